@@ -3,551 +3,238 @@
 import os
 import sys
 import argparse
-import csv
-import json
 import time
-import random
-from itertools import groupby
-from operator import itemgetter
 import logging
 import textwrap
 
-
-def detect_column_names(field_names):
-    if "RESOLVED_ENTITY_ID" in field_names:
-        cluster_field, source_field, record_field, score_field = (
-            "RESOLVED_ENTITY_ID",
-            "DATA_SOURCE",
-            "RECORD_ID",
-            "MATCH_KEY",
-        )
-    else:
-        cluster_field = source_field = record_field = score_field = None
-        for field_name in field_names:
-            if field_name.upper() in ("ENTITY_ID", "CLUSTER_ID"):
-                cluster_field = field_name
-            elif field_name.upper() == "DATA_SOURCE":
-                source_field = field_name
-            elif field_name.upper() == "RECORD_ID":
-                record_field = field_name
-            elif field_name.upper() == "SCORE":
-                score_field = field_name
-        if not cluster_field or not source_field or not record_field:
-            raise Exception(
-                f"Expected fields missing for {file_name}, need at least ENTITY_ID, DATA_SOURCE and RECORD_ID"
+from G2AuditCommon import (
+    add_audit_arguments,
+    configure_logging,
+    count_by_key,
+    format_seconds,
+    is_database_source,
+    new_performance,
+    pair_count,
+    peak_rss_mb,
+    Progress,
+    timed_phase,
+)
+from G2AuditDatabase import DATABASE_QUERIES
+from G2AuditFiles import read_entity_rows, row_filter_options, sample_group_counts
+from G2AuditCompact import index_command, index_files
+from G2AuditMaps import load_files_in_parallel, load_from_file, stream_entity_map
+from G2AuditSinks import AUDIT_CSV_HEADERS, AUDIT_SINKS
+from G2AuditStats import format_estimates, PairReplicates, write_metrics_file
+from G2AuditExternal import external_audit
+from G2AuditReaudit import reaudit, reaudit_command
+from G2AuditEngine import audit_checkpoint_key, audit_maps, AuditEngine, load_checkpoint
+from G2AuditSeries import audit_series, series_command
+from G2AuditServe import serve, serve_command
+from G2AuditPrecheck import format_precheck, map_precheck, precheck, within_max_missing
+
+__all__ = [
+    "audit",
+    "stat_checker",
+    "AuditEngine",
+    "AUDIT_CSV_HEADERS",
+    "DATABASE_QUERIES",
+    "audit_series",
+    "index_files",
+    "load_from_file",
+    "peak_rss_mb",
+    "precheck",
+    "reaudit",
+    "serve",
+]
+
+
+def audit(file_name1, file_name2, output_root, debug, **kwargs):
+    if kwargs.get("external"):
+        if kwargs.get("max_missing") is not None:
+            # the external audit never holds the record keys, so they are read first
+            start_time = time.time()
+            try:
+                report = precheck(file_name1, file_name2, **kwargs)
+            except Exception as err:
+                logging.error(f"{err} prechecking files")
+                return 1
+            logging.info(
+                f"precheck complete in {format_seconds(time.time() - start_time)}"
             )
-    return cluster_field, source_field, record_field, score_field
-
-
-def load_from_file(file_name, file_type):
-    logging.info(f"loading {file_name} ...")
-    file_map = {"entities": {}, "records": {}, "relations": {}}
-    with open(file_name, "r") as f:
-        reader = csv.DictReader(f)
-        cluster_field, source_field, record_field, score_field = detect_column_names(
-            reader.fieldnames
-        )
-        progress_cntr = 0
-        for record in reader:
-            progress_cntr = progress_display(
-                progress_cntr, f"{file_type} records loaded", interval=100000
+            if not within_max_missing(report, kwargs["max_missing"]):
+                return 1
+        return external_audit(file_name1, file_name2, output_root, **kwargs)
+
+    performance = new_performance()
+    workers = kwargs.get("workers") or 1
+    checkpoint_file = output_root + ".checkpoint"
+    checkpoint_key = None
+    resumed = None
+    if kwargs.get("checkpoint_every") or kwargs.get("resume"):
+        checkpoint_key = audit_checkpoint_key(file_name1, file_name2, **kwargs)
+    if kwargs.get("resume"):
+        try:
+            resumed = load_checkpoint(checkpoint_file)
+        except Exception as err:
+            logging.error(f"{err} reading {checkpoint_file}")
+            return 1
+        if resumed is None:
+            logging.warning(
+                f"there is no {checkpoint_file} to resume, starting from the beginning"
             )
-            entity_id = str(record[cluster_field])
-            if entity_id not in file_map["entities"]:
-                file_map["entities"][entity_id] = {}
-            if record.get("RELATED_ENTITY_ID", "0") == "0":
-                record_key = compute_record_key(
-                    record, cluster_field, source_field, record_field, score_field
-                )
-                file_map["entities"][entity_id][record_key] = record.get(
-                    score_field, ""
-                )
-                file_map["records"][record_key] = entity_id
-            elif file_type == "newer":  # don't need relationships for prior
-                rel_key = "|".join(
-                    sorted([record["RESOLVED_ENTITY_ID"], record["RELATED_ENTITY_ID"]])
-                )
-                if rel_key not in file_map["relations"]:
-                    file_map["relations"][rel_key] = record.get(score_field, "")
-        progress_cntr = progress_display(progress_cntr, "records loaded, complete")
-    return file_map
-
+        elif resumed["key"] != checkpoint_key:
+            logging.error(
+                f"{checkpoint_file} is for other files or options, rerun without --resume"
+            )
+            return 1
+        else:
+            logging.info(f"resuming after {resumed['cursor']:,} newer entities audited")
 
-def audit(file_name1, file_name2, output_root, debug):
     try:
-        newer_map = load_from_file(file_name1, "newer")
-        prior_map = load_from_file(file_name2, "prior")
+        if workers > 1 and not kwargs.get("compact") and not kwargs.get("cache_dir"):
+            with timed_phase(performance, "LOAD"):
+                newer_map, prior_map = load_files_in_parallel(
+                    [
+                        (file_name1, "newer", kwargs.get("newer_query")),
+                        (file_name2, "prior", kwargs.get("prior_query")),
+                    ],
+                    workers,
+                    **row_filter_options(kwargs),
+                )
+        else:
+            with timed_phase(performance, "NEWER_LOAD"):
+                newer_map = None
+                if kwargs.get("stream_newer") and not is_database_source(file_name1):
+                    newer_map = stream_entity_map(
+                        file_name1,
+                        "newer",
+                        **row_filter_options(kwargs),
+                    )
+                if newer_map is None:
+                    newer_map = load_from_file(
+                        file_name1,
+                        "newer",
+                        compact=kwargs.get("compact"),
+                        cache_dir=kwargs.get("cache_dir"),
+                        query=kwargs.get("newer_query"),
+                        **row_filter_options(kwargs),
+                    )
+            with timed_phase(performance, "PRIOR_LOAD"):
+                prior_map = load_from_file(
+                    file_name2,
+                    "prior",
+                    compact=kwargs.get("compact"),
+                    cache_dir=kwargs.get("cache_dir"),
+                    query=kwargs.get("prior_query"),
+                    **row_filter_options(kwargs),
+                )
     except Exception as err:
         logging.error(f"{err} loading files")
         return 1
-
-    csv_file_name = output_root + ".csv"
-    json_file_name = output_root + ".json"
-    csv_headers = [
-        "audit_id",
-        "audit_category",
-        "audit_result",
-        "data_source",
-        "record_id",
-        "prior_id",
-        "prior_score",
-        "newer_id",
-        "newer_score",
-    ]
-    try:
-        csv_handle = open(csv_file_name, "w")
-        csv_writer = csv.writer(csv_handle)
-        csv_writer.writerow(csv_headers)
-    except Exception as err:
-        logging.error(f"{err} opening {csv_file_name}")
+    if kwargs.get("max_missing") is not None and not within_max_missing(
+        map_precheck(newer_map, prior_map), kwargs["max_missing"]
+    ):
         return 1
 
-    newer_pair_count = 0
-    prior_entities = {}
-    prior_pair_count = 0
-    common_entity_count = 0
-    common_pair_count = 0
-    missing_prior_record_cnt = 0
-    missing_newer_record_cnt = 0
-    next_audit_id = 0
-    audit_stats = {}
-
-    logging.info("auditing newer entities ...")
-    progress_cntr = 0
-    for newer_entity_id in newer_map["entities"]:
-        progress_cntr = progress_display(progress_cntr, "newer entities audited")
-        logging.debug("-" * 50)
-        logging.debug(
-            f"newer entity {newer_entity_id} has {len(newer_map['entities'][newer_entity_id])} records"
-        )
-        prior_entity_ids = {}
-        newer_keys_found = {}
-        any_missing = False
-        missing_cnt = 0
-        for newer_key in newer_map["entities"][newer_entity_id]:
-            prior_entity_id = prior_map["records"].get(newer_key, "unknown")
-            if prior_entity_id != "unknown":
-                newer_keys_found[newer_key] = prior_entity_id
-                prior_entity_ids = count_by_key(prior_entity_ids, prior_entity_id)
-            else:
-                missing_cnt += 1
-        newer_pair_count += len(newer_keys_found) * (len(newer_keys_found) - 1) / 2
-
-        if missing_cnt:
-            logging.debug(f"prior set is missing {missing_cnt} records!")
-            missing_prior_record_cnt += missing_cnt
-            any_missing = True
-            if len(newer_keys_found) == 0:
-                logging.debug(
-                    "skipping as prior set does not have any of the newer records!"
-                )
-                continue
-
-        prior_entity_id = "unknown"
-        for entity_id in prior_entity_ids:  # choose the largest matching entity
-            logging.debug(
-                f"prior entity {entity_id} has {prior_entity_ids[entity_id]} of those records, plus {len(prior_map['entities'][entity_id])-prior_entity_ids[entity_id]} more"
-            )
-            if prior_entity_ids[entity_id] > prior_entity_ids.get(prior_entity_id, 0):
-                prior_entity_id = entity_id
-            elif (
-                prior_entity_ids[entity_id] == prior_entity_ids.get(prior_entity_id, 0)
-                and entity_id < prior_entity_id
-            ):
-                prior_entity_id = entity_id
-        if len(prior_entity_ids) > 1:
-            logging.debug(
-                f"prior entity {prior_entity_id} selected as it has the most matching records or is the lowest entity_id!"
-            )
-
-        same_cnt = new_pos_cnt = 0
-        audit_records = []
-        for newer_key in newer_map["entities"][newer_entity_id]:
-            data_source, record_id = parse_record_key(newer_key)
-            audit_record = {
-                "data_source": data_source,
-                "record_id": record_id,
-                "record_key": newer_key,
-                "newer_id": newer_entity_id,
-                "newer_score": newer_map["entities"][newer_entity_id][newer_key],
-                "prior_id": newer_keys_found.get(newer_key, "unknown"),
-                "prior_score": "",
-            }
-            if audit_record["prior_id"] == prior_entity_id:
-                audit_record["audit_result"] = "same"
-                audit_record["prior_score"] = prior_map["entities"][prior_entity_id][
-                    newer_key
-                ]
-                same_cnt += 1
-            elif audit_record["prior_id"] != "unknown":
-                audit_record["audit_result"] = "new positive"
-                new_pos_cnt += 1
-            else:
-                audit_record["audit_result"] = "missing"
-            audit_records.append(audit_record)
-
-        missing_cnt = 0
-        new_neg_cnt = 0
-        newer_entity_ids = {}
-        for prior_key in prior_map["entities"].get(prior_entity_id, []):
-            newer_entity_id2 = newer_map["records"].get(prior_key, "unknown")
-            if prior_key not in newer_map["entities"][newer_entity_id]:
-                data_source, record_id = parse_record_key(prior_key)
-                audit_record = {
-                    "data_source": data_source,
-                    "record_id": record_id,
-                    "record_key": prior_key,
-                    "newer_id": newer_entity_id2,
-                    "newer_score": "",  # will be replaced by relationship match_key later
-                    "audit_result": (
-                        "new negative" if newer_entity_id2 != "unknown" else "missing"
-                    ),
-                    "prior_id": prior_entity_id,
-                    "prior_score": prior_map["entities"][prior_entity_id][prior_key],
-                }
-                if audit_record["audit_result"] == "new negative":
-                    new_neg_cnt += 1
-                else:
-                    missing_cnt += 1
-                audit_records.append(audit_record)
-
-            if newer_entity_id2 != "unknown":
-                newer_entity_ids = count_by_key(newer_entity_ids, newer_entity_id2)
-
-        if prior_entity_id not in prior_entities:
-            prior_entities[prior_entity_id] = True
-            prior_entity_record_count = (
-                len(prior_map["entities"].get(prior_entity_id, [])) - missing_cnt
-            )
-            prior_pair_count += (
-                prior_entity_record_count * (prior_entity_record_count - 1) / 2
-            )
+    stat_pack = audit_maps(
+        newer_map,
+        prior_map,
+        output_root,
+        performance,
+        checkpoint_key=checkpoint_key,
+        resumed=resumed,
+        **kwargs,
+    )
+    if stat_pack is None:
+        return 1
+    write_metrics_file(stat_pack, kwargs.get("metrics_file"))
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return 0
 
-        if missing_cnt:
-            logging.debug(f"newer set is missing {missing_cnt} records!")
-            missing_newer_record_cnt += missing_cnt
-            any_missing = True
 
-        # always get credit for same pairs
-        common_pair_count += same_cnt * (same_cnt - 1) / 2
+def stat_checker_file_loader(file_name, file_type, query=None, **kwargs):
+    """returns the number of entities and a record_key -> entity_id map
 
-        # skip entity reporting if same
-        if new_pos_cnt + new_neg_cnt == 0 and not any_missing:
-            common_entity_count += 1
-            logging.debug("skipping as result is same!")
+    A record listed under more than one entity maps to a tuple of their entity ids.
+    The data_sources and sample_rate options are those of filter_entity_rows().
+    """
+    entity_ids = set()
+    records = {}
+    for entity_id, record_key, _, _ in read_entity_rows(
+        file_name, file_type, query, **kwargs
+    ):
+        entity_ids.add(entity_id)
+        if record_key is None:
             continue
-
-        # skip if another newer entity has more matching records in the prior
-        if len(newer_entity_ids) > 1:
-            best_newer_entity_id = newer_entity_id
-            for newer_entity_id2 in newer_entity_ids:
-                if (
-                    newer_entity_ids[newer_entity_id2]
-                    > newer_entity_ids[best_newer_entity_id]
-                ):
-                    best_newer_entity_id = newer_entity_id2
-                    logging.debug(
-                        f"oops, newer entity id {best_newer_entity_id} has {newer_entity_ids[best_newer_entity_id]} matching records for prior_entity {prior_entity_id}"
-                    )
-                elif (
-                    newer_entity_ids[newer_entity_id2]
-                    == newer_entity_ids[best_newer_entity_id]
-                    and newer_entity_id2 < newer_entity_id
-                ):
-                    best_newer_entity_id = newer_entity_id2
-                    logging.debug(
-                        f"oops, newer entity id {best_newer_entity_id} has the same number of matching records for prior_entity {prior_entity_id} and is a lower ID!"
-                    )
-                    break
-            if best_newer_entity_id != newer_entity_id:
-                logging.debug(
-                    f"skipping as {best_newer_entity_id} is a better match for the selected prior entity!"
-                )
-                continue
-
-        logging.debug(
-            f"logging prior entity {prior_entity_id} with {new_pos_cnt} new positives and {new_neg_cnt} new negatives"
-        )
-
-        # log it to the proper categories
-        audit_category = ""
-        if any_missing:
-            audit_category += "+MISSING"
-        if new_neg_cnt:
-            audit_category += "+SPLIT"
-        if new_pos_cnt:
-            audit_category += "+MERGE"
-        if not audit_category:
-            audit_category = "+UNKNOWN"
-        audit_category = audit_category[1:]
-
-        if audit_category not in audit_stats:
-            audit_stats[audit_category] = {}
-            audit_stats[audit_category]["COUNT"] = 0
-            audit_stats[audit_category]["SUB_CATEGORY"] = {}
-        audit_stats[audit_category]["COUNT"] += 1
-        next_audit_id += 1
-
-        newer_match_keys = {}
-        for audit_record in audit_records:
-            newer_match_keys = list_by_key(
-                newer_match_keys, audit_record["newer_id"], audit_record["newer_score"]
-            )
-
-        score_counts = {}
-        csv_rows = []
-        for audit_record in audit_records:
-            if audit_record["audit_result"] == "same":
-                audit_record["prior_score"] = ""
-                audit_record["newer_score"] = ""
-            elif (
-                audit_record["audit_result"] == "new negative"
-            ):  # use relationship score
-                rel_key = "|".join(sorted([newer_entity_id, audit_record["newer_id"]]))
-                if rel_key in newer_map["relations"]:
-                    audit_record["newer_score"] = "related on: " + newer_map[
-                        "relations"
-                    ].get(rel_key, "unspecified")
-                else:
-                    audit_record["newer_score"] = "not related"
-            elif (
-                audit_record["audit_result"] == "new positive"
-                and not audit_record["newer_score"]
-            ):
-                if len(newer_match_keys.get(audit_record["newer_id"], [])) == 1:
-                    audit_record["newer_score"] = newer_match_keys[
-                        audit_record["newer_id"]
-                    ][0]
-                else:
-                    audit_record["newer_score"] = "multiple"
-            score_counts = count_by_key(score_counts, audit_record["newer_score"])
-
-            csv_rows.append(
-                [
-                    next_audit_id,
-                    audit_category,
-                    audit_record["audit_result"],
-                    audit_record["data_source"],
-                    audit_record["record_id"],
-                    audit_record["prior_id"],
-                    audit_record["prior_score"],
-                    audit_record["newer_id"],
-                    audit_record["newer_score"],
-                ]
-            )
-            logging.debug(csv_rows[-1])
-
-        csv_writer.writerows(csv_rows)
-
-        audit_sample = [dict(zip(csv_headers, csv_row)) for csv_row in csv_rows]
-
-        if len(score_counts) == 0:
-            best_score = "none"
-        elif len(score_counts) == 1:
-            best_score = list(score_counts.keys())[0]
-        else:
-            best_score = "multiple"
-        logging.debug(f"{audit_category} sub category assigned is {best_score}")
-
-        if best_score not in audit_stats[audit_category]["SUB_CATEGORY"]:
-            audit_stats[audit_category]["SUB_CATEGORY"][best_score] = {}
-            audit_stats[audit_category]["SUB_CATEGORY"][best_score]["COUNT"] = 0
-            audit_stats[audit_category]["SUB_CATEGORY"][best_score]["SAMPLE"] = []
-        audit_stats[audit_category]["SUB_CATEGORY"][best_score]["COUNT"] += 1
-        if len(audit_stats[audit_category]["SUB_CATEGORY"][best_score]["SAMPLE"]) < 500:
-            audit_stats[audit_category]["SUB_CATEGORY"][best_score]["SAMPLE"].append(
-                audit_sample
-            )
-        else:
-            random_index = random.randint(1, 499)
-            if random_index % 10 != 0:
-                audit_stats[audit_category]["SUB_CATEGORY"][best_score]["SAMPLE"][
-                    random_index
-                ] = audit_sample
-
-        # if debug:
-        #    input('press any key to continue')
-    progress_cntr = progress_display(progress_cntr, "newer entities audited, complete")
-    csv_handle.close()
-
-    prior_entity_count = len(prior_map["entities"])
-    newer_entity_count = len(newer_map["entities"])
-    entity_precision = (
-        round(common_entity_count + 0.0 / newer_entity_count + 0.0, 5)
-        if newer_entity_count
-        else 0
-    )
-    entity_recall = (
-        round(common_entity_count + 0.0 / newer_entity_count + 0.0, 5)
-        if prior_entity_count
-        else 0
-    )
-    entity_f1_score = (
-        round(
-            2 * (entity_precision * entity_recall) / (entity_precision + entity_recall),
-            5,
-        )
-        if entity_precision or entity_recall
-        else 0
+        listed_entity_id = records.setdefault(record_key, entity_id)
+        if listed_entity_id != entity_id:
+            if not isinstance(listed_entity_id, tuple):
+                listed_entity_id = (listed_entity_id,)
+            if entity_id not in listed_entity_id:
+                records[record_key] = listed_entity_id + (entity_id,)
+    return len(entity_ids), records
+
+
+def record_entity_ids(listed_entity_id):
+    return (
+        listed_entity_id if isinstance(listed_entity_id, tuple) else (listed_entity_id,)
     )
 
-    pair_same_positive = common_pair_count
-    pair_new_positive = (
-        newer_pair_count - common_pair_count
-        if newer_pair_count > common_pair_count
-        else 0
-    )
-    pair_new_negative = (
-        prior_pair_count - common_pair_count
-        if prior_pair_count > common_pair_count
-        else 0
-    )
-    pair_precision = (
-        round(pair_same_positive / (pair_same_positive + pair_new_positive), 5)
-        if pair_same_positive + pair_new_positive > 0
-        else 0
-    )
-    pair_recall = (
-        round(pair_same_positive / (pair_same_positive + pair_new_negative), 5)
-        if pair_same_positive + pair_new_negative > 0
-        else 0
-    )
-    pair_f1_score = (
-        round((2 * pair_precision * pair_recall) / (pair_precision + pair_recall), 5)
-        if pair_precision + pair_recall > 0
-        else 0
-    )
-
-    stat_pack = {
-        "SOURCE": "G2Audit",
-        "ENTITY": {
-            "PRIOR_COUNT": prior_entity_count,
-            "NEWER_COUNT": newer_entity_count,
-            "COMMON_COUNT": common_entity_count,
-            "PRECISION": entity_precision,
-            "RECALL": entity_recall,
-            "F1-SCORE": entity_f1_score,
-        },
-        "PAIRS": {
-            "PRIOR_COUNT": prior_pair_count,
-            "NEWER_COUNT": newer_pair_count,
-            "COMMON_COUNT": common_pair_count,
-            "SAME_POSITIVE": pair_same_positive,
-            "NEW_POSITIVE": pair_new_positive,
-            "NEW_NEGATIVE": pair_new_negative,
-            "PRECISION": pair_precision,
-            "RECALL": pair_recall,
-            "F1-SCORE": pair_f1_score,
-        },
-        "AUDIT": audit_stats,
-    }
-    with open(json_file_name, "w") as f:
-        json.dump(stat_pack, f)
-
-    print(
-        textwrap.dedent(
-            f"""\
 
-    {stat_pack['PAIRS']['PRIOR_COUNT']} prior pairs
-    {stat_pack['PAIRS']['NEWER_COUNT']} newer pairs
-    {stat_pack['PAIRS']['COMMON_COUNT']} common pairs
-
-    {stat_pack['PAIRS']['SAME_POSITIVE']} same positives
-    {stat_pack['PAIRS']['NEW_POSITIVE']} new positives
-    {stat_pack['PAIRS']['NEW_NEGATIVE']} new negatives
-    {stat_pack['PAIRS']['PRECISION']} precision
-    {stat_pack['PAIRS']['RECALL']} recall
-    {stat_pack['PAIRS']['F1-SCORE']} f1-score
-
-    {stat_pack['ENTITY']['PRIOR_COUNT']} prior entities
-    {stat_pack['ENTITY']['NEWER_COUNT']} new entities
-    {stat_pack['ENTITY']['COMMON_COUNT']} common entities
-    {stat_pack['AUDIT'].get('MERGE', {}).get('COUNT', 0)} merged entities
-    {stat_pack['AUDIT'].get('SPLIT', {}).get('COUNT', 0)} split entities
-    {stat_pack['AUDIT'].get('SPLIT+MERGE', {}).get('COUNT', 0)} split+merge entities
+def stat_checker(newer_file_name, prior_file_name, **kwargs):
+    """simplified statistic checker
 
+    The pair counts come from the sparse newer x prior contingency table of record
+    counts rather than from listing every pair: records resolved together in both
+    files are the sum of C(n_ij, 2) over its cells and the newer and prior pair counts
+    are the sums of C(n, 2) over each file's entity sizes.
     """
+    try:
+        newer_entity_count, newer_records = stat_checker_file_loader(
+            newer_file_name,
+            "newer",
+            kwargs.get("newer_query"),
+            **row_filter_options(kwargs),
         )
-    )
-    if missing_prior_record_cnt or missing_newer_record_cnt:
-        print(f"{missing_prior_record_cnt} missing prior records")
-        print(f"{missing_newer_record_cnt} missing newer records")
-        print()
-    return 0
-
-
-def stat_checker_file_loader(file_name):
-    entity_count = 0
-    pairs = {}
-    with open(file_name, "r") as f:
-        reader = csv.DictReader(f)
-        cluster_field, source_field, record_field, score_field = detect_column_names(
-            reader.fieldnames
+        prior_entity_count, prior_records = stat_checker_file_loader(
+            prior_file_name,
+            "prior",
+            kwargs.get("prior_query"),
+            **row_filter_options(kwargs),
         )
-        sorted_reader = sorted(
-            reader, key=itemgetter(cluster_field)
-        )  # can't rely on input being sorted
-        progress_cntr = 0
-        for entity_group in groupby(sorted_reader, key=itemgetter(cluster_field)):
-            progress_cntr = progress_display(progress_cntr, "entities loaded")
-            entity_count += 1
-            entity_id = entity_group[0]
-            entity_records = [
-                x
-                for x in list(entity_group[1])
-                if x.get("RELATED_ENTITY_ID", "0") == "0"
-            ]
-            for entity_record1 in entity_records:
-                record_key1 = compute_record_key(
-                    entity_record1,
-                    cluster_field,
-                    source_field,
-                    record_field,
-                    score_field,
-                )
-                for entity_record2 in entity_records:
-                    record_key2 = compute_record_key(
-                        entity_record2,
-                        cluster_field,
-                        source_field,
-                        record_field,
-                        score_field,
-                    )
-                    if record_key1 < record_key2:
-                        pairs[f"{record_key1}|{record_key2}"] = entity_id
-        progress_cntr = progress_display(progress_cntr, "entities loaded, complete")
-    return entity_count, pairs
-
-
-def stat_checker(newer_file_name, prior_file_name):
-    """simplified statistic checker"""
-    try:
-        newer_entity_count, newer_pairs = stat_checker_file_loader(newer_file_name)
-        prior_entity_count, prior_pairs = stat_checker_file_loader(prior_file_name)
     except Exception as err:
         logging.error(f"{err} loading files")
         return 1
 
-    logging.info("checking newer pairs for true and false positives")
-    true_positive_count = 0
-    false_positive_count = 0
-    progress_cntr = 0
-    for newer_pair in newer_pairs:
-        progress_cntr = progress_display(progress_cntr, "newer pairs checked")
-        if newer_pair in prior_pairs:
-            true_positive_count += 1
-        else:
-            false_positive_count += 1
-    progress_cntr = progress_display(progress_cntr, "newer pairs checked, complete")
-
-    progress_cntr = 0
-    logging.info("checking prior pairs for false negatives")
-    false_negative_count = 0
-    for prior_pair in prior_pairs:
-        progress_cntr = progress_display(progress_cntr, "prior pairs checked")
-        if prior_pair not in newer_pairs:
-            false_negative_count += 1
-    progress_cntr = progress_display(progress_cntr, "prior pairs checked, complete")
+    logging.info("building newer x prior contingency table")
+    newer_sizes = {}
+    for listed_entity_id in newer_records.values():
+        for newer_entity_id in record_entity_ids(listed_entity_id):
+            newer_sizes = count_by_key(newer_sizes, newer_entity_id)
+    prior_sizes = {}
+    for listed_entity_id in prior_records.values():
+        for prior_entity_id in record_entity_ids(listed_entity_id):
+            prior_sizes = count_by_key(prior_sizes, prior_entity_id)
+    contingency = {}
+    progress = Progress("newer records checked", total=len(newer_records))
+    for record_key, listed_entity_id in newer_records.items():
+        progress.update()
+        listed_prior_entity_id = prior_records.get(record_key)
+        if listed_prior_entity_id is None:
+            continue
+        for newer_entity_id in record_entity_ids(listed_entity_id):
+            for prior_entity_id in record_entity_ids(listed_prior_entity_id):
+                contingency = count_by_key(
+                    contingency, (newer_entity_id, prior_entity_id)
+                )
+    progress.finish()
+
+    newer_pair_count = sum(pair_count(size) for size in newer_sizes.values())
+    prior_pair_count = sum(pair_count(size) for size in prior_sizes.values())
+    true_positive_count = sum(pair_count(size) for size in contingency.values())
+    false_positive_count = newer_pair_count - true_positive_count
+    false_negative_count = prior_pair_count - true_positive_count
 
     precision = (
         round(true_positive_count / (true_positive_count + false_positive_count), 5)
@@ -565,6 +252,57 @@ def stat_checker(newer_file_name, prior_file_name):
         else 0
     )
 
+    # adjusted rand index and b-cubed scores only compare the records in both files
+    common_newer_sizes = {}
+    common_prior_sizes = {}
+    for (newer_entity_id, prior_entity_id), size in contingency.items():
+        common_newer_sizes[newer_entity_id] = (
+            common_newer_sizes.get(newer_entity_id, 0) + size
+        )
+        common_prior_sizes[prior_entity_id] = (
+            common_prior_sizes.get(prior_entity_id, 0) + size
+        )
+    common_record_count = sum(contingency.values())
+    newer_common_pairs = sum(pair_count(size) for size in common_newer_sizes.values())
+    prior_common_pairs = sum(pair_count(size) for size in common_prior_sizes.values())
+    expected_index = (
+        newer_common_pairs * prior_common_pairs / pair_count(common_record_count)
+        if common_record_count > 1
+        else 0
+    )
+    max_index = (newer_common_pairs + prior_common_pairs) / 2
+    adjusted_rand_index = (
+        round((true_positive_count - expected_index) / (max_index - expected_index), 5)
+        if max_index != expected_index
+        else 1.0
+    )
+    bcubed_precision = bcubed_recall = 0
+    if common_record_count:
+        bcubed_precision = round(
+            sum(
+                size * size / common_newer_sizes[newer_entity_id]
+                for (newer_entity_id, _), size in contingency.items()
+            )
+            / common_record_count,
+            5,
+        )
+        bcubed_recall = round(
+            sum(
+                size * size / common_prior_sizes[prior_entity_id]
+                for (_, prior_entity_id), size in contingency.items()
+            )
+            / common_record_count,
+            5,
+        )
+    bcubed_f1_score = (
+        round(
+            (2 * bcubed_precision * bcubed_recall) / (bcubed_precision + bcubed_recall),
+            5,
+        )
+        if bcubed_precision + bcubed_recall > 0
+        else 0
+    )
+
     print(
         textwrap.dedent(
             f"""\
@@ -572,8 +310,8 @@ def stat_checker(newer_file_name, prior_file_name):
     {newer_entity_count} newer_entities
     {prior_entity_count} prior_entities
 
-    {len(newer_pairs)} newer_pairs
-    {len(prior_pairs)} prior_pairs
+    {newer_pair_count} newer_pairs
+    {prior_pair_count} prior_pairs
 
     {true_positive_count} true_positives
     {false_positive_count} false_positives
@@ -583,62 +321,83 @@ def stat_checker(newer_file_name, prior_file_name):
     {recall} recall
     {f1_score} f1-score
 
+    {common_record_count} common_records
+    {adjusted_rand_index} adjusted_rand_index
+    {bcubed_precision} bcubed_precision
+    {bcubed_recall} bcubed_recall
+    {bcubed_f1_score} bcubed_f1-score
+
     """
         )
     )
+    if kwargs.get("sample_rate"):
+        pair_replicates = checker_pair_replicates(
+            newer_records, prior_records, kwargs["sample_rate"]
+        )
+        estimates = pair_replicates.estimates(
+            [newer_pair_count, prior_pair_count, true_positive_count],
+            kwargs["sample_rate"],
+        )
+        print(format_estimates(estimates))
     return 0
 
 
-def count_by_key(_dict, _key):
-    if _key:
-        if _key in _dict:
-            _dict[_key] += 1
-        else:
-            _dict[_key] = 1
-    return _dict
-
-
-def list_by_key(_dict, _key, _item):
-    if _key not in _dict:
-        _dict[_key] = [_item]
-    elif _item and _item not in _dict[_key]:
-        _dict[_key].append(_item)
-    return _dict
-
-
-def compute_record_key(record, cluster_field, source_field, record_field, score_field):
-    return f"{record[source_field]}||{record[record_field]}"
+def checker_pair_replicates(newer_records, prior_records, sample_rate):
+    """the PairReplicates of the statistic checker, from the hash ranges of the records
+    of each newer entity, prior entity and contingency table cell"""
+    cell_keys = {}
+    for record_key, listed_entity_id in newer_records.items():
+        listed_prior_entity_id = prior_records.get(record_key)
+        for newer_entity_id in record_entity_ids(listed_entity_id):
+            cell_keys.setdefault((0, newer_entity_id), []).append(record_key)
+            if listed_prior_entity_id is None:
+                continue
+            for prior_entity_id in record_entity_ids(listed_prior_entity_id):
+                cell_keys.setdefault((2, newer_entity_id, prior_entity_id), []).append(
+                    record_key
+                )
+    for record_key, listed_entity_id in prior_records.items():
+        for prior_entity_id in record_entity_ids(listed_entity_id):
+            cell_keys.setdefault((1, prior_entity_id), []).append(record_key)
+    pair_replicates = PairReplicates()
+    for cell_key, record_keys in cell_keys.items():
+        pair_replicates.add(cell_key[0], sample_group_counts(record_keys, sample_rate))
+    return pair_replicates
 
 
-def parse_record_key(key):
-    return key.split("||")
+if __name__ == "__main__":
 
+    if sys.argv[1:2] == ["index"]:
+        sys.exit(index_command(sys.argv[2:]))
 
-def progress_display(progress_cntr, desc, **kwargs):
-    interval = kwargs.get("interval", 100000)
-    if "complete" not in desc:
-        progress_cntr += 1
-    if progress_cntr % interval == 0 or "complete" in desc:
-        logging.info(f"{progress_cntr:,} {desc}")
-    return progress_cntr
+    if sys.argv[1:2] == ["serve"]:
+        sys.exit(serve_command(sys.argv[2:]))
 
+    if sys.argv[1:2] == ["series"]:
+        sys.exit(series_command(sys.argv[2:]))
 
-if __name__ == "__main__":
+    if sys.argv[1:2] == ["reaudit"]:
+        sys.exit(reaudit_command(sys.argv[2:]))
 
-    argParser = argparse.ArgumentParser()
+    argParser = argparse.ArgumentParser(
+        epilog="use G2Audit.py index --help to see how to build the --cache_dir ahead of time"
+        ", G2Audit.py series --help to see how to audit a series of snapshots"
+        ", G2Audit.py serve --help to see how to keep prior files loaded for many audits"
+        " and G2Audit.py reaudit --help to see how to update a --save_state audit for changed records"
+    )
     argParser.add_argument(
         "-n",
         "--newer_csv_file",
         dest="newerFile",
         default=None,
-        help="the latest entity map file",
+        help="the latest entity map file (csv or json lines, may be compressed) or module://dsn database",
     )
     argParser.add_argument(
         "-p",
         "--prior_csv_file",
         dest="priorFile",
         default=None,
-        help="the prior entity map file",
+        help="the prior entity map file (csv or json lines, may be compressed) or module://dsn database",
     )
     argParser.add_argument(
         "-o",
@@ -647,14 +406,7 @@ if __name__ == "__main__":
         default=None,
         help="the output file root name (both a .csv and a .json file will be created",
     )
-    argParser.add_argument(
-        "-D",
-        "--debug",
-        dest="debug",
-        action="store_true",
-        default=False,
-        help="print debug statements",
-    )
+    add_audit_arguments(argParser, "debug")
     argParser.add_argument(
         "-C",
         "--checker",
@@ -663,38 +415,268 @@ if __name__ == "__main__":
         default=False,
         help="run simplified statistic checker",
     )
+    add_audit_arguments(argParser, "compact")
+    argParser.add_argument(
+        "--external",
+        dest="external",
+        action="store_true",
+        default=False,
+        help="audit with on disk sort/merge passes for files too large for memory",
+    )
+    argParser.add_argument(
+        "--memory_limit",
+        dest="memoryLimit",
+        default="1G",
+        help="approximate memory to use for --external sorting such as 512M or 4G, default=1G",
+    )
+    argParser.add_argument(
+        "--temp_dir",
+        dest="tempDir",
+        default=None,
+        help="directory for the --external sort files, default is the system temp directory",
+    )
+    add_audit_arguments(argParser, "workers", "numpy")
+    argParser.add_argument(
+        "--stream_newer",
+        dest="streamNewer",
+        action="store_true",
+        default=False,
+        help="read the newer file an entity at a time during the audit instead of holding it all in memory, if its rows are grouped by entity id",
+    )
+    add_audit_arguments(argParser, "cache_dir", "one_to_one", "data_sources")
+    argParser.add_argument(
+        "--sample_rate",
+        dest="sampleRate",
+        type=float,
+        default=None,
+        help="fraction of the records to audit, such as 0.01, picked by a hash of their record keys to quickly estimate the pair scores",
+    )
+    argParser.add_argument(
+        "--checkpoint_every",
+        dest="checkpointEvery",
+        type=int,
+        default=None,
+        help="save a checkpoint of the audit every this many newer entities so --resume can carry on after a crash",
+    )
+    argParser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        default=False,
+        help="carry on from the last checkpoint of an audit to the same output root",
+    )
+    argParser.add_argument(
+        "--save_state",
+        dest="saveState",
+        action="store_true",
+        default=False,
+        help="also save the loaded files and counters to a .state file that G2Audit.py reaudit can update for changed records",
+    )
+    argParser.add_argument(
+        "--precheck",
+        dest="precheck",
+        action="store_true",
+        default=False,
+        help="only estimate how many records of each file are missing from the other from hash sketches of their record keys",
+    )
+    argParser.add_argument(
+        "--max_missing",
+        dest="maxMissing",
+        type=float,
+        default=None,
+        help="stop once the files are loaded if more than this fraction of either file's records, such as 0.1, is missing from the other (--external reads the files an extra time to check first)",
+    )
+    argParser.add_argument(
+        "--newer_query",
+        dest="newerQuery",
+        default=None,
+        help="query, or file containing it, to read a newer database with instead of the built in one for the Senzing tables",
+    )
+    argParser.add_argument(
+        "--prior_query",
+        dest="priorQuery",
+        default=None,
+        help="query, or file containing it, to read a prior database with instead of the built in one for the Senzing tables",
+    )
+    add_audit_arguments(argParser, "output_formats", "csv_compression")
+    argParser.add_argument(
+        "--metrics_file",
+        dest="metricsFile",
+        default=None,
+        help="also write the audit's timings and scores to this prometheus textfile",
+    )
+    argParser.add_argument(
+        "--sample_size",
+        dest="sampleSize",
+        type=int,
+        default=500,
+        help="number of audit results to sample for each sub category in the json file, default=500",
+    )
+    argParser.add_argument(
+        "--sample_rows",
+        dest="sampleRows",
+        type=int,
+        default=0,
+        help="most records of an audit result to keep in a sample, default=0 for all of them",
+    )
+    argParser.add_argument(
+        "--sample_seed",
+        dest="sampleSeed",
+        type=int,
+        default=1,
+        help="random seed of the samples so reruns pick the same ones, default=1",
+    )
     args = argParser.parse_args()
 
-    loggingLevel = logging.DEBUG if args.debug else logging.INFO
-    logging.basicConfig(
-        format="%(asctime)s %(levelname)s: %(message)s",
-        datefmt="%m/%d %I:%M",
-        level=loggingLevel,
-    )
+    configure_logging(args.debug)
 
     if not args.newerFile:
         logging.error("A newer csv file must be specified with -n")
         sys.exit(1)
-    elif not os.path.exists(args.newerFile):
+    elif not os.path.exists(args.newerFile) and not is_database_source(args.newerFile):
         logging.error("The newer csv file was not found!")
         sys.exit(1)
 
     if not args.priorFile:
         logging.error("A prior csv file must be specified with -p")
         sys.exit(1)
-    elif not os.path.exists(args.priorFile):
+    elif not os.path.exists(args.priorFile) and not is_database_source(args.priorFile):
         logging.error("The prior csv file was not found!")
         sys.exit(1)
 
-    if not args.outputRoot:
+    if not args.outputRoot and not args.precheck:
         logging.error("An output root must be specified with -o")
         sys.exit(1)
 
+    if args.oneToOne and args.external:
+        logging.error("--one_to_one can't be used with --external")
+        sys.exit(1)
+
+    if args.streamNewer and (
+        args.workers > 1 or args.external or args.oneToOne or args.cacheDir
+    ):
+        logging.error(
+            "--stream_newer can't be used with --workers, --external, --one_to_one or --cache_dir"
+        )
+        sys.exit(1)
+
+    if args.useNumpy and (args.workers > 1 or args.external):
+        logging.error("--numpy can't be used with --workers or --external")
+        sys.exit(1)
+
+    if args.sampleRate is not None and not 0 < args.sampleRate < 1:
+        logging.error("--sample_rate must be above 0 and below 1")
+        sys.exit(1)
+
+    if args.checkpointEvery is not None and args.checkpointEvery < 1:
+        logging.error("--checkpoint_every must be at least 1")
+        sys.exit(1)
+
+    if (args.checkpointEvery or args.resume) and not args.checker:
+        if args.workers > 1 or args.external:
+            logging.error(
+                "--checkpoint_every and --resume can't be used with --workers or --external"
+            )
+            sys.exit(1)
+        if args.outputFormats != "csv" or args.csvCompression:
+            logging.error(
+                "--checkpoint_every and --resume need the uncompressed csv output format"
+            )
+            sys.exit(1)
+
+    if args.saveState and not args.checker:
+        if args.workers > 1 or any(
+            (
+                args.external,
+                args.streamNewer,
+                args.compact,
+                args.cacheDir,
+                args.oneToOne,
+            )
+        ):
+            logging.error(
+                "--save_state can't be used with --workers, --external, --stream_newer, --compact, --cache_dir or --one_to_one"
+            )
+            sys.exit(1)
+        if "csv" not in args.outputFormats.split(","):
+            logging.error("--save_state needs the csv output format")
+            sys.exit(1)
+
+    unknown_formats = set(args.outputFormats.split(",")) - set(AUDIT_SINKS)
+    if unknown_formats:
+        logging.error(
+            f"Unknown output format {', '.join(sorted(unknown_formats))}, use {', '.join(AUDIT_SINKS)}"
+        )
+        sys.exit(1)
+
+    if args.maxMissing is not None and not 0 <= args.maxMissing <= 1:
+        logging.error("--max_missing must be between 0 and 1")
+        sys.exit(1)
+
+    if args.maxMissing is not None and args.checker:
+        logging.error("--max_missing can't be used with -C")
+        sys.exit(1)
+
+    dataSources = args.dataSources.split(",") if args.dataSources else None
+
     proc_start_time = time.time()
-    if args.checker:
-        success = stat_checker(args.newerFile, args.priorFile)
+    if args.precheck:
+        try:
+            print(
+                format_precheck(
+                    precheck(
+                        args.newerFile,
+                        args.priorFile,
+                        newer_query=args.newerQuery,
+                        prior_query=args.priorQuery,
+                        data_sources=dataSources,
+                        sample_rate=args.sampleRate,
+                    )
+                )
+            )
+            success = 0
+        except Exception as err:
+            logging.error(f"{err} prechecking files")
+            success = 1
+    elif args.checker:
+        success = stat_checker(
+            args.newerFile,
+            args.priorFile,
+            newer_query=args.newerQuery,
+            prior_query=args.priorQuery,
+            data_sources=dataSources,
+            sample_rate=args.sampleRate,
+        )
     else:
-        success = audit(args.newerFile, args.priorFile, args.outputRoot, args.debug)
+        success = audit(
+            args.newerFile,
+            args.priorFile,
+            args.outputRoot,
+            args.debug,
+            compact=args.compact,
+            external=args.external,
+            memory_limit=args.memoryLimit,
+            temp_dir=args.tempDir,
+            workers=args.workers,
+            use_numpy=args.useNumpy,
+            stream_newer=args.streamNewer,
+            cache_dir=args.cacheDir,
+            one_to_one=args.oneToOne,
+            data_sources=dataSources,
+            sample_rate=args.sampleRate,
+            checkpoint_every=args.checkpointEvery,
+            resume=args.resume,
+            save_state=args.saveState,
+            max_missing=args.maxMissing,
+            newer_query=args.newerQuery,
+            prior_query=args.priorQuery,
+            csv_compression=args.csvCompression,
+            output_formats=args.outputFormats.split(","),
+            metrics_file=args.metricsFile,
+            sample_size=args.sampleSize,
+            sample_rows=args.sampleRows,
+            sample_seed=args.sampleSeed,
+        )
     print(
         f"process completed in {round((time.time() - proc_start_time) / 60, 1)} minutes\n"
     )
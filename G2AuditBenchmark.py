@@ -0,0 +1,792 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import argparse
+import contextlib
+import csv
+import json
+import multiprocessing
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import logging
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+
+import G2Audit
+import G2AuditFiles
+
+DATA_SOURCES = ["CUSTOMERS", "WATCHLIST", "REFERENCE", "VENDORS"]
+RECORD_MATCH_KEYS = ["+NAME+DOB", "+NAME+ADDRESS", "+NAME+PHONE", "+NAME+SSN"]
+RELATION_MATCH_KEYS = ["+NAME", "+ADDRESS", "+PHONE", "+SURNAME+ADDRESS"]
+ENTITY_MAP_HEADERS = [
+    "RESOLVED_ENTITY_ID",
+    "RELATED_ENTITY_ID",
+    "MATCH_LEVEL",
+    "MATCH_KEY",
+    "DATA_SOURCE",
+    "RECORD_ID",
+]
+
+# the audit() options of each audit variant, the database, series, reaudit and
+# engine variants audit the same files another way
+AUDIT_VARIANTS = {
+    "default": {},
+    "compact": {"compact": True},
+    "external": {"external": True},
+    "database": {},
+    "workers": {"workers": 4},
+    "numpy": {"use_numpy": True},
+    "stream_newer": {"stream_newer": True},
+    "cache": {},
+    "series": {},
+    "reaudit": {},
+    "engine": {},
+}
+# the variants the load benchmark can time too
+LOAD_VARIANTS = ("default", "compact", "database")
+# share of the newer entities whose last record the reaudit variant's delta moves
+REAUDIT_MOVE_RATE = 0.005
+
+GENERATOR_DEFAULTS = {
+    "singleton_rate": 0.6,
+    "size_alpha": 1.5,
+    "max_entity_size": 100,
+    "giant_rate": 0.0005,
+    "giant_size": 1000,
+    "split_rate": 0.05,
+    "merge_rate": 0.03,
+    "missing_rate": 0.01,
+    "added_rate": 0.01,
+    "relation_rate": 0.3,
+    "max_relations": 3,
+}
+GENERATOR_HELP = {
+    "singleton_rate": "share of prior entities with a single record",
+    "size_alpha": "pareto shape of the other entity sizes, lower is more skewed",
+    "max_entity_size": "largest entity other than the giant ones",
+    "giant_rate": "share of entities that are giant",
+    "giant_size": "records in a giant entity",
+    "split_rate": "share of records split off into their own newer entity",
+    "merge_rate": "share of entities merged into the one before them in the newer file",
+    "missing_rate": "share of prior records missing from the newer file",
+    "added_rate": "newer only records added per prior record",
+    "relation_rate": "share of entities with related entity rows",
+    "max_relations": "most related entity rows an entity can have",
+}
+
+
+def entity_sizes(rnd, record_count, **kwargs):
+    """yields prior entity sizes adding up to record_count
+
+    Most entities are singletons, the rest follow a pareto distribution capped at
+    max_entity_size and a few are giant entities of giant_size records.
+    """
+    options = {**GENERATOR_DEFAULTS, **kwargs}
+    remaining = record_count
+    while remaining > 0:
+        if rnd.random() < options["giant_rate"]:
+            size = options["giant_size"]
+        elif rnd.random() < options["singleton_rate"]:
+            size = 1
+        else:
+            size = min(
+                1 + int(rnd.paretovariate(options["size_alpha"])),
+                options["max_entity_size"],
+            )
+        size = min(size, remaining)
+        remaining -= size
+        yield size
+
+
+def generate_entity_maps(
+    prior_file_name, newer_file_name, record_count, seed=1, **kwargs
+):
+    """writes a prior and a newer entity map csv file of about record_count records
+
+    The newer file is the prior one with records split off into their own entities,
+    whole entities merged into the one before them, records missing and records
+    added at the given rates.  Related entity rows are added to both files at
+    relation_rate.  Both files are written as they are generated, grouped by entity
+    and in entity id order like a Senzing export, so any size can be generated in
+    constant memory, the split off entities going to a temporary file until the end.
+    Returns the row counts.
+    """
+    options = {**GENERATOR_DEFAULTS, **kwargs}
+    rnd = random.Random(seed)
+    row_counts = {"prior": 0, "newer": 0}
+    with open(prior_file_name, "w", newline="") as prior_handle, open(
+        newer_file_name, "w", newline=""
+    ) as newer_handle, tempfile.TemporaryFile("w+", newline="") as split_handle:
+        prior_writer = csv.writer(prior_handle)
+        newer_writer = csv.writer(newer_handle)
+        split_writer = csv.writer(split_handle)
+        prior_writer.writerow(ENTITY_MAP_HEADERS)
+        newer_writer.writerow(ENTITY_MAP_HEADERS)
+
+        def write_entity(writer, file_type, entity_id, record_keys, last_entity_id):
+            for i, (data_source, record_id) in enumerate(record_keys):
+                writer.writerow(
+                    [
+                        entity_id,
+                        0,
+                        0 if i == 0 else 1,
+                        "" if i == 0 else rnd.choice(RECORD_MATCH_KEYS),
+                        data_source,
+                        record_id,
+                    ]
+                )
+            row_counts[file_type] += len(record_keys)
+            if last_entity_id > 1 and rnd.random() < options["relation_rate"]:
+                for _ in range(rnd.randint(1, options["max_relations"])):
+                    related_entity_id = rnd.randint(1, last_entity_id - 1)
+                    writer.writerow(
+                        [
+                            entity_id,
+                            related_entity_id,
+                            3,
+                            rnd.choice(RELATION_MATCH_KEYS),
+                            "",
+                            "",
+                        ]
+                    )
+                    row_counts[file_type] += 1
+
+        record_seq = 0
+        split_entity_id = 10 * record_count + 1
+        newer_entity_id, newer_records = None, []
+        for entity_seq, size in enumerate(
+            entity_sizes(rnd, record_count, **options), start=1
+        ):
+            prior_records, kept_records = [], []
+            for _ in range(size):
+                record_seq += 1
+                record_key = (
+                    DATA_SOURCES[record_seq % len(DATA_SOURCES)],
+                    str(record_seq),
+                )
+                prior_records.append(record_key)
+                draw = rnd.random()
+                if draw < options["missing_rate"]:
+                    continue
+                if draw < options["missing_rate"] + options["split_rate"]:
+                    write_entity(
+                        split_writer, "newer", split_entity_id, [record_key], entity_seq
+                    )
+                    split_entity_id += 1
+                else:
+                    kept_records.append(record_key)
+                if rnd.random() < options["added_rate"]:
+                    record_seq += 1
+                    kept_records.append(("ADDED", str(record_seq)))
+            write_entity(prior_writer, "prior", entity_seq, prior_records, entity_seq)
+
+            if newer_records and rnd.random() < options["merge_rate"]:
+                newer_records.extend(kept_records)
+                continue
+            if newer_records:
+                write_entity(
+                    newer_writer, "newer", newer_entity_id, newer_records, entity_seq
+                )
+            newer_entity_id, newer_records = entity_seq, kept_records
+        if newer_records:
+            write_entity(
+                newer_writer, "newer", newer_entity_id, newer_records, newer_entity_id
+            )
+        split_handle.seek(0)
+        shutil.copyfileobj(split_handle, newer_handle)
+    return row_counts
+
+
+def write_senzing_database(entity_map_file_name, database_file_name):
+    """copies an entity map csv file into a sqlite stand-in for the Senzing repository
+
+    Only the tables and columns G2Audit.DATABASE_QUERIES read are created, with the
+    data sources numbered in DSRC_ID and their codes in a SYS_CFG configuration.
+    Returns the number of records written.
+    """
+    data_source_ids = {
+        data_source: i for i, data_source in enumerate(DATA_SOURCES + ["ADDED"], 1)
+    }
+    if os.path.exists(database_file_name):
+        os.remove(database_file_name)
+    connection = sqlite3.connect(database_file_name)
+    connection.executescript(
+        """
+        create table OBS_ENT (OBS_ENT_ID integer primary key, DSRC_ID integer, ENT_SRC_KEY text);
+        create table DSRC_RECORD (DSRC_ID integer, RECORD_ID text, ENT_SRC_KEY text);
+        create table RES_ENT_OKEY (RES_ENT_ID integer, OBS_ENT_ID integer, MATCH_KEY text);
+        create table RES_RELATE (RES_REL_ID integer primary key, MIN_RES_ENT_ID integer, MAX_RES_ENT_ID integer, MATCH_KEY text);
+        create table RES_REL_EKEY (RES_ENT_ID integer, RES_REL_ID integer, REL_ENT_ID integer);
+        create table SYS_CFG (CONFIG_DATA_ID integer primary key, CONFIG_DATA text);
+        """
+    )
+    config_data = {
+        "G2_CONFIG": {
+            "CFG_DSRC": [
+                {"DSRC_ID": data_source_id, "DSRC_CODE": data_source}
+                for data_source, data_source_id in data_source_ids.items()
+            ]
+        }
+    }
+    connection.execute(
+        "insert into SYS_CFG values (?, ?)", (1, json.dumps(config_data))
+    )
+    record_count = 0
+    relation_ids = {}
+    with open(entity_map_file_name, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            entity_id = int(row["RESOLVED_ENTITY_ID"])
+            related_entity_id = int(row["RELATED_ENTITY_ID"])
+            if related_entity_id == 0:
+                record_count += 1
+                data_source_id = data_source_ids[row["DATA_SOURCE"]]
+                ent_src_key = f"{row['DATA_SOURCE']}|{row['RECORD_ID']}"
+                connection.execute(
+                    "insert into OBS_ENT values (?, ?, ?)",
+                    (record_count, data_source_id, ent_src_key),
+                )
+                connection.execute(
+                    "insert into DSRC_RECORD values (?, ?, ?)",
+                    (data_source_id, row["RECORD_ID"], ent_src_key),
+                )
+                connection.execute(
+                    "insert into RES_ENT_OKEY values (?, ?, ?)",
+                    (entity_id, record_count, row["MATCH_KEY"]),
+                )
+                continue
+            entity_pair = (
+                min(entity_id, related_entity_id),
+                max(entity_id, related_entity_id),
+            )
+            if entity_pair not in relation_ids:
+                relation_ids[entity_pair] = len(relation_ids) + 1
+                connection.execute(
+                    "insert into RES_RELATE values (?, ?, ?, ?)",
+                    (relation_ids[entity_pair], *entity_pair, row["MATCH_KEY"]),
+                )
+            connection.execute(
+                "insert into RES_REL_EKEY values (?, ?, ?)",
+                (entity_id, relation_ids[entity_pair], related_entity_id),
+            )
+    connection.commit()
+    connection.close()
+    return record_count
+
+
+def database_source(entity_map_file_name):
+    """the sqlite3:// source of an entity map's stand-in database, written if missing"""
+    database_file_name = os.path.splitext(entity_map_file_name)[0] + ".db"
+    if not os.path.exists(database_file_name):
+        logging.info(f"writing {database_file_name} ...")
+        write_senzing_database(entity_map_file_name, database_file_name)
+    return "sqlite3://" + database_file_name
+
+
+def parse_count(count_text):
+    """converts counts like 500K, 10M or 1.5B to an integer"""
+    count_text = str(count_text).strip().upper()
+    multiplier = 1
+    if count_text and count_text[-1] in "KMB":
+        multiplier = 1000 ** ("KMB".index(count_text[-1]) + 1)
+        count_text = count_text[:-1]
+    return int(float(count_text) * multiplier)
+
+
+def format_count(count):
+    for suffix, multiplier in (("B", 10**9), ("M", 10**6), ("K", 10**3)):
+        if count >= multiplier and count % multiplier == 0:
+            return f"{count // multiplier}{suffix}"
+    return str(count)
+
+
+def benchmark_load(newer_file_name, prior_file_name, output_root, variant):
+    start_time = time.time()
+    newer_map = G2Audit.load_from_file(
+        newer_file_name, "newer", compact=variant == "compact"
+    )
+    seconds = time.time() - start_time
+    return {
+        "phases": {"newer_load": seconds},
+        "seconds": seconds,
+        "records_loaded": len(newer_map["records"]),
+        "records_per_second": round(len(newer_map["records"]) / max(seconds, 1e-9)),
+    }
+
+
+def write_reaudit_files(newer_file_name, base_file_name, delta_file_name, seed=1):
+    """writes a base entity map the newer one is a delta away from, for timing reaudit
+
+    The last record of one in REAUDIT_MOVE_RATE newer entities with more than one
+    record is moved to an entity of its own in the base file and the delta moves it
+    back.  Being the last record, reaudit puts it back in its place.  Returns the
+    number of records moved.
+    """
+    rnd = random.Random(seed)
+    moved_count = 0
+    with open(newer_file_name, "r", newline="") as newer_handle, open(
+        base_file_name, "w", newline=""
+    ) as base_handle, open(delta_file_name, "w", newline="") as delta_handle:
+        reader = csv.reader(newer_handle)
+        base_writer = csv.writer(base_handle)
+        delta_writer = csv.writer(delta_handle)
+        base_writer.writerow(next(reader))
+        delta_writer.writerow(
+            ["DATA_SOURCE", "RECORD_ID", "OLD_ENTITY_ID", "NEW_ENTITY_ID", "MATCH_KEY"]
+        )
+        moved_rows = []
+        for entity_id, entity_rows in groupby(reader, key=itemgetter(0)):
+            entity_rows = list(entity_rows)
+            record_rows = [row for row in entity_rows if row[1] == "0"]
+            if len(record_rows) > 1 and rnd.random() < REAUDIT_MOVE_RATE:
+                moved_row = record_rows[-1]
+                entity_rows.remove(moved_row)
+                moved_rows.append(moved_row)
+                base_id = f"MOVED{len(moved_rows)}"
+                delta_writer.writerow(
+                    [moved_row[4], moved_row[5], base_id, entity_id, moved_row[3]]
+                )
+            base_writer.writerows(entity_rows)
+        for moved_count, moved_row in enumerate(moved_rows, 1):
+            base_writer.writerow([f"MOVED{moved_count}", 0, 0, "", *moved_row[4:]])
+    return moved_count
+
+
+def reaudit_files(newer_file_name):
+    """the base entity map and delta of write_reaudit_files(), written if missing"""
+    file_root = os.path.splitext(newer_file_name)[0]
+    base_file_name, delta_file_name = file_root + "_base.csv", file_root + "_delta.csv"
+    if not os.path.exists(base_file_name) or not os.path.exists(delta_file_name):
+        logging.info(f"writing {base_file_name} ...")
+        write_reaudit_files(newer_file_name, base_file_name, delta_file_name)
+    return base_file_name, delta_file_name
+
+
+def write_engine_audit(newer_file_name, prior_file_name, output_root):
+    """audits the files with an AuditEngine and writes its rows and stats like audit()"""
+    engine = G2Audit.AuditEngine()
+    with open(newer_file_name, "r", newline="") as f:
+        engine.add_newer(csv.DictReader(f))
+    with open(prior_file_name, "r", newline="") as f:
+        engine.add_prior(csv.DictReader(f))
+    with open(output_root + ".csv", "w", newline="") as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(G2Audit.AUDIT_CSV_HEADERS)
+        csv_writer.writerows(engine.run())
+    with open(output_root + ".json", "w") as f:
+        json.dump(engine.stats, f)
+
+
+def run_audit_variant(newer_file_name, prior_file_name, output_root, variant):
+    """audits the files the way variant says, writing the output_root files"""
+    if variant == "series":
+        G2Audit.audit_series(
+            [prior_file_name, newer_file_name], output_root + "_series"
+        )
+        for file_extension in (".csv", ".json"):
+            os.replace(
+                output_root + "_series.1-2" + file_extension,
+                output_root + file_extension,
+            )
+        return 0
+    if variant == "reaudit":
+        base_file_name, delta_file_name = reaudit_files(newer_file_name)
+        return G2Audit.audit(
+            base_file_name,
+            prior_file_name,
+            output_root + "_base",
+            False,
+            save_state=True,
+        ) or G2Audit.reaudit(output_root + "_base.state", delta_file_name, output_root)
+    if variant == "engine":
+        write_engine_audit(newer_file_name, prior_file_name, output_root)
+        return 0
+    audit_options = dict(AUDIT_VARIANTS[variant])
+    if variant == "cache":
+        audit_options["cache_dir"] = os.path.join(os.path.dirname(output_root), "cache")
+        # the first audit fills the cache for the timed one
+        G2Audit.audit(
+            newer_file_name, prior_file_name, output_root, False, **audit_options
+        )
+    return G2Audit.audit(
+        newer_file_name, prior_file_name, output_root, False, **audit_options
+    )
+
+
+def benchmark_audit(newer_file_name, prior_file_name, output_root, variant):
+    """runs an audit variant and returns the phase timings from the PERFORMANCE section
+    it writes, or just its time if it writes none"""
+    start_time = time.time()
+    if run_audit_variant(newer_file_name, prior_file_name, output_root, variant):
+        raise Exception(f"the {variant} audit failed")
+    seconds = time.time() - start_time
+    with open(output_root + ".json") as f:
+        performance = json.load(f).get("PERFORMANCE")
+    if performance is None:
+        return {"phases": {}, "seconds": seconds}
+    return {
+        "phases": {
+            phase.lower(): seconds
+            for phase, seconds in performance["PHASE_SECONDS"].items()
+        },
+        "seconds": performance["TOTAL_SECONDS"],
+        "records_per_second": {
+            file_type.lower(): rate
+            for file_type, rate in performance["RECORDS_PER_SECOND"].items()
+        },
+        "largest_entity": {
+            file_type.lower(): largest[0]["RECORD_COUNT"] if largest else 0
+            for file_type, largest in performance["LARGEST_ENTITIES"].items()
+        },
+    }
+
+
+def audit_differences(output_root, default_root, variant):
+    """lists how the .csv and .json files of an audit variant differ from those of the
+    default audit, leaving out the PERFORMANCE sections
+
+    A reaudit keeps the rows it copies where they were and gives the audit results it
+    makes again new audit ids, so its audit results are compared regardless of their
+    order and audit ids, and its samples, picked in that order too, are left out.
+    """
+    differences = []
+    file_rows = []
+    for file_root in (output_root, default_root):
+        with open(file_root + ".csv", "r", newline="") as f:
+            csv_rows = list(csv.reader(f))
+        if variant == "reaudit":
+            audit_results = {}
+            for csv_row in csv_rows[1:]:
+                audit_results.setdefault(csv_row[0], []).append(tuple(csv_row[1:]))
+            csv_rows = Counter(
+                tuple(sorted(audit_rows)) for audit_rows in audit_results.values()
+            )
+        file_rows.append(csv_rows)
+    if file_rows[0] != file_rows[1]:
+        differences.append("audit results")
+
+    stat_packs = []
+    for file_root in (output_root, default_root):
+        with open(file_root + ".json") as f:
+            stat_pack = json.load(f)
+        stat_pack.pop("PERFORMANCE", None)
+        if variant == "reaudit":
+            for audit_category in stat_pack["AUDIT"].values():
+                for sub_category in audit_category["SUB_CATEGORY"].values():
+                    sub_category.pop("SAMPLE")
+        stat_packs.append(stat_pack)
+    for section in sorted(set(stat_packs[0]) | set(stat_packs[1])):
+        if stat_packs[0].get(section) != stat_packs[1].get(section):
+            differences.append(f"{section} statistics")
+    return differences
+
+
+def benchmark_checker(newer_file_name, prior_file_name, output_root, variant):
+    start_time = time.time()
+    G2Audit.stat_checker(newer_file_name, prior_file_name)
+    seconds = time.time() - start_time
+    return {"phases": {}, "seconds": seconds}
+
+
+# the hash samples the coverage benchmark draws and their sample rate
+COVERAGE_SAMPLES = 40
+COVERAGE_RATE = 0.1
+
+
+def benchmark_coverage(newer_file_name, prior_file_name, output_root, variant):
+    """audits COVERAGE_SAMPLES different --sample_rate samples of the files, each keying
+    the record hash differently, and returns how often the confidence intervals of
+    their SAMPLE_ESTIMATES hold the PAIRS statistics of the full audit"""
+    start_time = time.time()
+    G2Audit.audit(newer_file_name, prior_file_name, output_root, False)
+    with open(output_root + ".json") as f:
+        full_pairs = json.load(f)["PAIRS"]
+    covered_counts = {}
+    for sample_number in range(COVERAGE_SAMPLES):
+        G2AuditFiles.SAMPLE_HASH_KEY = str(sample_number).encode()
+        G2Audit.audit(
+            newer_file_name,
+            prior_file_name,
+            output_root + "_sample",
+            False,
+            sample_rate=COVERAGE_RATE,
+        )
+        with open(output_root + "_sample.json") as f:
+            sample_estimates = json.load(f)["SAMPLE_ESTIMATES"]
+        for name, estimate in sample_estimates.items():
+            if isinstance(estimate, dict):
+                covered_counts[name] = covered_counts.get(name, 0) + (
+                    estimate["LOW"] <= full_pairs[name] <= estimate["HIGH"]
+                )
+    return {
+        "phases": {},
+        "seconds": time.time() - start_time,
+        "sample_rate": COVERAGE_RATE,
+        "coverage": {
+            name: covered_count / COVERAGE_SAMPLES
+            for name, covered_count in covered_counts.items()
+        },
+    }
+
+
+def benchmark_database(newer_file_name, prior_file_name, output_root, variant):
+    """loads each file and its sqlite stand-in and lists where the entity maps
+    read_database_rows() gives differ from those of the csv file, so a DSRC_ID that
+    maps to the wrong data source code shows up as records that differ"""
+    phases = {"csv_load": 0.0, "database_load": 0.0}
+    differences = []
+    for file_name in (newer_file_name, prior_file_name):
+        start_time = time.time()
+        csv_map = G2Audit.load_from_file(file_name, "newer")
+        phases["csv_load"] += time.time() - start_time
+        start_time = time.time()
+        database_map = G2Audit.load_from_file(database_source(file_name), "newer")
+        phases["database_load"] += time.time() - start_time
+        for name in ("entities", "records", "relations"):
+            if dict(database_map[name]) != dict(csv_map[name]):
+                differences.append(f"{os.path.basename(file_name)} {name}")
+    return {
+        "phases": phases,
+        "seconds": sum(phases.values()),
+        "differences": differences,
+    }
+
+
+BENCHMARKS = {
+    "load": benchmark_load,
+    "audit": benchmark_audit,
+    "checker": benchmark_checker,
+    "coverage": benchmark_coverage,
+    "database": benchmark_database,
+}
+
+
+def run_benchmark(benchmark_task, result_pipe):
+    """runs one benchmark in a child process so its peak memory is its own"""
+    case, newer_file_name, prior_file_name, output_root, variant = benchmark_task
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = BENCHMARKS[case](
+                newer_file_name, prior_file_name, output_root, variant
+            )
+        result["peak_rss_mb"] = G2Audit.peak_rss_mb()
+    except Exception as err:
+        result = {"error": str(err)}
+    result_pipe.send(result)
+    result_pipe.close()
+
+
+def benchmark_in_child(benchmark_task):
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+    parent_pipe, child_pipe = context.Pipe(duplex=False)
+    process = context.Process(target=run_benchmark, args=(benchmark_task, child_pipe))
+    process.start()
+    child_pipe.close()
+    try:
+        result = parent_pipe.recv()
+    except EOFError:
+        result = {"error": f"benchmark process exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+
+def run_benchmarks(sizes, data_dir, cases, variants, **kwargs):
+    benchmark_results = []
+    for record_count in sizes:
+        size_name = format_count(record_count)
+        prior_file_name = os.path.join(data_dir, f"prior_{size_name}.csv")
+        newer_file_name = os.path.join(data_dir, f"newer_{size_name}.csv")
+        if not os.path.exists(prior_file_name) or not os.path.exists(newer_file_name):
+            logging.info(f"generating {size_name} record entity maps in {data_dir} ...")
+            start_time = time.time()
+            row_counts = generate_entity_maps(
+                prior_file_name, newer_file_name, record_count, **kwargs
+            )
+            logging.info(
+                f"{row_counts['prior']:,} prior and {row_counts['newer']:,} newer rows generated in {time.time() - start_time:.1f} seconds"
+            )
+        for case in cases:
+            case_variants = variants
+            if case in ("checker", "coverage", "database"):
+                case_variants = ["default"]
+            elif case == "audit":
+                # the other audit variants are checked against the default one
+                case_variants = ["default"] + [
+                    variant for variant in variants if variant != "default"
+                ]
+            for variant in case_variants:
+                if case == "load" and variant not in LOAD_VARIANTS:
+                    continue
+                newer_source, prior_source = newer_file_name, prior_file_name
+                if variant == "database":
+                    newer_source = database_source(newer_file_name)
+                    prior_source = database_source(prior_file_name)
+                logging.info(
+                    f"benchmarking {case} ({variant}) on {size_name} records ..."
+                )
+                output_root = os.path.join(data_dir, f"audit_{size_name}_{variant}")
+                result = benchmark_in_child(
+                    (case, newer_source, prior_source, output_root, variant)
+                )
+                if "error" in result:
+                    logging.error(f"{case} ({variant}) failed: {result['error']}")
+                else:
+                    logging.info(
+                        f"{case} ({variant}) took {result['seconds']:.2f} seconds, peak memory {result['peak_rss_mb']} MB"
+                    )
+                if case == "audit" and variant != "default" and "error" not in result:
+                    result["differences"] = audit_differences(
+                        output_root,
+                        os.path.join(data_dir, f"audit_{size_name}_default"),
+                        variant,
+                    )
+                for difference in result.get("differences", []):
+                    logging.error(
+                        f"the stand-in database's {difference} differ from the csv file's"
+                        if case == "database"
+                        else f"the {variant} audit's {difference} differ from the default audit's"
+                    )
+                if "coverage" in result:
+                    logging.info(
+                        f"confidence interval coverage of {COVERAGE_SAMPLES} samples: {result['coverage']}"
+                    )
+                benchmark_results.append(
+                    {
+                        "size": record_count,
+                        "case": case,
+                        "variant": variant,
+                        **result,
+                    }
+                )
+    return benchmark_results
+
+
+if __name__ == "__main__":
+
+    argParser = argparse.ArgumentParser(
+        description="generates synthetic prior and newer entity maps and times G2Audit.py on them"
+    )
+    argParser.add_argument(
+        "-s",
+        "--sizes",
+        dest="sizes",
+        default="1M,10M,50M",
+        help="comma separated record counts to benchmark such as 1M,10M,50M, default=1M,10M,50M",
+    )
+    argParser.add_argument(
+        "-d",
+        "--data_dir",
+        dest="dataDir",
+        default="benchmark_data",
+        help="directory for the generated entity maps, which are reused if they exist, default=benchmark_data",
+    )
+    argParser.add_argument(
+        "-o",
+        "--output_file",
+        dest="outputFile",
+        default="benchmark_results.json",
+        help="the json file to write the results to, default=benchmark_results.json",
+    )
+    argParser.add_argument(
+        "--cases",
+        dest="cases",
+        default="load,audit,checker",
+        help="comma separated benchmarks to run from load, audit, checker, coverage and database, default=load,audit,checker",
+    )
+    argParser.add_argument(
+        "--variants",
+        dest="variants",
+        default="default",
+        help="comma separated audit variants from "
+        + ", ".join(AUDIT_VARIANTS)
+        + " (database audits sqlite stand-ins of the senzing tables and engine an AuditEngine), or all, default=default",
+    )
+    argParser.add_argument(
+        "--generate_only",
+        dest="generateOnly",
+        action="store_true",
+        default=False,
+        help="only generate the entity maps",
+    )
+    argParser.add_argument(
+        "--seed", dest="seed", type=int, default=1, help="random seed, default=1"
+    )
+    for option, default in GENERATOR_DEFAULTS.items():
+        argParser.add_argument(
+            f"--{option}",
+            dest=option,
+            type=type(default),
+            default=default,
+            help=f"{GENERATOR_HELP[option]}, default={default}",
+        )
+    args = argParser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%m/%d %I:%M",
+        level=logging.INFO,
+    )
+
+    sizes = [parse_count(size) for size in args.sizes.split(",")]
+    cases = [case.strip() for case in args.cases.split(",")]
+    variants = [variant.strip() for variant in args.variants.split(",")]
+    for case in cases:
+        if case not in BENCHMARKS:
+            logging.error(
+                f"unknown benchmark {case}, use load, audit, checker, coverage or database"
+            )
+            sys.exit(1)
+    if variants == ["all"]:
+        variants = list(AUDIT_VARIANTS)
+    for variant in variants:
+        if variant not in AUDIT_VARIANTS:
+            logging.error(
+                f"unknown variant {variant}, use {', '.join(AUDIT_VARIANTS)} or all"
+            )
+            sys.exit(1)
+    generator_options = {option: getattr(args, option) for option in GENERATOR_DEFAULTS}
+    os.makedirs(args.dataDir, exist_ok=True)
+
+    if args.generateOnly:
+        for record_count in sizes:
+            size_name = format_count(record_count)
+            row_counts = generate_entity_maps(
+                os.path.join(args.dataDir, f"prior_{size_name}.csv"),
+                os.path.join(args.dataDir, f"newer_{size_name}.csv"),
+                record_count,
+                seed=args.seed,
+                **generator_options,
+            )
+            logging.info(
+                f"{row_counts['prior']:,} prior and {row_counts['newer']:,} newer rows written for {size_name} records"
+            )
+        sys.exit(0)
+
+    results = run_benchmarks(
+        sizes, args.dataDir, cases, variants, seed=args.seed, **generator_options
+    )
+    with open(args.outputFile, "w") as f:
+        json.dump(
+            {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "generator": {"seed": args.seed, **generator_options},
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+    logging.info(f"results written to {args.outputFile}")
+    if any("error" in result or result.get("differences") for result in results):
+        logging.error("some benchmarks failed or found differences")
+        sys.exit(1)
@@ -0,0 +1,365 @@
+"""the helpers the G2Audit.py modules share"""
+
+import os
+import sys
+import contextlib
+import time
+import re
+import heapq
+import pickle
+import logging
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz", "zstd": ".zst"}
+
+
+def detect_column_names(field_names, file_name=""):
+    if "RESOLVED_ENTITY_ID" in field_names:
+        cluster_field, source_field, record_field, score_field = (
+            "RESOLVED_ENTITY_ID",
+            "DATA_SOURCE",
+            "RECORD_ID",
+            "MATCH_KEY",
+        )
+    else:
+        cluster_field = source_field = record_field = score_field = None
+        for field_name in field_names:
+            if field_name.upper() in ("ENTITY_ID", "CLUSTER_ID"):
+                cluster_field = field_name
+            elif field_name.upper() == "DATA_SOURCE":
+                source_field = field_name
+            elif field_name.upper() == "RECORD_ID":
+                record_field = field_name
+            elif field_name.upper() == "SCORE":
+                score_field = field_name
+        if not cluster_field or not source_field or not record_field:
+            raise Exception(
+                f"Expected fields missing for {file_name}, need at least ENTITY_ID, DATA_SOURCE and RECORD_ID"
+            )
+    return cluster_field, source_field, record_field, score_field
+
+
+def detect_column_positions(field_names, file_name=""):
+    """returns the positions of the cluster, source, record, score and related entity columns"""
+    cluster_field, source_field, record_field, score_field = detect_column_names(
+        field_names, file_name
+    )
+    return (
+        field_names.index(cluster_field),
+        field_names.index(source_field),
+        field_names.index(record_field),
+        field_names.index(score_field) if score_field in field_names else None,
+        (
+            field_names.index("RELATED_ENTITY_ID")
+            if "RELATED_ENTITY_ID" in field_names
+            else None
+        ),
+    )
+
+
+def is_database_source(file_name):
+    """True for module://dsn database sources like sqlite3:///path/to/G2C.db"""
+    return "://" in file_name and not os.path.exists(file_name)
+
+
+def display_name(file_name):
+    """the file name or database source with any password in it masked for the log"""
+    if not is_database_source(file_name):
+        return file_name
+    file_name = re.sub(r"(password\s*=\s*)\S+", r"\1***", file_name, flags=re.I)
+    return re.sub(r"(://[^:/@]*:)[^@/]+@", r"\1***@", file_name)
+
+
+def padded_rows(reader, column_positions):
+    """the csv rows of a reader, skipping blank ones and padding short ones out to
+    the last of the column positions"""
+    row_width = max(pos for pos in column_positions if pos is not None) + 1
+    for row in reader:
+        if len(row) < row_width:
+            if not row:
+                continue
+            row += [""] * (row_width - len(row))
+        yield row
+
+
+def parse_entity_rows(reader, column_positions):
+    cluster_pos, source_pos, record_pos, score_pos, related_pos = column_positions
+    for row in padded_rows(reader, column_positions):
+        related_entity_id = row[related_pos] if related_pos is not None else "0"
+        if related_entity_id == "0":
+            record_key = compute_record_key(
+                row, cluster_pos, source_pos, record_pos, score_pos
+            )
+        else:
+            record_key = None
+        yield (
+            row[cluster_pos],
+            record_key,
+            row[score_pos] if score_pos is not None else "",
+            related_entity_id,
+        )
+
+
+def write_pickle(file_name, value):
+    """pickles the value to a temporary file first so a crash while saving it leaves
+    the last one whole"""
+    with open(file_name + ".tmp", "wb") as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(file_name + ".tmp", file_name)
+
+
+def new_performance():
+    return {
+        "PHASE_SECONDS": {},
+        "RECORDS_PER_SECOND": {},
+        "LARGEST_ENTITIES": {},
+    }
+
+
+@contextlib.contextmanager
+def timed_phase(performance, phase):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        performance["PHASE_SECONDS"][phase] = round(time.time() - start_time, 3)
+
+
+class TimedWriter:
+    """a row writer that adds up the time spent handing it rows and closing it"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.seconds = 0.0
+
+    @contextlib.contextmanager
+    def timer(self):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start_time
+
+    def writerow(self, row):
+        with self.timer():
+            self.writer.writerow(row)
+
+    def writerows(self, rows):
+        with self.timer():
+            self.writer.writerows(rows)
+
+    def checkpoint(self):
+        with self.timer():
+            return self.writer.checkpoint()
+
+    def close(self):
+        with self.timer():
+            self.writer.close()
+
+
+def track_largest_entity(largest, entity_seq, entity_id, record_count, count=10):
+    """keeps the count largest entities seen in a heap, ties go to the earlier one"""
+    entity_size = (record_count, -entity_seq, entity_id)
+    if len(largest) < count:
+        heapq.heappush(largest, entity_size)
+    elif entity_size > largest[0]:
+        heapq.heapreplace(largest, entity_size)
+
+
+def peak_rss_mb():
+    """peak resident memory of this process in megabytes, None where it can't be measured"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":  # kilobytes everywhere else
+        max_rss *= 1024
+    return round(max_rss / (1024 * 1024), 1)
+
+
+def pair_count(record_count):
+    return record_count * (record_count - 1) // 2
+
+
+def count_by_key(_dict, _key):
+    if _key:
+        if _key in _dict:
+            _dict[_key] += 1
+        else:
+            _dict[_key] = 1
+    return _dict
+
+
+def list_by_key(_dict, _key, _item):
+    if _key not in _dict:
+        _dict[_key] = [_item]
+    elif _item and _item not in _dict[_key]:
+        _dict[_key].append(_item)
+    return _dict
+
+
+def compute_record_key(record, cluster_field, source_field, record_field, score_field):
+    return f"{record[source_field]}||{record[record_field]}"
+
+
+def parse_record_key(key):
+    return key.split("||")
+
+
+class Progress:
+    """logs how a long step is going at most every interval seconds
+
+    update() is just a count until every check_every calls when it looks at the clock.
+    With a total and a position function, such as the size of a file and how many
+    bytes of it have been read, the log line has the percent done and an eta.
+    """
+
+    interval = 10
+    check_every = 4096
+
+    def __init__(self, desc, total=None, position=None):
+        self.desc = desc
+        self.total = total
+        self.position = position
+        self.count = 0
+        self.next_check = self.check_every
+        self.start_time = self.log_time = time.time()
+
+    def update(self):
+        self.count += 1
+        if self.count >= self.next_check:
+            self.next_check += self.check_every
+            if time.time() - self.log_time >= self.interval:
+                self.log()
+
+    def log(self):
+        self.log_time = time.time()
+        elapsed = self.log_time - self.start_time
+        message = f"{self.count:,} {self.desc}, {self.count / elapsed:,.0f} per second"
+        if self.total:
+            done = (self.position() if self.position else self.count) / self.total
+            if 0 < done < 1:
+                message += f", {done:.0%} done, eta {format_seconds(elapsed * (1 - done) / done)}"
+        logging.info(message)
+
+    def finish(self):
+        elapsed = time.time() - self.start_time
+        logging.info(
+            f"{self.count:,} {self.desc}, complete in {format_seconds(elapsed)}"
+        )
+        return elapsed
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+AUDIT_ARGUMENTS = {
+    "debug": (
+        ["-D", "--debug"],
+        {
+            "dest": "debug",
+            "action": "store_true",
+            "default": False,
+            "help": "print debug statements",
+        },
+    ),
+    "compact": (
+        ["--compact"],
+        {
+            "dest": "compact",
+            "action": "store_true",
+            "default": False,
+            "help": "load the entity maps into compact arrays to use far less memory (but run slower)",
+        },
+    ),
+    "cache_dir": (
+        ["--cache_dir"],
+        {
+            "dest": "cacheDir",
+            "default": None,
+            "help": "directory to cache the parsed entity map files in so later audits can memory map them",
+        },
+    ),
+    "workers": (
+        ["--workers"],
+        {
+            "dest": "workers",
+            "type": int,
+            "default": 1,
+            "help": "number of processes to audit with, default=1",
+        },
+    ),
+    "numpy": (
+        ["--numpy"],
+        {
+            "dest": "useNumpy",
+            "action": "store_true",
+            "default": False,
+            "help": "find the newer entities that are the same as a prior entity with numpy arrays so only the others are compared in python",
+        },
+    ),
+    "one_to_one": (
+        ["--one_to_one"],
+        {
+            "dest": "oneToOne",
+            "action": "store_true",
+            "default": False,
+            "help": "compare each prior entity to at most one newer entity, assigned to maximize the records they share",
+        },
+    ),
+    "data_sources": (
+        ["--data_sources"],
+        {
+            "dest": "dataSources",
+            "default": None,
+            "help": "comma separated data sources to audit, the records of any others are dropped as the files are loaded",
+        },
+    ),
+    "output_formats": (
+        ["--output_formats"],
+        {
+            "dest": "outputFormats",
+            "default": "csv",
+            "help": "comma separated formats to write the audit results in from csv, parquet and sqlite, default=csv",
+        },
+    ),
+    "csv_compression": (
+        ["--csv_compression"],
+        {
+            "dest": "csvCompression",
+            "choices": sorted(COMPRESSION_EXTENSIONS),
+            "default": None,
+            "help": "compress the audit .csv file with gzip, bz2, xz or zstd",
+        },
+    ),
+}
+
+
+def add_audit_arguments(parser, *names):
+    """adds the options G2Audit.py and its commands share to an argument parser"""
+    for name in names:
+        flags, options = AUDIT_ARGUMENTS[name]
+        parser.add_argument(*flags, **options)
+
+
+def configure_logging(debug):
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%m/%d %I:%M",
+        level=logging.DEBUG if debug else logging.INFO,
+    )
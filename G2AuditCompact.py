@@ -0,0 +1,530 @@
+"""the compact entity map layout and the parsed file cache"""
+
+import os
+import argparse
+import json
+import hashlib
+import mmap
+import time
+import tempfile
+import zlib
+from array import array
+from collections.abc import Mapping
+import logging
+
+from G2AuditCommon import add_audit_arguments, configure_logging, parse_record_key
+from G2AuditFiles import read_entity_rows
+
+
+def cache_file_name(file_name, cache_dir, **kwargs):
+    """the cache file for an entity map file is keyed on its path, size and mtime
+
+    A cache of only some of the records is also keyed on the data_sources and
+    sample_rate options they were filtered with.
+    """
+    file_stat = os.stat(file_name)
+    cache_key = (
+        f"{os.path.abspath(file_name)}|{file_stat.st_size}|{file_stat.st_mtime_ns}"
+    )
+    if kwargs.get("data_sources"):
+        cache_key += "|" + ",".join(sorted(kwargs["data_sources"]))
+    if kwargs.get("sample_rate"):
+        cache_key += f"|{kwargs['sample_rate']}"
+    return os.path.join(
+        cache_dir,
+        f"{os.path.basename(file_name)}.{hashlib.blake2b(cache_key.encode(), digest_size=8).hexdigest()}.g2map",
+    )
+
+
+def file_content_hash(file_name, block_size=1024 * 1024):
+    """hashes the whole content of a file, a block at a time"""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def load_from_cache(file_name, file_type, cache_dir, **kwargs):
+    """memory maps the cached CompactEntityMap for a file, building it on a cache miss"""
+    start_time = time.time()
+    cached_file_name = cache_file_name(file_name, cache_dir, **kwargs)
+    content_hash = file_content_hash(file_name)
+    if os.path.exists(cached_file_name):
+        header = CompactEntityMap.read_header(cached_file_name)
+        if header and header.get("content_hash") == content_hash:
+            file_map = CompactEntityMap.load(cached_file_name)
+            logging.info(
+                f"{file_type} map loaded from {cached_file_name} in {time.time() - start_time:.2f} seconds"
+            )
+            return file_map
+        logging.info(f"{cached_file_name} is out of date")
+    file_map = build_cache(file_name, file_type, cache_dir, content_hash, **kwargs)
+    logging.info(
+        f"{file_type} map loaded and cached in {time.time() - start_time:.2f} seconds"
+    )
+    return file_map
+
+
+def build_cache(file_name, file_type, cache_dir, content_hash=None, **kwargs):
+    """loads a file into a CompactEntityMap and saves it to the cache directory
+
+    Relationships are always kept so the same cache serves as a newer or prior file.
+    The data_sources and sample_rate options are those of filter_entity_rows().
+    """
+    logging.info(f"loading {file_name} ...")
+    file_map = CompactEntityMap()
+    for row in read_entity_rows(file_name, file_type, **kwargs):
+        file_map.add_row(*row, keep_relations=True)
+    file_map.finalize()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_file_name = cache_file_name(file_name, cache_dir, **kwargs)
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=cache_dir, suffix=".tmp", delete=False
+    ) as f:
+        temp_file_name = f.name
+    file_map.save(
+        temp_file_name,
+        {
+            "file_name": os.path.abspath(file_name),
+            "content_hash": content_hash or file_content_hash(file_name),
+        },
+    )
+    os.replace(temp_file_name, cached_file_name)
+    logging.info(f"{file_name} cached to {cached_file_name}")
+    return file_map
+
+
+def index_files(file_names, cache_dir):
+    """builds the cache for each entity map file ahead of the audits that use it"""
+    for file_name in file_names:
+        if not os.path.exists(file_name):
+            logging.error(f"{file_name} was not found!")
+            return 1
+        start_time = time.time()
+        try:
+            build_cache(file_name, "index", cache_dir)
+        except Exception as err:
+            logging.error(f"{err} indexing {file_name}")
+            return 1
+        logging.info(f"{file_name} indexed in {time.time() - start_time:.2f} seconds")
+    return 0
+
+
+class PackedStrings:
+    """byte strings packed end to end in one buffer and interned to consecutive
+    integer codes through an open addressing hash table"""
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.offsets = array("q", [0])
+        self.table = array("i", [-1]) * 1024
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, code):
+        return bytes(self.blob[self.offsets[code] : self.offsets[code + 1]])
+
+    def find(self, value):
+        """returns the code of value or -1 if it was never added"""
+        mask = len(self.table) - 1
+        slot = zlib.crc32(value) & mask
+        while True:
+            code = self.table[slot]
+            if code < 0 or self.get_bytes(code) == value:
+                return code
+            slot = (slot + 1) & mask
+
+    def add(self, value):
+        """returns (code, is_new) after interning value"""
+        mask = len(self.table) - 1
+        slot = zlib.crc32(value) & mask
+        while True:
+            code = self.table[slot]
+            if code < 0:
+                break
+            if self.get_bytes(code) == value:
+                return code, False
+            slot = (slot + 1) & mask
+        code = len(self)
+        self.table[slot] = code
+        self.blob += value
+        self.offsets.append(len(self.blob))
+        if (code + 1) * 2 > len(self.table):
+            self.rehash(len(self.table) * 2)
+        return code, True
+
+    def rehash(self, table_size):
+        self.table = array("i", [-1]) * table_size
+        mask = table_size - 1
+        for code in range(len(self)):
+            slot = zlib.crc32(self.get_bytes(code)) & mask
+            while self.table[slot] >= 0:
+                slot = (slot + 1) & mask
+            self.table[slot] = code
+
+
+class CompactEntityMap:
+    """low memory alternative to the dict of dicts file_map built by load_from_file
+
+    Data sources and match keys are interned into small string tables, record keys and
+    entity ids into PackedStrings, and the entity to record relationship is kept in
+    integer arrays (entity offsets into a member array of record codes).  Indexing it
+    with "entities", "records" or "relations" returns read only mappings that behave
+    like the dict layout so audit() can use either one.
+    """
+
+    file_magic = b"G2AUDMAP"
+    file_version = 1
+    array_names = (
+        "rec_entity",
+        "rec_score",
+        "ent_offsets",
+        "ent_members",
+        "ent_scores",
+        "rel_score",
+    )
+
+    def __init__(self):
+        self.header = {"data_sources": [], "strings": [""], "cross_entity_dups": False}
+        self.record_keys = PackedStrings()
+        self.entity_ids = PackedStrings()
+        self.relation_keys = PackedStrings()
+        self.arrays = {name: array("i") for name in CompactEntityMap.array_names}
+        self.arrays["ent_offsets"] = array("q")
+        self._data_source_codes = {}
+        self._loading = {
+            "string_codes": {"": 0},
+            "mem_entity": array("i"),
+            "mem_record": array("i"),
+            "mem_score": array("i"),
+            "dup_records": set(),
+        }
+
+    def __getitem__(self, name):
+        if name == "entities":
+            return CompactEntities(self)
+        if name == "records":
+            return CompactRecords(self)
+        if name == "relations":
+            return CompactRelations(self)
+        raise KeyError(name)
+
+    def intern_string(self, value):
+        string_codes = self._loading["string_codes"]
+        code = string_codes.get(value)
+        if code is None:
+            code = string_codes[value] = len(self.header["strings"])
+            self.header["strings"].append(value)
+        return code
+
+    def encode_record_key(self, record_key, add=False):
+        data_source, record_id = parse_record_key(record_key)
+        data_source_code = self._data_source_codes.get(data_source)
+        if data_source_code is None:
+            if not add:
+                return None
+            data_source_code = self._data_source_codes[data_source] = len(
+                self.header["data_sources"]
+            )
+            self.header["data_sources"].append(data_source)
+        return data_source_code.to_bytes(2, "big") + record_id.encode()
+
+    def decode_record_key(self, record_code):
+        value = self.record_keys.get_bytes(record_code)
+        data_source = self.header["data_sources"][int.from_bytes(value[:2], "big")]
+        return f"{data_source}||{value[2:].decode()}"
+
+    def record_code(self, record_key):
+        value = self.encode_record_key(record_key)
+        return self.record_keys.find(value) if value is not None else -1
+
+    def entity_code(self, entity_id):
+        return self.entity_ids.find(str(entity_id).encode())
+
+    def entity_id(self, entity_code):
+        return self.entity_ids.get_bytes(entity_code).decode()
+
+    def entity_size(self, entity_code):
+        offsets = self.arrays["ent_offsets"]
+        return offsets[entity_code + 1] - offsets[entity_code]
+
+    def add_row(self, entity_id, record_key, score, related_entity_id, **kwargs):
+        entity_code = self.entity_ids.add(entity_id.encode())[0]
+        if record_key is not None:
+            record_code, is_new = self.record_keys.add(
+                self.encode_record_key(record_key, add=True)
+            )
+            score_code = self.intern_string(score)
+            rec_entity, rec_score = self.arrays["rec_entity"], self.arrays["rec_score"]
+            if is_new:
+                rec_entity.append(entity_code)
+                rec_score.append(score_code)
+            else:
+                self._loading["dup_records"].add(record_code)
+                if rec_entity[record_code] != entity_code:
+                    self.header["cross_entity_dups"] = True
+                rec_entity[record_code] = entity_code
+                rec_score[record_code] = score_code
+            self._loading["mem_entity"].append(entity_code)
+            self._loading["mem_record"].append(record_code)
+            self._loading["mem_score"].append(score_code)
+        elif kwargs.get("keep_relations"):
+            rel_key = "|".join(sorted([entity_id, related_entity_id]))
+            if self.relation_keys.add(rel_key.encode())[1]:
+                self.arrays["rel_score"].append(self.intern_string(score))
+
+    def finalize(self):
+        """groups the loaded rows by entity, keeping them in file order"""
+        mem_entity = self._loading["mem_entity"]
+        entity_count = len(self.entity_ids)
+        offsets = array("q", [0]) * (entity_count + 1)
+        for entity_code in mem_entity:
+            offsets[entity_code + 1] += 1
+        for entity_code in range(entity_count):
+            offsets[entity_code + 1] += offsets[entity_code]
+        next_slot = offsets[:-1]
+        members = array("i", [0]) * len(mem_entity)
+        scores = array("i", [0]) * len(mem_entity)
+        for entity_code, record_code, score_code in zip(
+            mem_entity, self._loading["mem_record"], self._loading["mem_score"]
+        ):
+            members[next_slot[entity_code]] = record_code
+            scores[next_slot[entity_code]] = score_code
+            next_slot[entity_code] += 1
+        self.arrays.update(ent_offsets=offsets, ent_members=members, ent_scores=scores)
+        dup_records = self._loading["dup_records"]
+        self._loading = {"string_codes": self._loading["string_codes"]}
+        if dup_records:
+            self.remove_duplicate_members(dup_records)
+
+    def remove_duplicate_members(self, dup_records):
+        """a record listed twice for an entity keeps its first position and last score"""
+        members, scores = array("i"), array("i")
+        offsets = array("q", [0])
+        ent_offsets = self.arrays["ent_offsets"]
+        for entity_code in range(len(self.entity_ids)):
+            positions = {}
+            for i in range(ent_offsets[entity_code], ent_offsets[entity_code + 1]):
+                record_code = self.arrays["ent_members"][i]
+                if record_code in dup_records:
+                    if record_code in positions:
+                        scores[positions[record_code]] = self.arrays["ent_scores"][i]
+                        continue
+                    positions[record_code] = len(members)
+                members.append(record_code)
+                scores.append(self.arrays["ent_scores"][i])
+            offsets.append(len(members))
+        self.arrays.update(ent_offsets=offsets, ent_members=members, ent_scores=scores)
+
+    def member_score(self, entity_code, record_code):
+        """returns the entity's score for the record or None if it is not a member"""
+        strings = self.header["strings"]
+        if self.arrays["rec_entity"][record_code] == entity_code:
+            return strings[self.arrays["rec_score"][record_code]]
+        if self.header["cross_entity_dups"]:
+            ent_offsets = self.arrays["ent_offsets"]
+            for i in range(ent_offsets[entity_code], ent_offsets[entity_code + 1]):
+                if self.arrays["ent_members"][i] == record_code:
+                    return strings[self.arrays["ent_scores"][i]]
+        return None
+
+    def columns(self):
+        """the arrays a CompactEntityMap is made of, by name"""
+        columns = {}
+        for name in ("record_keys", "entity_ids", "relation_keys"):
+            packed_strings = getattr(self, name)
+            columns[f"{name}.blob"] = packed_strings.blob
+            columns[f"{name}.offsets"] = packed_strings.offsets
+            columns[f"{name}.table"] = packed_strings.table
+        for name in CompactEntityMap.array_names:
+            columns[name] = self.arrays[name]
+        return columns
+
+    def save(self, file_name, header):
+        """writes the map in a format load() can memory map, header is extra json to keep"""
+        header = dict(
+            header,
+            version=CompactEntityMap.file_version,
+            columns={},
+            **self.header,
+        )
+        offset = 0
+        for name, column in self.columns().items():
+            typecode = column.typecode if isinstance(column, array) else "B"
+            size = len(column) * (column.itemsize if isinstance(column, array) else 1)
+            header["columns"][name] = [typecode, offset, size]
+            offset += (size + 7) // 8 * 8
+        header_bytes = json.dumps(header).encode()
+        header_bytes += b" " * (-len(header_bytes) % 8)
+        with open(file_name, "wb") as f:
+            f.write(CompactEntityMap.file_magic)
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for name, column in self.columns().items():
+                f.write(column)
+                f.write(b"\0" * (-f.tell() % 8))
+
+    @staticmethod
+    def read_header(file_name):
+        """returns the json header of a saved map, None if it is not one"""
+        with open(file_name, "rb") as f:
+            if f.read(8) != CompactEntityMap.file_magic:
+                return None
+            header_size = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_size))
+        return (
+            header if header.get("version") == CompactEntityMap.file_version else None
+        )
+
+    @staticmethod
+    def load(file_name):
+        """memory maps a saved map, nothing is parsed or copied until it is used"""
+        header = CompactEntityMap.read_header(file_name)
+        with open(file_name, "rb") as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data_start = 16 + int.from_bytes(mapped_file[8:16], "little")
+        file_view = memoryview(mapped_file)
+        file_map = CompactEntityMap()
+        for name in file_map.header:
+            file_map.header[name] = header[name]
+        for name, (typecode, offset, size) in header["columns"].items():
+            column = file_view[data_start + offset : data_start + offset + size]
+            if typecode != "B":
+                column = column.cast(typecode)
+            if "." in name:
+                attribute_name, packed_name = name.split(".")
+                setattr(getattr(file_map, attribute_name), packed_name, column)
+            else:
+                file_map.arrays[name] = column
+        file_map.set_read_only()
+        return file_map
+
+    def set_read_only(self):
+        """drops the loading state of a map read back by load()"""
+        self._data_source_codes = {
+            data_source: i for i, data_source in enumerate(self.header["data_sources"])
+        }
+        self._loading = None
+
+
+class CompactEntities(Mapping):
+    """entity_id -> CompactEntity view of a CompactEntityMap"""
+
+    def __init__(self, file_map):
+        self._map = file_map
+
+    def __len__(self):
+        return len(self._map.entity_ids)
+
+    def __iter__(self):
+        for entity_code in range(len(self._map.entity_ids)):
+            yield self._map.entity_id(entity_code)
+
+    def __getitem__(self, entity_id):
+        entity_code = self._map.entity_code(entity_id)
+        if entity_code < 0:
+            raise KeyError(entity_id)
+        return CompactEntity(self._map, entity_code)
+
+
+class CompactEntity(Mapping):
+    """record_key -> score view of one entity of a CompactEntityMap"""
+
+    def __init__(self, file_map, entity_code):
+        self._map = file_map
+        self._entity_code = entity_code
+
+    def __len__(self):
+        return self._map.entity_size(self._entity_code)
+
+    def __iter__(self):
+        ent_offsets = self._map.arrays["ent_offsets"]
+        for i in range(
+            ent_offsets[self._entity_code], ent_offsets[self._entity_code + 1]
+        ):
+            yield self._map.decode_record_key(self._map.arrays["ent_members"][i])
+
+    def __getitem__(self, record_key):
+        record_code = self._map.record_code(record_key)
+        score = (
+            self._map.member_score(self._entity_code, record_code)
+            if record_code >= 0
+            else None
+        )
+        if score is None:
+            raise KeyError(record_key)
+        return score
+
+    def __contains__(self, record_key):
+        record_code = self._map.record_code(record_key)
+        return (
+            record_code >= 0
+            and self._map.member_score(self._entity_code, record_code) is not None
+        )
+
+
+class CompactRelations(Mapping):
+    """rel_key -> match key view of a CompactEntityMap"""
+
+    def __init__(self, file_map):
+        self._map = file_map
+
+    def __len__(self):
+        return len(self._map.relation_keys)
+
+    def __iter__(self):
+        for rel_code in range(len(self._map.relation_keys)):
+            yield self._map.relation_keys.get_bytes(rel_code).decode()
+
+    def __getitem__(self, rel_key):
+        rel_code = self._map.relation_keys.find(rel_key.encode())
+        if rel_code < 0:
+            raise KeyError(rel_key)
+        return self._map.header["strings"][self._map.arrays["rel_score"][rel_code]]
+
+
+class CompactRecords(Mapping):
+    """record_key -> entity_id view of a CompactEntityMap"""
+
+    def __init__(self, file_map):
+        self._map = file_map
+
+    def __len__(self):
+        return len(self._map.record_keys)
+
+    def __iter__(self):
+        for record_code in range(len(self._map.record_keys)):
+            yield self._map.decode_record_key(record_code)
+
+    def __getitem__(self, record_key):
+        record_code = self._map.record_code(record_key)
+        if record_code < 0:
+            raise KeyError(record_key)
+        return self._map.entity_id(self._map.arrays["rec_entity"][record_code])
+
+
+def index_command(argv):
+    """the index command, parsing entity map files into a cache directory, argv being its arguments"""
+    indexParser = argparse.ArgumentParser(
+        prog="G2Audit.py index",
+        description="parse entity map files into the --cache_dir ahead of time",
+    )
+    indexParser.add_argument(
+        "indexFiles",
+        nargs="+",
+        metavar="entity_map_file",
+        help="the files to index",
+    )
+    indexParser.add_argument(
+        "--cache_dir",
+        dest="cacheDir",
+        required=True,
+        help="the directory to keep the parsed files in",
+    )
+    add_audit_arguments(indexParser, "debug")
+    args = indexParser.parse_args(argv)
+    configure_logging(args.debug)
+    return index_files(args.indexFiles, args.cacheDir)
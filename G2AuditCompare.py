@@ -0,0 +1,836 @@
+"""compares the newer entities to the prior ones and tallies the results"""
+
+from collections.abc import Mapping
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+from G2AuditCommon import count_by_key, list_by_key, pair_count, parse_record_key
+from G2AuditFiles import sample_group_counts
+from G2AuditStats import PairReplicates, ReservoirSampler
+
+
+class AuditRows(list):
+    """collects the csv rows log_audit_result() writes for AuditEngine.run() to yield"""
+
+    writerows = list.extend
+
+
+def find_overlap_components(newer_map, prior_map):
+    """splits the newer entities into connected components of the newer/prior overlap graph
+
+    Two newer entities are connected when they share a prior entity, so each component
+    holds every entity its decisions look at.  Returns the newer entity ids in file
+    order and the components as lists of indexes into it.
+    """
+    logging.info("finding connected entities ...")
+    newer_entity_ids = list(newer_map["entities"])
+    newer_index = {entity_id: i for i, entity_id in enumerate(newer_entity_ids)}
+    parents = list(range(len(newer_entity_ids)))
+
+    def find_root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    prior_anchors = (
+        {}
+    )  # prior entity -> first newer entity seen sharing a record with it
+    prior_records = prior_map["records"]
+    for newer_entity_id, newer_entity in newer_map["entities"].items():
+        i = newer_index[newer_entity_id]
+        for record_key in newer_entity:
+            prior_entity_id = prior_records.get(record_key)
+            if prior_entity_id is None:
+                continue
+            j = prior_anchors.setdefault(prior_entity_id, i)
+            if i != j:
+                root_i, root_j = find_root(i), find_root(j)
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    components = {}
+    for i in range(len(newer_entity_ids)):
+        components.setdefault(find_root(i), []).append(i)
+    return newer_entity_ids, list(components.values())
+
+
+def new_audit_state(sampler=None, sample_rate=None):
+    return {
+        "newer_pair_count": 0,
+        "prior_entities": {},
+        "prior_pair_count": 0,
+        "common_entity_count": 0,
+        "common_pair_count": 0,
+        "missing_prior_record_cnt": 0,
+        "missing_newer_record_cnt": 0,
+        "next_audit_id": 0,
+        "audit_stats": {},
+        "data_sources": {},
+        "match_keys": {},
+        "sampler": sampler or ReservoirSampler(),
+        "sample_rate": sample_rate,
+        # for the confidence intervals of a --sample_rate audit
+        "sample_replicates": PairReplicates() if sample_rate else None,
+    }
+
+
+def data_source_stats(audit_state, data_source):
+    """the pair and entity counters of one data source's records, added when first seen"""
+    stats = audit_state["data_sources"].get(data_source)
+    if stats is None:
+        stats = audit_state["data_sources"][data_source] = {
+            "newer_pair_count": 0,
+            "prior_pair_count": 0,
+            "common_pair_count": 0,
+            "common_entity_count": 0,
+            "audit_stats": {},
+        }
+    return stats
+
+
+def choose_prior_entity(prior_entity_ids, prior_entities):
+    prior_entity_id = "unknown"
+    for entity_id in prior_entity_ids:  # choose the largest matching entity
+        if entity_id in prior_entities:
+            logging.debug(
+                f"prior entity {entity_id} has {prior_entity_ids[entity_id]} of those records, plus {len(prior_entities[entity_id])-prior_entity_ids[entity_id]} more"
+            )
+        else:
+            logging.debug(
+                f"prior entity {entity_id} has {prior_entity_ids[entity_id]} of those records"
+            )
+        if prior_entity_ids[entity_id] > prior_entity_ids.get(prior_entity_id, 0):
+            prior_entity_id = entity_id
+        elif (
+            prior_entity_ids[entity_id] == prior_entity_ids.get(prior_entity_id, 0)
+            and entity_id < prior_entity_id
+        ):
+            prior_entity_id = entity_id
+    if len(prior_entity_ids) > 1:
+        logging.debug(
+            f"prior entity {prior_entity_id} selected as it has the most matching records or is the lowest entity_id!"
+        )
+    return prior_entity_id
+
+
+def compare_newer_entity(
+    newer_entity_id,
+    newer_entity,
+    prior_records,
+    prior_entities,
+    newer_records,
+    **kwargs,
+):
+    """compares one newer entity to the prior entity holding most of its records
+
+    newer_entity maps its record keys to newer scores, prior_records and newer_records
+    map record keys to entity ids and prior_entities maps prior entity ids to their
+    record keys and prior scores.  Returns the audit result that tally_audit_result()
+    and report_audit_result() apply to the audit state, including the counts of its
+    records by data source and by newer match key for the breakdowns of the stats.
+
+    With an overlap_matrix an entity another newer entity matches better is skipped
+    without scanning the prior entity's records.  With an assignment from
+    assign_one_to_one() the newer entity is compared to its assigned prior entity and
+    skipped if it has none.  With a sample_rate the records the newer and prior pairs
+    and the common pairs are counted from are also counted by sample hash range for
+    the PairReplicates of the audit.
+    """
+    logging.debug("-" * 50)
+    logging.debug(f"newer entity {newer_entity_id} has {len(newer_entity)} records")
+    audit_result = {"newer_entity_id": newer_entity_id, "prior_entity_id": None}
+    prior_entity_ids = {}
+    newer_keys_found = {}
+    any_missing = False
+    missing_cnt = 0
+    for newer_key in newer_entity:
+        prior_entity_id = prior_records.get(newer_key, "unknown")
+        if prior_entity_id != "unknown":
+            newer_keys_found[newer_key] = prior_entity_id
+            prior_entity_ids = count_by_key(prior_entity_ids, prior_entity_id)
+        else:
+            missing_cnt += 1
+    audit_result["newer_pair_count"] = (
+        len(newer_keys_found) * (len(newer_keys_found) - 1) / 2
+    )
+    audit_result["missing_prior_record_cnt"] = missing_cnt
+
+    if missing_cnt:
+        logging.debug(f"prior set is missing {missing_cnt} records!")
+        any_missing = True
+        if len(newer_keys_found) == 0:
+            logging.debug(
+                "skipping as prior set does not have any of the newer records!"
+            )
+            return audit_result
+
+    assignment = kwargs.get("assignment")
+    if assignment is not None and newer_entity_id in assignment:
+        prior_entity_id = assignment[newer_entity_id]
+    else:
+        prior_entity_id = choose_prior_entity(prior_entity_ids, prior_entities)
+    audit_result["prior_entity_id"] = prior_entity_id
+
+    same_cnt = new_pos_cnt = 0
+    audit_records = []
+    # data source -> [records in the prior file, those in the selected prior entity]
+    source_counts = {}
+    # newer match key -> [records in the selected prior entity, those in another]
+    match_key_counts = {}
+    for newer_key in newer_entity:
+        data_source, record_id = parse_record_key(newer_key)
+        audit_record = {
+            "data_source": data_source,
+            "record_id": record_id,
+            "record_key": newer_key,
+            "newer_id": newer_entity_id,
+            "newer_score": newer_entity[newer_key],
+            "prior_id": newer_keys_found.get(newer_key, "unknown"),
+            "prior_score": "",
+        }
+        if audit_record["prior_id"] == prior_entity_id:
+            audit_record["audit_result"] = "same"
+            audit_record["prior_score"] = prior_entities[prior_entity_id][newer_key]
+            same_cnt += 1
+        elif audit_record["prior_id"] != "unknown":
+            audit_record["audit_result"] = "new positive"
+            new_pos_cnt += 1
+        else:
+            audit_record["audit_result"] = "missing"
+        audit_records.append(audit_record)
+
+        if audit_record["prior_id"] != "unknown":
+            is_same = audit_record["prior_id"] == prior_entity_id
+            source_count = source_counts.get(data_source)
+            if source_count is None:
+                source_count = source_counts[data_source] = [0, 0]
+            source_count[0] += 1
+            source_count[1] += is_same
+            match_key = audit_record["newer_score"]
+            if match_key:
+                match_key_count = match_key_counts.get(match_key)
+                if match_key_count is None:
+                    match_key_count = match_key_counts[match_key] = [0, 0]
+                match_key_count[0 if is_same else 1] += 1
+    audit_result["data_sources"] = source_counts
+    audit_result["match_keys"] = match_key_counts
+
+    overlap_matrix = kwargs.get("overlap_matrix")
+    prior_entity = prior_entities.get(prior_entity_id, {})
+    sample_rate = kwargs.get("sample_rate")
+    if sample_rate:
+        audit_result["newer_groups"] = sample_group_counts(
+            newer_keys_found, sample_rate
+        )
+        audit_result["prior_groups"] = sample_group_counts(
+            (
+                prior_key
+                for prior_key in prior_entity
+                if prior_key in newer_entity
+                or newer_records.get(prior_key, "unknown") != "unknown"
+            ),
+            sample_rate,
+        )
+        audit_result["common_groups"] = sample_group_counts(
+            (
+                newer_key
+                for newer_key, found_prior_entity_id in newer_keys_found.items()
+                if found_prior_entity_id == prior_entity_id
+            ),
+            sample_rate,
+        )
+    # a prior entity with all its records in this one has no better newer entity
+    if overlap_matrix is not None and same_cnt < len(prior_entity):
+        overlap = overlap_matrix[prior_entity_id]
+        if not is_best_newer_entity(
+            newer_entity_id, overlap, prior_entity_id, assignment
+        ):
+            # the same counts the scan below would have made for the skipped entity
+            missing_cnt = overlap.get("unknown", 0)
+            prior_entity_record_count = len(prior_entity) - missing_cnt
+            audit_result["prior_pair_count"] = (
+                prior_entity_record_count * (prior_entity_record_count - 1) / 2
+            )
+            audit_result["missing_newer_record_cnt"] = missing_cnt
+            audit_result["common_pair_count"] = same_cnt * (same_cnt - 1) / 2
+            audit_result["prior_data_sources"] = overlap_matrix.source_counts(
+                prior_entity_id
+            )
+            audit_result["same"] = False
+            return audit_result
+
+    missing_cnt = 0
+    new_neg_cnt = 0
+    newer_entity_ids = {}
+    # the prior entity's records still in the newer file by data source
+    prior_source_counts = {
+        data_source: source_count[1]
+        for data_source, source_count in source_counts.items()
+        if source_count[1]
+    }
+    for prior_key in prior_entity:
+        newer_entity_id2 = newer_records.get(prior_key, "unknown")
+        if prior_key not in newer_entity:
+            data_source, record_id = parse_record_key(prior_key)
+            audit_record = {
+                "data_source": data_source,
+                "record_id": record_id,
+                "record_key": prior_key,
+                "newer_id": newer_entity_id2,
+                "newer_score": "",  # will be replaced by relationship match_key later
+                "audit_result": (
+                    "new negative" if newer_entity_id2 != "unknown" else "missing"
+                ),
+                "prior_id": prior_entity_id,
+                "prior_score": prior_entity[prior_key],
+            }
+            if audit_record["audit_result"] == "new negative":
+                new_neg_cnt += 1
+                prior_source_counts[data_source] = (
+                    prior_source_counts.get(data_source, 0) + 1
+                )
+            else:
+                missing_cnt += 1
+            audit_records.append(audit_record)
+
+        if newer_entity_id2 != "unknown" and overlap_matrix is None:
+            newer_entity_ids = count_by_key(newer_entity_ids, newer_entity_id2)
+
+    prior_entity_record_count = len(prior_entity) - missing_cnt
+    audit_result["prior_pair_count"] = (
+        prior_entity_record_count * (prior_entity_record_count - 1) / 2
+    )
+    audit_result["missing_newer_record_cnt"] = missing_cnt
+    audit_result["prior_data_sources"] = prior_source_counts
+
+    if missing_cnt:
+        logging.debug(f"newer set is missing {missing_cnt} records!")
+        any_missing = True
+
+    # always get credit for same pairs
+    audit_result["common_pair_count"] = same_cnt * (same_cnt - 1) / 2
+
+    # skip entity reporting if same
+    if new_pos_cnt + new_neg_cnt == 0 and not any_missing:
+        audit_result["same"] = True
+        logging.debug("skipping as result is same!")
+        return audit_result
+    audit_result["same"] = False
+
+    # skip if another newer entity has more matching records in the prior
+    if overlap_matrix is None and not is_best_newer_entity(
+        newer_entity_id, newer_entity_ids, prior_entity_id, assignment
+    ):
+        return audit_result
+
+    logging.debug(
+        f"logging prior entity {prior_entity_id} with {new_pos_cnt} new positives and {new_neg_cnt} new negatives"
+    )
+
+    # log it to the proper categories
+    audit_category = ""
+    if any_missing:
+        audit_category += "+MISSING"
+    if new_neg_cnt:
+        audit_category += "+SPLIT"
+    if new_pos_cnt:
+        audit_category += "+MERGE"
+    if not audit_category:
+        audit_category = "+UNKNOWN"
+    audit_result["audit_category"] = audit_category[1:]
+    audit_result["audit_records"] = audit_records
+    return audit_result
+
+
+def compare_map_entity(newer_entity_id, newer_map, prior_map, **kwargs):
+    """compare_newer_entity() for one of the entities of newer_map"""
+    return compare_newer_entity(
+        newer_entity_id,
+        newer_map["entities"][newer_entity_id],
+        prior_map["records"],
+        prior_map["entities"],
+        newer_map["records"],
+        **kwargs,
+    )
+
+
+def is_best_newer_entity(
+    newer_entity_id, newer_entity_ids, prior_entity_id, assignment=None
+):
+    """False if another newer entity is a better match for the selected prior entity
+
+    newer_entity_ids counts the prior entity's records by the newer entity holding
+    them, any "unknown" count is ignored.  With an assignment the assigned newer
+    entity is the best one.
+    """
+    if assignment is not None:
+        if assignment.get(newer_entity_id) != prior_entity_id:
+            logging.debug(
+                f"skipping as prior entity {prior_entity_id} is assigned to another newer entity!"
+            )
+            return False
+        return True
+    newer_entity_ids = {
+        newer_entity_id2: count
+        for newer_entity_id2, count in newer_entity_ids.items()
+        if newer_entity_id2 != "unknown"
+    }
+    if len(newer_entity_ids) <= 1:
+        return True
+    best_newer_entity_id = newer_entity_id
+    for newer_entity_id2 in newer_entity_ids:
+        if newer_entity_ids[newer_entity_id2] > newer_entity_ids.get(
+            best_newer_entity_id, 0
+        ):
+            best_newer_entity_id = newer_entity_id2
+            logging.debug(
+                f"oops, newer entity id {best_newer_entity_id} has {newer_entity_ids[best_newer_entity_id]} matching records for prior_entity {prior_entity_id}"
+            )
+        elif (
+            newer_entity_ids[newer_entity_id2]
+            == newer_entity_ids.get(best_newer_entity_id, 0)
+            and newer_entity_id2 < newer_entity_id
+        ):
+            best_newer_entity_id = newer_entity_id2
+            logging.debug(
+                f"oops, newer entity id {best_newer_entity_id} has the same number of matching records for prior_entity {prior_entity_id} and is a lower ID!"
+            )
+            break
+    if best_newer_entity_id != newer_entity_id:
+        logging.debug(
+            f"skipping as {best_newer_entity_id} is a better match for the selected prior entity!"
+        )
+        return False
+    return True
+
+
+class OverlapMatrix(Mapping):
+    """the sparse newer x prior matrix of the records entities have in common
+
+    Indexing it with a prior entity id returns its column, which counts the prior
+    entity's records by the newer entity holding them now ("unknown" for the missing
+    ones) in record order so ties are broken as before.  A column is filled in one
+    pass over the prior entity's records the first time it is asked for and kept for
+    the other newer entities that pick the same prior entity, so a prior entity split
+    over many newer entities is no longer rescanned for each of them.
+    """
+
+    def __init__(self, newer_map, prior_map):
+        self.prior_entities = prior_map["entities"]
+        self.newer_records = newer_map["records"]
+        self.columns = {}
+        self.prior_source_counts = {}
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __getitem__(self, prior_entity_id):
+        column = self.columns.get(prior_entity_id)
+        if column is None:
+            column = self.columns[prior_entity_id] = {}
+            for prior_key in self.prior_entities.get(prior_entity_id, {}):
+                newer_entity_id = self.newer_records.get(prior_key, "unknown")
+                column[newer_entity_id] = column.get(newer_entity_id, 0) + 1
+        return column
+
+    def source_counts(self, prior_entity_id):
+        """counts a prior entity's records still in the newer file by data source"""
+        counts = self.prior_source_counts.get(prior_entity_id)
+        if counts is None:
+            counts = self.prior_source_counts[prior_entity_id] = {}
+            for prior_key in self.prior_entities.get(prior_entity_id, {}):
+                if prior_key in self.newer_records:
+                    data_source = parse_record_key(prior_key)[0]
+                    counts[data_source] = counts.get(data_source, 0) + 1
+        return counts
+
+
+def assign_one_to_one(newer_map, prior_map):
+    """pairs newer and prior entities one to one, maximizing the records they share
+
+    Each connected component of the overlap is solved on its own, optimally with
+    scipy's linear_sum_assignment when it is installed and the component is not too
+    big, otherwise greedily from the largest overlaps down.  Returns a newer entity
+    id -> prior entity id dict.
+    """
+    newer_entity_ids, components = find_overlap_components(newer_map, prior_map)
+    logging.info(f"assigning {len(components):,} connected components one to one ...")
+    prior_records = prior_map["records"]
+    assignment = {}
+    for component in components:
+        overlaps = {}
+        for i in component:
+            newer_entity_id = newer_entity_ids[i]
+            overlap = {}
+            for record_key in newer_map["entities"][newer_entity_id]:
+                prior_entity_id = prior_records.get(record_key)
+                if prior_entity_id is not None:
+                    overlap[prior_entity_id] = overlap.get(prior_entity_id, 0) + 1
+            if overlap:
+                overlaps[newer_entity_id] = overlap
+        assignment.update(assign_component(overlaps))
+    return assignment
+
+
+def assign_component(overlaps, max_cells=4000000):
+    """solves the assignment of one component of newer -> prior -> count overlaps"""
+    if len(overlaps) == 1:
+        newer_entity_id, overlap = next(iter(overlaps.items()))
+        return {newer_entity_id: choose_prior_entity(overlap, {})}
+    newer_entity_ids = sorted(overlaps)
+    prior_entity_ids = sorted({p for overlap in overlaps.values() for p in overlap})
+    if (
+        linear_sum_assignment is not None
+        and len(newer_entity_ids) * len(prior_entity_ids) <= max_cells
+    ):
+        prior_index = {p: j for j, p in enumerate(prior_entity_ids)}
+        weights = numpy.zeros((len(newer_entity_ids), len(prior_entity_ids)))
+        for i, newer_entity_id in enumerate(newer_entity_ids):
+            for prior_entity_id, count in overlaps[newer_entity_id].items():
+                weights[i, prior_index[prior_entity_id]] = count
+        rows, columns = linear_sum_assignment(weights, maximize=True)
+        return {
+            newer_entity_ids[i]: prior_entity_ids[j]
+            for i, j in zip(rows, columns)
+            if weights[i, j] > 0
+        }
+    assignment, assigned_prior_ids = {}, set()
+    for count, newer_entity_id, prior_entity_id in sorted(
+        (-count, newer_entity_id, prior_entity_id)
+        for newer_entity_id, overlap in overlaps.items()
+        for prior_entity_id, count in overlap.items()
+    ):
+        if newer_entity_id in assignment or prior_entity_id in assigned_prior_ids:
+            continue
+        assignment[newer_entity_id] = prior_entity_id
+        assigned_prior_ids.add(prior_entity_id)
+    return assignment
+
+
+def array_audit(newer_map, prior_map):
+    """finds the newer entities with exactly the records of a prior entity using numpy
+
+    The record keys of both maps go into arrays and the newer records are joined to
+    the prior ones with a sort and searchsorted.  Counting the (newer entity, prior
+    entity) pairs of the joined records gives each newer entity's best prior entity,
+    the one with the most of its records and then the lowest entity id as in
+    choose_prior_entity(), and a newer entity is the same as it when all of its
+    records are in it and it has no others.  Those need none of the python work of
+    compare_newer_entity(), so this returns the prior entity id of each newer entity
+    in map order (None unless it is the same), their record counts and the data
+    source and match key breakdowns of the same entities for add_same_breakdowns().
+    """
+    prior_entity_ids = []
+    prior_sizes = []
+    prior_codes = {}
+    for prior_entity_id, prior_entity in prior_map["entities"].items():
+        prior_codes[prior_entity_id] = len(prior_entity_ids)
+        prior_entity_ids.append(prior_entity_id)
+        prior_sizes.append(len(prior_entity))
+    prior_sizes = numpy.array(prior_sizes, dtype=numpy.int64)
+    prior_keys = numpy.array(list(prior_map["records"]), dtype=str)
+    prior_record_codes = numpy.fromiter(
+        (prior_codes[entity_id] for entity_id in prior_map["records"].values()),
+        dtype=numpy.int64,
+        count=len(prior_keys),
+    )
+
+    newer_keys, newer_scores, record_counts = [], [], []
+    for newer_entity in newer_map["entities"].values():
+        newer_keys.extend(newer_entity)
+        newer_scores.extend(newer_entity.values())
+        record_counts.append(len(newer_entity))
+    newer_keys = numpy.array(newer_keys, dtype=str)
+    record_counts = numpy.array(record_counts, dtype=numpy.int64)
+    newer_codes = numpy.repeat(numpy.arange(len(record_counts)), record_counts)
+
+    joined_codes = numpy.full(len(newer_keys), -1, dtype=numpy.int64)
+    if len(prior_keys) and len(newer_keys):
+        order = numpy.argsort(prior_keys, kind="stable")
+        sorted_keys = prior_keys[order]
+        positions = numpy.searchsorted(sorted_keys, newer_keys)
+        positions[positions == len(sorted_keys)] = 0
+        found = sorted_keys[positions] == newer_keys
+        joined_codes[found] = prior_record_codes[order[positions[found]]]
+
+    found = joined_codes >= 0
+    cells, cell_counts = numpy.unique(
+        newer_codes[found] * len(prior_sizes) + joined_codes[found],
+        return_counts=True,
+    )
+    cell_newer, cell_prior = numpy.divmod(cells, max(len(prior_sizes), 1))
+    prior_ranks = numpy.empty(len(prior_entity_ids), dtype=numpy.int64)
+    prior_ranks[numpy.argsort(numpy.array(prior_entity_ids, dtype=str))] = numpy.arange(
+        len(prior_entity_ids)
+    )
+    best = numpy.lexsort((prior_ranks[cell_prior], -cell_counts, cell_newer))
+    best = best[numpy.diff(cell_newer[best], prepend=-1) != 0]
+    best_newer, best_prior = cell_newer[best], cell_prior[best]
+    same = (cell_counts[best] == record_counts[best_newer]) & (
+        prior_sizes[best_prior] == record_counts[best_newer]
+    )
+    if len(newer_map["records"]) != len(newer_keys):
+        # a record in more than one newer entity makes the prior entity shared
+        _, key_codes, key_counts = numpy.unique(
+            newer_keys, return_inverse=True, return_counts=True
+        )
+        shared_entities = numpy.unique(newer_codes[key_counts[key_codes] > 1])
+        same &= ~numpy.isin(best_newer, shared_entities)
+    same_priors = [None] * len(record_counts)
+    for newer_code, prior_code in zip(
+        best_newer[same].tolist(), best_prior[same].tolist()
+    ):
+        same_priors[newer_code] = prior_entity_ids[prior_code]
+
+    is_same_record = numpy.zeros(len(record_counts), dtype=bool)
+    is_same_record[best_newer[same]] = True
+    is_same_record = is_same_record[newer_codes]
+    data_sources = {}
+    if is_same_record.any():
+        record_sources = numpy.char.partition(newer_keys[is_same_record], "||")[:, 0]
+        source_names, source_codes = numpy.unique(record_sources, return_inverse=True)
+        source_cells, source_cell_counts = numpy.unique(
+            newer_codes[is_same_record] * len(source_names) + source_codes,
+            return_counts=True,
+        )
+        cell_sources = source_cells % len(source_names)
+        source_pair_counts = numpy.bincount(
+            cell_sources,
+            weights=source_cell_counts * (source_cell_counts - 1) // 2,
+            minlength=len(source_names),
+        )
+        source_entity_counts = numpy.bincount(cell_sources, minlength=len(source_names))
+        for data_source, source_pair_count, source_entity_count in zip(
+            source_names.tolist(),
+            source_pair_counts.tolist(),
+            source_entity_counts.tolist(),
+        ):
+            data_sources[data_source] = [int(source_pair_count), source_entity_count]
+    same_scores = numpy.array(newer_scores, dtype=str)[is_same_record]
+    match_keys = dict(
+        zip(
+            *(
+                values.tolist()
+                for values in numpy.unique(
+                    same_scores[same_scores != ""], return_counts=True
+                )
+            )
+        )
+    )
+    return {
+        "same_priors": same_priors,
+        "record_counts": record_counts.tolist(),
+        "data_sources": data_sources,
+        "match_keys": match_keys,
+    }
+
+
+def add_same_breakdowns(audit_state, array_result):
+    """adds what the same entities of array_audit() add to the data source and match
+    key breakdowns, all at once rather than entity by entity"""
+    for data_source, (entity_pair_count, entity_count) in array_result[
+        "data_sources"
+    ].items():
+        stats = data_source_stats(audit_state, data_source)
+        stats["newer_pair_count"] += entity_pair_count
+        stats["prior_pair_count"] += entity_pair_count
+        stats["common_pair_count"] += entity_pair_count
+        stats["common_entity_count"] += entity_count
+    for match_key, same_count in array_result["match_keys"].items():
+        audit_state["match_keys"].setdefault(match_key, [0, 0])[0] += same_count
+
+
+def tally_same_entity(audit_state, prior_entity_id, newer_entity):
+    """tally_audit_result() of a newer entity array_audit() found to be the same as
+    its prior entity, less the breakdowns add_same_breakdowns() has added"""
+    entity_pair_count = len(newer_entity) * (len(newer_entity) - 1) / 2
+    audit_state["newer_pair_count"] += entity_pair_count
+    audit_state["prior_entities"][prior_entity_id] = True
+    audit_state["prior_pair_count"] += entity_pair_count
+    audit_state["common_pair_count"] += entity_pair_count
+    if audit_state["sample_replicates"] is not None:
+        group_counts = sample_group_counts(newer_entity, audit_state["sample_rate"])
+        for column in range(3):
+            audit_state["sample_replicates"].add(column, group_counts)
+    audit_state["common_entity_count"] += 1
+
+
+def add_match_key_counts(audit_state, match_keys):
+    """adds [same, new positive] record counts by match key to the audit state's"""
+    for match_key, (same_count, new_positive_count) in match_keys.items():
+        match_key_count = audit_state["match_keys"].setdefault(match_key, [0, 0])
+        match_key_count[0] += same_count
+        match_key_count[1] += new_positive_count
+
+
+def tally_audit_result(audit_state, audit_result, first_prior_result=None):
+    """adds an audit result to the counters, returns True if it needs to be reported
+
+    A prior entity's pairs are counted with the first audit result compared to it,
+    first_prior_result tells whether this is it when the caller keeps track of that.
+    """
+    audit_state["newer_pair_count"] += audit_result["newer_pair_count"]
+    audit_state["missing_prior_record_cnt"] += audit_result["missing_prior_record_cnt"]
+    prior_entity_id = audit_result["prior_entity_id"]
+    if prior_entity_id is None:
+        return False
+
+    if first_prior_result is None:
+        first_prior_result = prior_entity_id not in audit_state["prior_entities"]
+        audit_state["prior_entities"][prior_entity_id] = True
+    prior_pair_count = 0
+    if first_prior_result:
+        prior_pair_count = audit_result["prior_pair_count"]
+        audit_state["prior_pair_count"] += prior_pair_count
+        for data_source, record_count in audit_result["prior_data_sources"].items():
+            stats = data_source_stats(audit_state, data_source)
+            stats["prior_pair_count"] += pair_count(record_count)
+    audit_state["missing_newer_record_cnt"] += audit_result["missing_newer_record_cnt"]
+    audit_state["common_pair_count"] += audit_result["common_pair_count"]
+
+    for data_source, (record_count, same_count) in audit_result["data_sources"].items():
+        stats = data_source_stats(audit_state, data_source)
+        stats["newer_pair_count"] += pair_count(record_count)
+        stats["common_pair_count"] += pair_count(same_count)
+        if audit_result["same"]:
+            stats["common_entity_count"] += 1
+    add_match_key_counts(audit_state, audit_result["match_keys"])
+    if audit_state["sample_replicates"] is not None:
+        sample_replicates = audit_state["sample_replicates"]
+        sample_replicates.add(0, audit_result["newer_groups"])
+        if first_prior_result:
+            sample_replicates.add(1, audit_result["prior_groups"])
+        sample_replicates.add(2, audit_result["common_groups"])
+
+    if audit_result["same"]:
+        audit_state["common_entity_count"] += 1
+        return False
+    return "audit_category" in audit_result
+
+
+def relation_keys_needed(audit_result):
+    """returns the relationship keys report_audit_result() will look up"""
+    return {
+        "|".join(sorted([audit_result["newer_entity_id"], audit_record["newer_id"]]))
+        for audit_record in audit_result["audit_records"]
+        if audit_record["audit_result"] == "new negative"
+    }
+
+
+def report_audit_result(audit_state, audit_result, relations, csv_writer):
+    """assigns the next audit_id to a split or merge and logs it to the csv and audit stats"""
+    score_audit_result(audit_result, relations)
+    log_audit_result(audit_state, audit_result, csv_writer)
+
+
+def score_audit_result(audit_result, relations):
+    """fills in the newer scores shown for each record and picks the sub category"""
+    newer_entity_id = audit_result["newer_entity_id"]
+    audit_records = audit_result["audit_records"]
+
+    newer_match_keys = {}
+    for audit_record in audit_records:
+        newer_match_keys = list_by_key(
+            newer_match_keys, audit_record["newer_id"], audit_record["newer_score"]
+        )
+
+    score_counts = {}
+    for audit_record in audit_records:
+        if audit_record["audit_result"] == "same":
+            audit_record["prior_score"] = ""
+            audit_record["newer_score"] = ""
+        elif audit_record["audit_result"] == "new negative":  # use relationship score
+            rel_key = "|".join(sorted([newer_entity_id, audit_record["newer_id"]]))
+            if rel_key in relations:
+                audit_record["newer_score"] = "related on: " + relations.get(
+                    rel_key, "unspecified"
+                )
+            else:
+                audit_record["newer_score"] = "not related"
+        elif (
+            audit_record["audit_result"] == "new positive"
+            and not audit_record["newer_score"]
+        ):
+            if len(newer_match_keys.get(audit_record["newer_id"], [])) == 1:
+                audit_record["newer_score"] = newer_match_keys[
+                    audit_record["newer_id"]
+                ][0]
+            else:
+                audit_record["newer_score"] = "multiple"
+        score_counts = count_by_key(score_counts, audit_record["newer_score"])
+
+    if len(score_counts) == 0:
+        best_score = "none"
+    elif len(score_counts) == 1:
+        best_score = list(score_counts.keys())[0]
+    else:
+        best_score = "multiple"
+    audit_result["best_score"] = best_score
+
+
+def log_audit_result(audit_state, audit_result, csv_writer):
+    """assigns the next audit_id to a scored audit result and logs it to the csv and audit stats"""
+    audit_category = audit_result["audit_category"]
+    best_score = audit_result["best_score"]
+    audit_stats = audit_state["audit_stats"]
+
+    if audit_category not in audit_stats:
+        audit_stats[audit_category] = {}
+        audit_stats[audit_category]["COUNT"] = 0
+        audit_stats[audit_category]["SUB_CATEGORY"] = {}
+    audit_stats[audit_category]["COUNT"] += 1
+    for data_source in {
+        audit_record["data_source"] for audit_record in audit_result["audit_records"]
+    }:
+        source_audit_stats = data_source_stats(audit_state, data_source)["audit_stats"]
+        source_audit_stats[audit_category] = (
+            source_audit_stats.get(audit_category, 0) + 1
+        )
+    audit_state["next_audit_id"] += 1
+    next_audit_id = audit_state["next_audit_id"]
+
+    csv_rows = []
+    for audit_record in audit_result["audit_records"]:
+        csv_rows.append(
+            [
+                next_audit_id,
+                audit_category,
+                audit_record["audit_result"],
+                audit_record["data_source"],
+                audit_record["record_id"],
+                audit_record["prior_id"],
+                audit_record["prior_score"],
+                audit_record["newer_id"],
+                audit_record["newer_score"],
+            ]
+        )
+        logging.debug(csv_rows[-1])
+
+    csv_writer.writerows(csv_rows)
+
+    logging.debug(f"{audit_category} sub category assigned is {best_score}")
+
+    if best_score not in audit_stats[audit_category]["SUB_CATEGORY"]:
+        audit_stats[audit_category]["SUB_CATEGORY"][best_score] = {}
+        audit_stats[audit_category]["SUB_CATEGORY"][best_score]["COUNT"] = 0
+        audit_stats[audit_category]["SUB_CATEGORY"][best_score]["SAMPLE"] = []
+    audit_stats[audit_category]["SUB_CATEGORY"][best_score]["COUNT"] += 1
+    # the samples keep the csv rows, iter_json() writes them out as dicts
+    audit_state["sampler"].add(
+        audit_stats[audit_category]["SUB_CATEGORY"][best_score]["SAMPLE"],
+        audit_stats[audit_category]["SUB_CATEGORY"][best_score]["COUNT"],
+        csv_rows,
+    )
@@ -0,0 +1,183 @@
+"""reads entity maps straight from the tables of a Senzing database"""
+
+import os
+import contextlib
+import json
+import importlib
+import queue
+import threading
+
+from G2AuditCommon import (
+    detect_column_positions,
+    display_name,
+    parse_entity_rows,
+    Progress,
+)
+
+
+# the Senzing repository tables, read_database_rows() maps the DSRC_IDs to their codes
+SENZING_RECORD_QUERY = """
+select
+  RES_ENT_OKEY.RES_ENT_ID as RESOLVED_ENTITY_ID,
+  0 as RELATED_ENTITY_ID,
+  OBS_ENT.DSRC_ID as DATA_SOURCE,
+  DSRC_RECORD.RECORD_ID,
+  RES_ENT_OKEY.MATCH_KEY
+from RES_ENT_OKEY
+join OBS_ENT on OBS_ENT.OBS_ENT_ID = RES_ENT_OKEY.OBS_ENT_ID
+join DSRC_RECORD on DSRC_RECORD.DSRC_ID = OBS_ENT.DSRC_ID
+  and DSRC_RECORD.ENT_SRC_KEY = OBS_ENT.ENT_SRC_KEY
+"""
+SENZING_RELATION_QUERY = """
+select
+  RES_REL_EKEY.RES_ENT_ID,
+  RES_REL_EKEY.REL_ENT_ID,
+  null,
+  null,
+  RES_RELATE.MATCH_KEY
+from RES_REL_EKEY
+join RES_RELATE on RES_RELATE.RES_REL_ID = RES_REL_EKEY.RES_REL_ID
+"""
+DATABASE_QUERIES = {
+    "newer": f"{SENZING_RECORD_QUERY} union all {SENZING_RELATION_QUERY} order by 1, 2",
+    "prior": f"{SENZING_RECORD_QUERY} order by 1",  # relationships aren't needed
+}
+SENZING_CONFIG_QUERY = "select CONFIG_DATA from SYS_CFG"
+
+
+def connect_database(source):
+    """opens a DB-API connection for a module://dsn source, module being the driver"""
+    module_name, dsn = source.split("://", 1)
+    return importlib.import_module(module_name).connect(dsn)
+
+
+def read_data_source_codes(source):
+    """maps the DSRC_IDs of a Senzing repository to their data source codes, taken
+    from the configurations in its SYS_CFG table"""
+    with contextlib.closing(connect_database(source)) as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(SENZING_CONFIG_QUERY)
+            config_rows = cursor.fetchall()
+        except Exception as err:
+            raise Exception(
+                f"{err} reading the data source codes from the SYS_CFG table of {display_name(source)}"
+            ) from err
+    data_source_codes = {}
+    for (config_data,) in config_rows:
+        if hasattr(config_data, "read"):  # an oracle LOB
+            config_data = config_data.read()
+        if not isinstance(config_data, dict):
+            config_data = json.loads(config_data)
+        for data_source in config_data["G2_CONFIG"]["CFG_DSRC"]:
+            data_source_codes[str(data_source["DSRC_ID"])] = data_source["DSRC_CODE"]
+    if not data_source_codes:
+        raise Exception(
+            f"there are no data source codes in the SYS_CFG table of {display_name(source)}"
+        )
+    return data_source_codes
+
+
+def read_database_rows(source, file_type, query=None):
+    """yields the entity rows of a query on a database source, like read_entity_rows()
+
+    The query is the built in one for the Senzing repository tables unless another
+    query, or the name of a file containing one, is given.  Its columns are detected
+    like a csv file's and the rows are best ordered by entity.  The built in query
+    reads the DSRC_ID of each record, which is swapped for its data source code so
+    the record keys are the same as those of a file exported from the repository.
+    """
+    if query and os.path.exists(query):
+        with open(query, "r") as f:
+            query = f.read()
+    data_source_codes = None if query else read_data_source_codes(source)
+    database_reader = DatabaseReader(source, query or DATABASE_QUERIES[file_type])
+    with contextlib.closing(database_reader):
+        batches = iter(database_reader)
+        column_positions = detect_column_positions(
+            next(batches, []), display_name(source)
+        )
+        progress = Progress(f"{file_type} rows loaded")
+        for rows in batches:
+            text_rows = [
+                ["" if value is None else str(value) for value in row] for row in rows
+            ]
+            if data_source_codes:
+                source_pos = column_positions[1]
+                for text_row in text_rows:
+                    if text_row[source_pos]:
+                        data_source = data_source_codes.get(text_row[source_pos])
+                        if data_source is None:
+                            raise Exception(
+                                f"DSRC_ID {text_row[source_pos]} of {display_name(source)} isn't in its SYS_CFG table"
+                            )
+                        text_row[source_pos] = data_source
+            for entity_row in parse_entity_rows(text_rows, column_positions):
+                progress.update()
+                yield entity_row
+        progress.finish()
+
+
+class DatabaseReader:
+    """runs a query on its own connection in a background thread
+
+    The rows are fetched batch_size at a time, with a server side cursor for
+    psycopg, and handed over through a bounded queue so the next batch is fetched
+    while the last one is parsed.  Iterating yields the upper cased column names and
+    then the batches, raising any error of the background thread at the end.
+    """
+
+    batch_size = 10000
+    queue_size = 4
+
+    def __init__(self, source, query):
+        self.source = source
+        self.query = query
+        self.batches = queue.Queue(self.queue_size)
+        self.stopping = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.fetch, daemon=True)
+        self.thread.start()
+
+    def fetch(self):
+        try:
+            connection = connect_database(self.source)
+            try:
+                if self.source.startswith("psycopg"):
+                    cursor = connection.cursor("g2audit")
+                else:
+                    cursor = connection.cursor()
+                cursor.arraysize = self.batch_size
+                cursor.execute(self.query)
+                self.put_batch([column[0].upper() for column in cursor.description])
+                while not self.stopping.is_set():
+                    rows = cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+                    self.put_batch(rows)
+            finally:
+                connection.close()
+        except Exception as err:
+            self.error = err
+        self.put_batch(None)
+
+    def put_batch(self, batch):
+        while not self.stopping.is_set():
+            try:
+                self.batches.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            yield batch
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
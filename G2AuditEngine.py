@@ -0,0 +1,468 @@
+"""the audit loops over the loaded maps, in one process or several"""
+
+import os
+import time
+import heapq
+import multiprocessing
+import pickle
+import tempfile
+from itertools import islice
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from G2AuditCommon import display_name, Progress, timed_phase, TimedWriter, write_pickle
+from G2AuditFiles import filter_entity_rows, parse_record_dicts
+from G2AuditCompact import CompactEntityMap, file_content_hash
+from G2AuditMaps import add_entity_rows, largest_entities, RelationIndex
+from G2AuditSinks import AUDIT_CSV_HEADERS, close_audit_writer, open_audit_writer
+from G2AuditStats import compute_stat_pack, ReservoirSampler
+from G2AuditCompare import (
+    add_match_key_counts,
+    add_same_breakdowns,
+    array_audit,
+    assign_one_to_one,
+    AuditRows,
+    compare_map_entity,
+    data_source_stats,
+    find_overlap_components,
+    log_audit_result,
+    new_audit_state,
+    OverlapMatrix,
+    report_audit_result,
+    score_audit_result,
+    tally_audit_result,
+    tally_same_entity,
+)
+from G2AuditExternal import ExternalSorter
+from G2AuditReaudit import finish_audit
+
+
+def audit_maps(newer_map, prior_map, output_root, performance, **kwargs):
+    """audits two loaded maps into the output files of output_root and returns the
+    stat pack, or None if the output couldn't be written
+
+    The options are those of audit(), plus the checkpoint_key and resumed checkpoint
+    of audit_entities() and quiet to not print the main statistics.
+    """
+    workers = kwargs.get("workers") or 1
+    resumed = kwargs.get("resumed")
+    try:
+        csv_writer = TimedWriter(
+            open_audit_writer(
+                output_root,
+                csv_offset=resumed["output_offsets"][0] if resumed else None,
+                **kwargs,
+            )
+        )
+    except Exception as err:
+        logging.error(f"{err} opening the audit output files")
+        return None
+
+    sampler = ReservoirSampler(
+        kwargs.get("sample_size"), kwargs.get("sample_rows"), kwargs.get("sample_seed")
+    )
+    if kwargs.get("use_numpy") and numpy is None:
+        logging.warning("--numpy needs numpy, pip install numpy, auditing without it")
+        kwargs["use_numpy"] = False
+    assignment = None
+    if kwargs.get("one_to_one"):
+        with timed_phase(performance, "ASSIGNMENT"):
+            assignment = assign_one_to_one(newer_map, prior_map)
+    with timed_phase(performance, "AUDIT_LOOP"):
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            audit_state = parallel_audit_entities(
+                newer_map,
+                prior_map,
+                csv_writer,
+                workers,
+                temp_dir=kwargs.get("temp_dir"),
+                sampler=sampler,
+                assignment=assignment,
+                sample_rate=kwargs.get("sample_rate"),
+            )
+        else:
+            if workers > 1:
+                logging.warning(
+                    "--workers needs the fork start method, running serially"
+                )
+            audit_state = audit_entities(
+                newer_map,
+                prior_map,
+                csv_writer,
+                sampler=sampler,
+                assignment=assignment,
+                sample_rate=kwargs.get("sample_rate"),
+                use_numpy=kwargs.get("use_numpy") and assignment is None,
+                checkpoint_every=kwargs.get("checkpoint_every"),
+                checkpoint_file=output_root + ".checkpoint",
+                checkpoint_key=kwargs.get("checkpoint_key"),
+                resumed=resumed,
+            )
+        if not close_audit_writer(csv_writer):
+            return None
+    performance["PHASE_SECONDS"]["AUDIT_LOOP"] = round(
+        performance["PHASE_SECONDS"]["AUDIT_LOOP"] - csv_writer.seconds, 3
+    )
+    performance["PHASE_SECONDS"]["OUTPUT_WRITE"] = round(csv_writer.seconds, 3)
+
+    for file_type, file_map in (("NEWER", newer_map), ("PRIOR", prior_map)):
+        load_seconds = performance["PHASE_SECONDS"].get(f"{file_type}_LOAD")
+        if load_seconds:
+            performance["RECORDS_PER_SECOND"][file_type] = round(
+                len(file_map["records"]) / load_seconds
+            )
+        performance["LARGEST_ENTITIES"][file_type] = largest_entities(file_map)
+    if performance["PHASE_SECONDS"]["AUDIT_LOOP"]:
+        performance["ENTITIES_AUDITED_PER_SECOND"] = round(
+            (len(newer_map["entities"]) - (resumed["cursor"] if resumed else 0))
+            / performance["PHASE_SECONDS"]["AUDIT_LOOP"]
+        )
+    return finish_audit(
+        output_root, newer_map, prior_map, audit_state, performance, **kwargs
+    )
+
+
+def audit_entities(newer_map, prior_map, csv_writer, **kwargs):
+    """audits each newer entity in file order, the sampler, assignment and sample_rate
+    options are those of parallel_audit_entities()
+
+    Every checkpoint_every newer entities the audit state is saved to checkpoint_file
+    along with the checkpoint_key it was made for, and a resumed checkpoint carries
+    on with the newer entity after the last one it had audited.  With use_numpy the
+    newer entities array_audit() finds the same as a prior entity are only counted.
+    """
+    resumed = kwargs.get("resumed")
+    if resumed:
+        audit_state, start = resumed["audit_state"], resumed["cursor"]
+    else:
+        audit_state = new_audit_state(kwargs.get("sampler"), kwargs.get("sample_rate"))
+        start = 0
+    overlap_matrix = OverlapMatrix(newer_map, prior_map)
+    array_result = None
+    if kwargs.get("use_numpy"):
+        logging.info("finding the same entities with numpy ...")
+        array_result = array_audit(newer_map, prior_map)
+        if not resumed:  # a checkpoint has them already
+            add_same_breakdowns(audit_state, array_result)
+    checkpoint_every = kwargs.get("checkpoint_every")
+
+    logging.info("auditing newer entities ...")
+    progress = Progress(
+        "newer entities audited", total=len(newer_map["entities"]) - start
+    )
+    for cursor, newer_entity_id in enumerate(
+        islice(newer_map["entities"], start, None), start + 1
+    ):
+        progress.update()
+        if array_result and array_result["same_priors"][cursor - 1] is not None:
+            tally_same_entity(
+                audit_state,
+                array_result["same_priors"][cursor - 1],
+                newer_map["entities"][newer_entity_id],
+            )
+        else:
+            audit_result = compare_map_entity(
+                newer_entity_id,
+                newer_map,
+                prior_map,
+                overlap_matrix=overlap_matrix,
+                assignment=kwargs.get("assignment"),
+                sample_rate=kwargs.get("sample_rate"),
+            )
+            if tally_audit_result(audit_state, audit_result):
+                report_audit_result(
+                    audit_state, audit_result, newer_map["relations"], csv_writer
+                )
+        if checkpoint_every and cursor % checkpoint_every == 0:
+            save_checkpoint(
+                kwargs["checkpoint_file"],
+                {
+                    "key": kwargs.get("checkpoint_key"),
+                    "cursor": cursor,
+                    "audit_state": audit_state,
+                    "output_offsets": csv_writer.checkpoint(),
+                },
+            )
+
+        # if debug:
+        #    input('press any key to continue')
+    progress.finish()
+    return audit_state
+
+
+CHECKPOINT_OPTIONS = (
+    "newer_query",
+    "prior_query",
+    "one_to_one",
+    "data_sources",
+    "sample_rate",
+    "sample_size",
+    "sample_rows",
+    "sample_seed",
+)
+
+
+def audit_checkpoint_key(file_name1, file_name2, **kwargs):
+    """what a checkpoint has to match to be resumed, the content hashes of the files
+    (or the names of the databases) and the options that change the results"""
+    return {
+        "files": [
+            (
+                file_content_hash(file_name)
+                if os.path.isfile(file_name)
+                else display_name(file_name)
+            )
+            for file_name in (file_name1, file_name2)
+        ],
+        "options": {option: kwargs.get(option) for option in CHECKPOINT_OPTIONS},
+    }
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    start_time = time.time()
+    write_pickle(checkpoint_file, checkpoint)
+    logging.info(
+        f"checkpoint saved after {checkpoint['cursor']:,} newer entities in {time.time() - start_time:.2f} seconds"
+    )
+
+
+def load_checkpoint(checkpoint_file):
+    """the checkpoint saved by save_checkpoint(), or None if there isn't one"""
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, "rb") as f:
+        return pickle.load(f)
+
+
+class AuditEngine:
+    """audits records handed over in batches rather than read from entity map files
+
+    For services that already have the records in memory or in a database cursor:
+
+        engine = AuditEngine(compact=True)
+        engine.add_newer(newer_records)
+        engine.add_prior(prior_records)
+        for audit_row in engine.run():
+            ...
+        stat_pack = engine.stats
+
+    The records are dicts with the columns of an entity map file, or json entity
+    documents like the Senzing export, and each side can be added in any number of
+    batches before run().  run() yields the audit csv rows, in AUDIT_CSV_HEADERS
+    order, as the audit goes and stats is then the stat pack of the json file with
+    its samples as dicts.  The one_to_one, data_sources, sample_rate, sample_size,
+    sample_rows and sample_seed options are those of audit().
+    """
+
+    def __init__(self, **kwargs):
+        self.options = kwargs
+        self.file_maps = {
+            file_type: (
+                CompactEntityMap()
+                if kwargs.get("compact")
+                else {"entities": {}, "records": {}, "relations": RelationIndex()}
+            )
+            for file_type in ("newer", "prior")
+        }
+        self.sampler = ReservoirSampler(
+            kwargs.get("sample_size"),
+            kwargs.get("sample_rows"),
+            kwargs.get("sample_seed"),
+        )
+        self.audit_state = None
+        self.stats = None
+
+    def add_newer(self, records):
+        self.add_records(records, "newer")
+
+    def add_prior(self, records):
+        self.add_records(records, "prior")
+
+    def add_records(self, records, file_type):
+        if self.audit_state is not None:
+            raise Exception("records can't be added once the audit has run")
+        file_map = self.file_maps[file_type]
+        entity_rows = filter_entity_rows(
+            parse_record_dicts(records),
+            self.options.get("data_sources"),
+            self.options.get("sample_rate"),
+        )
+        if self.options.get("compact"):
+            for row in entity_rows:
+                file_map.add_row(*row, keep_relations=file_type == "newer")
+        else:
+            add_entity_rows(file_map, entity_rows, file_type)
+
+    def run(self):
+        """yields the audit csv rows of each split and merge, in newer record order"""
+        if self.audit_state is not None:
+            raise Exception("the audit has already run")
+        newer_map, prior_map = self.file_maps["newer"], self.file_maps["prior"]
+        if self.options.get("compact"):
+            newer_map.finalize()
+            prior_map.finalize()
+        else:
+            newer_map["relations"].finalize()
+        self.audit_state = new_audit_state(
+            self.sampler, self.options.get("sample_rate")
+        )
+        overlap_matrix = OverlapMatrix(newer_map, prior_map)
+        assignment = (
+            assign_one_to_one(newer_map, prior_map)
+            if self.options.get("one_to_one")
+            else None
+        )
+        audit_rows = AuditRows()
+        for newer_entity_id in newer_map["entities"]:
+            audit_result = compare_map_entity(
+                newer_entity_id,
+                newer_map,
+                prior_map,
+                overlap_matrix=overlap_matrix,
+                assignment=assignment,
+                sample_rate=self.audit_state["sample_rate"],
+            )
+            if tally_audit_result(self.audit_state, audit_result):
+                report_audit_result(
+                    self.audit_state, audit_result, newer_map["relations"], audit_rows
+                )
+                yield from audit_rows
+                audit_rows.clear()
+
+        self.stats = compute_stat_pack(
+            self.audit_state, len(prior_map["entities"]), len(newer_map["entities"])
+        )
+        for audit_category in self.stats["AUDIT"].values():
+            for sub_category in audit_category["SUB_CATEGORY"].values():
+                sub_category["SAMPLE"] = [
+                    [dict(zip(AUDIT_CSV_HEADERS, csv_row)) for csv_row in audit_sample]
+                    for audit_sample in sub_category["SAMPLE"]
+                ]
+
+
+def shard_components(components, shard_count):
+    """deals the components out to shards, largest first to the smallest shard"""
+    shards = [[] for _ in range(shard_count)]
+    shard_sizes = [(0, i) for i in range(shard_count)]
+    for component in sorted(components, key=len, reverse=True):
+        shard_size, i = heapq.heappop(shard_sizes)
+        shards[i].extend(component)
+        heapq.heappush(shard_sizes, (shard_size + len(component), i))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def parallel_audit_entities(newer_map, prior_map, csv_writer, workers, **kwargs):
+    """audit_entities() spread over a pool of forked worker processes
+
+    The workers make the decisions for their shard of components and return their
+    counters plus a file of scored audit results.  Those are merged back in newer file
+    order here so audit ids, samples and the csv come out as in a single process run.
+    """
+    global _shard_context
+    newer_entity_ids, components = find_overlap_components(newer_map, prior_map)
+    shards = shard_components(components, workers * 4)
+    logging.info(
+        f"auditing {len(components):,} connected components on {workers} workers ..."
+    )
+
+    audit_state = new_audit_state(kwargs.get("sampler"), kwargs.get("sample_rate"))
+    overlap_matrix = OverlapMatrix(newer_map, prior_map)
+    fragment_file_names = []
+    with tempfile.TemporaryDirectory(
+        prefix="g2audit-", dir=kwargs.get("temp_dir")
+    ) as shard_dir:
+        _shard_context = (
+            newer_map,
+            prior_map,
+            newer_entity_ids,
+            shard_dir,
+            {
+                "overlap_matrix": overlap_matrix,
+                "assignment": kwargs.get("assignment"),
+                "sample_rate": kwargs.get("sample_rate"),
+            },
+            kwargs.get("sample_rate"),
+        )
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            for shard_state, fragment_file_name in pool.imap_unordered(
+                audit_shard, shards
+            ):
+                for counter in shard_state:
+                    if counter not in (
+                        "prior_entities",
+                        "audit_stats",
+                        "data_sources",
+                        "match_keys",
+                        "next_audit_id",
+                        "sampler",
+                        "sample_rate",
+                        "sample_replicates",
+                    ):
+                        audit_state[counter] += shard_state[counter]
+                merge_breakdowns(audit_state, shard_state)
+                fragment_file_names.append(fragment_file_name)
+                logging.info(
+                    f"{len(fragment_file_names)} of {len(shards)} shards audited"
+                )
+        _shard_context = None
+
+        for _, audit_result in heapq.merge(
+            *[ExternalSorter.read_run(file_name) for file_name in fragment_file_names]
+        ):
+            log_audit_result(audit_state, audit_result, csv_writer)
+    return audit_state
+
+
+_shard_context = None
+
+
+def merge_breakdowns(audit_state, shard_state):
+    """adds a shard's data source, match key and sample counters to the audit state"""
+    for data_source, shard_stats in shard_state["data_sources"].items():
+        stats = data_source_stats(audit_state, data_source)
+        for counter, count in shard_stats.items():
+            if counter != "audit_stats":  # counted as the results are logged
+                stats[counter] += count
+    add_match_key_counts(audit_state, shard_state["match_keys"])
+    if shard_state["sample_replicates"] is not None:
+        audit_state["sample_replicates"].merge(shard_state["sample_replicates"])
+
+
+def audit_shard(shard):
+    """worker side of parallel_audit_entities()"""
+    (
+        newer_map,
+        prior_map,
+        newer_entity_ids,
+        shard_dir,
+        compare_options,
+        sample_rate,
+    ) = _shard_context
+    audit_state = new_audit_state(sample_rate=sample_rate)
+    audit_results = []
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=shard_dir, suffix=".run", delete=False
+    ) as f:
+        for i in shard:
+            newer_entity_id = newer_entity_ids[i]
+            audit_result = compare_map_entity(
+                newer_entity_id,
+                newer_map,
+                prior_map,
+                **compare_options,
+            )
+            if tally_audit_result(audit_state, audit_result):
+                score_audit_result(audit_result, newer_map["relations"])
+                audit_results.append((i, audit_result))
+                if len(audit_results) == ExternalSorter.batch_size:
+                    pickle.dump(audit_results, f, pickle.HIGHEST_PROTOCOL)
+                    audit_results = []
+        if audit_results:
+            pickle.dump(audit_results, f, pickle.HIGHEST_PROTOCOL)
+    del audit_state["prior_entities"]
+    del audit_state["sampler"]
+    return audit_state, f.name
@@ -0,0 +1,414 @@
+"""audits with on disk sort/merge passes for files too large for memory"""
+
+import os
+import sys
+import time
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+import logging
+
+from G2AuditCommon import (
+    count_by_key,
+    display_name,
+    new_performance,
+    Progress,
+    timed_phase,
+    track_largest_entity,
+)
+from G2AuditFiles import read_entity_rows, row_filter_options
+from G2AuditSinks import close_audit_writer, open_audit_writer
+from G2AuditStats import (
+    print_stat_pack,
+    ReservoirSampler,
+    write_metrics_file,
+    write_stat_pack,
+)
+from G2AuditCompare import (
+    choose_prior_entity,
+    compare_newer_entity,
+    new_audit_state,
+    relation_keys_needed,
+    report_audit_result,
+    tally_audit_result,
+)
+
+
+def parse_memory_size(size_text):
+    """converts sizes like 512M or 4G to bytes"""
+    size_text = str(size_text).strip().upper().rstrip("B")
+    multiplier = 1
+    if size_text and size_text[-1] in "KMGT":
+        multiplier = 1024 ** ("KMGT".index(size_text[-1]) + 1)
+        size_text = size_text[:-1]
+    return int(float(size_text) * multiplier)
+
+
+def approximate_size(value):
+    """rough deep size of the tuples, lists and strings held by the external sorter"""
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(approximate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            approximate_size(key) + approximate_size(item)
+            for key, item in value.items()
+        )
+    return sys.getsizeof(value)
+
+
+class ExternalSorter:
+    """sorts a stream of tuples larger than memory
+
+    Tuples are buffered until they use about memory_limit bytes, then sorted and
+    spilled to a run file in temp_dir.  Iterating merges the runs back in order.
+    """
+
+    batch_size = 1024
+
+    def __init__(self, temp_dir, memory_limit):
+        self.temp_dir = temp_dir
+        self.memory_limit = memory_limit
+        self.rows = []
+        self.row_size = 0
+        self.buffer_size = 0
+        self.runs = []
+        self.row_count = 0
+
+    def add(self, row):
+        if self.row_count % 256 == 0:
+            self.row_size = approximate_size(row)
+        self.rows.append(row)
+        self.row_count += 1
+        self.buffer_size += self.row_size + 8
+        if self.buffer_size > self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        self.rows.sort()
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.temp_dir, suffix=".run", delete=False
+        ) as f:
+            for i in range(0, len(self.rows), self.batch_size):
+                pickle.dump(
+                    self.rows[i : i + self.batch_size], f, pickle.HIGHEST_PROTOCOL
+                )
+            self.runs.append(f.name)
+        self.rows = []
+        self.buffer_size = 0
+
+    def finish(self):
+        """spills what is left so other sorters get the memory while this one waits"""
+        if self.rows:
+            self.spill()
+
+    def __iter__(self):
+        if not self.runs:
+            self.rows.sort()
+            return iter(self.rows)
+        self.finish()
+        return heapq.merge(*[self.read_run(run) for run in self.runs])
+
+    @staticmethod
+    def read_run(run_file_name):
+        with open(run_file_name, "rb") as f:
+            while True:
+                try:
+                    rows = pickle.load(f)
+                except EOFError:
+                    break
+                yield from rows
+        os.remove(run_file_name)
+
+
+def merge_groups(*sorted_streams):
+    """co-iterates streams of tuples sorted on their first item
+
+    yields (key, [rows of stream 1], [rows of stream 2], ...) for every key in any stream
+    """
+    groupers = []
+    for stream in sorted_streams:
+        groupers.append(groupby(stream, key=itemgetter(0)))
+    current = [next(grouper, None) for grouper in groupers]
+    while True:
+        keys = [group[0] for group in current if group is not None]
+        if not keys:
+            return
+        key = min(keys)
+        rows = []
+        for i, group in enumerate(current):
+            if group is not None and group[0] == key:
+                rows.append(list(group[1]))
+                current[i] = next(groupers[i], None)
+            else:
+                rows.append([])
+        yield (key, *rows)
+
+
+def spill_entity_map(file_name, file_type, temp_dir, memory_limit, **kwargs):
+    """streams an entity map file into sorters of its entities, records and relations
+
+    The query, data_sources and sample_rate options are those of read_entity_rows().
+    """
+    logging.info(f"spilling {display_name(file_name)} ...")
+    entity_rows = ExternalSorter(temp_dir, memory_limit)
+    record_rows = ExternalSorter(temp_dir, memory_limit)
+    relation_rows = ExternalSorter(temp_dir, memory_limit)
+    for row_seq, (entity_id, record_key, score, related_entity_id) in enumerate(
+        read_entity_rows(file_name, file_type, **kwargs)
+    ):
+        entity_rows.add((entity_id, row_seq))
+        if record_key is not None:
+            record_rows.add((record_key, row_seq, entity_id, score))
+        elif file_type == "newer":
+            rel_key = "|".join(sorted([entity_id, related_entity_id]))
+            relation_rows.add((rel_key, row_seq, score))
+    entity_rows.finish()
+    record_rows.finish()
+    relation_rows.finish()
+    return entity_rows, record_rows, relation_rows
+
+
+def join_record_rows(newer_record_rows, prior_record_rows, temp_dir, memory_limit):
+    """merge joins both files on record key
+
+    Returns the newer memberships as (newer_entity_id, position, record_key, newer_score,
+    prior_entity_id) and the prior memberships as (prior_entity_id, position, record_key,
+    prior_score, newer_entity_id) sorted by entity and file position.  A record listed
+    twice keeps its first position and last score like the dict layout does and the
+    record's entity is the last one it was listed for.
+    """
+    newer_members = ExternalSorter(temp_dir, memory_limit)
+    prior_members = ExternalSorter(temp_dir, memory_limit)
+    for record_key, newer_rows, prior_rows in merge_groups(
+        newer_record_rows, prior_record_rows
+    ):
+        newer_entity_id = newer_rows[-1][2] if newer_rows else "unknown"
+        prior_entity_id = prior_rows[-1][2] if prior_rows else "unknown"
+        for entity_id, (position, score) in distinct_members(newer_rows).items():
+            newer_members.add((entity_id, position, record_key, score, prior_entity_id))
+        for entity_id, (position, score) in distinct_members(prior_rows).items():
+            prior_members.add((entity_id, position, record_key, score, newer_entity_id))
+    newer_members.finish()
+    prior_members.finish()
+    return newer_members, prior_members
+
+
+def distinct_members(record_rows):
+    members = {}
+    for _, row_seq, entity_id, score in record_rows:
+        if entity_id in members:
+            members[entity_id] = (members[entity_id][0], score)
+        else:
+            members[entity_id] = (row_seq, score)
+    return members
+
+
+def external_audit(file_name1, file_name2, output_root, **kwargs):
+    """audit() for entity maps larger than memory
+
+    Each file is spilled into sorted runs, merge joined on record key and then grouped
+    by newer entity and by prior entity in further sort passes.  The per entity
+    decisions are made by the same compare_newer_entity() as the in memory audit and
+    in the same order so the csv and json files are identical.
+    """
+    memory_limit = parse_memory_size(kwargs.get("memory_limit") or "1G")
+    # the busiest pass has about four sorters filling at the same time
+    sorter_limit = max(memory_limit // 4, 1024 * 1024)
+    performance = new_performance()
+    largest = {"NEWER": [], "PRIOR": []}
+
+    with tempfile.TemporaryDirectory(
+        prefix="g2audit-", dir=kwargs.get("temp_dir")
+    ) as temp_dir:
+        spilled = {}
+        for file_type, file_name in (("newer", file_name1), ("prior", file_name2)):
+            try:
+                with timed_phase(performance, f"{file_type.upper()}_LOAD"):
+                    spilled[file_type] = spill_entity_map(
+                        file_name,
+                        file_type,
+                        temp_dir,
+                        sorter_limit,
+                        query=kwargs.get(f"{file_type}_query"),
+                        **row_filter_options(kwargs),
+                    )
+            except Exception as err:
+                logging.error(f"{err} loading {display_name(file_name)}")
+                return 1
+        newer_entity_rows, newer_record_rows, relation_rows = spilled["newer"]
+        prior_entity_rows, prior_record_rows, _ = spilled["prior"]
+
+        # opened once the files have loaded so a bad file leaves no output behind
+        try:
+            csv_writer = open_audit_writer(output_root, **kwargs)
+        except Exception as err:
+            logging.error(f"{err} opening the audit output files")
+            return 1
+
+        audit_start_time = time.time()
+        logging.info("joining records ...")
+        newer_members, prior_members = join_record_rows(
+            newer_record_rows, prior_record_rows, temp_dir, sorter_limit
+        )
+
+        # group the newer records by entity and choose each one's prior entity
+        logging.info("grouping newer entities ...")
+        newer_bundles = ExternalSorter(temp_dir, sorter_limit)
+        prior_requests = ExternalSorter(temp_dir, sorter_limit)
+        newer_entity_count = 0
+        for newer_entity_id, entity_rows, member_rows in merge_groups(
+            newer_entity_rows, newer_members
+        ):
+            newer_entity_count += 1
+            entity_seq = entity_rows[0][1]
+            members = [(row[2], row[3], row[4]) for row in member_rows]
+            track_largest_entity(
+                largest["NEWER"], entity_seq, newer_entity_id, len(members)
+            )
+            prior_entity_ids = {}
+            for member in members:
+                if member[2] != "unknown":
+                    prior_entity_ids = count_by_key(prior_entity_ids, member[2])
+            prior_entity_id = None  # compare_newer_entity() skips it
+            if prior_entity_ids or not members:
+                prior_entity_id = choose_prior_entity(prior_entity_ids, {})
+                prior_requests.add((prior_entity_id, entity_seq))
+            newer_bundles.add((entity_seq, newer_entity_id, members, prior_entity_id))
+        newer_bundles.finish()
+        prior_requests.finish()
+
+        # attach each requested prior entity's records to the newer entities asking for it
+        logging.info("grouping prior entities ...")
+        audit_state = new_audit_state(
+            ReservoirSampler(
+                kwargs.get("sample_size"),
+                kwargs.get("sample_rows"),
+                kwargs.get("sample_seed"),
+            ),
+            kwargs.get("sample_rate"),
+        )
+        prior_bundles = ExternalSorter(temp_dir, sorter_limit)
+        prior_entity_count = 0
+        for prior_entity_id, entity_rows, request_rows, member_rows in merge_groups(
+            prior_entity_rows, prior_requests, prior_members
+        ):
+            if entity_rows:
+                prior_entity_count += 1
+                track_largest_entity(
+                    largest["PRIOR"],
+                    entity_rows[0][1],
+                    prior_entity_id,
+                    len(member_rows),
+                )
+            if not request_rows:
+                continue
+            members = [(row[2], row[3], row[4]) for row in member_rows]
+            # the prior pairs are counted with the first newer entity asking for it
+            for i, request_row in enumerate(request_rows):
+                prior_bundles.add((request_row[1], members, i == 0))
+        prior_bundles.finish()
+
+        # make the audit decisions in newer file order, holding back the reporting
+        # until the relationships needed for the new negatives have been looked up
+        logging.info("auditing newer entities ...")
+        relation_requests = ExternalSorter(temp_dir, sorter_limit)
+        pending_file_name = os.path.join(temp_dir, "pending.pkl")
+        progress = Progress("newer entities audited", total=newer_entity_count)
+        with open(pending_file_name, "wb") as pending_file:
+            for entity_seq, bundle_rows, prior_rows in merge_groups(
+                newer_bundles, prior_bundles
+            ):
+                progress.update()
+                _, newer_entity_id, members, prior_entity_id = bundle_rows[0]
+                newer_entity = {member[0]: member[1] for member in members}
+                prior_records = {
+                    member[0]: member[2] for member in members if member[2] != "unknown"
+                }
+                prior_entities, newer_records = {}, {}
+                if prior_rows:
+                    prior_members_list = prior_rows[0][1]
+                    prior_entities[prior_entity_id] = {
+                        member[0]: member[1] for member in prior_members_list
+                    }
+                    newer_records = {
+                        member[0]: member[2] for member in prior_members_list
+                    }
+                audit_result = compare_newer_entity(
+                    newer_entity_id,
+                    newer_entity,
+                    prior_records,
+                    prior_entities,
+                    newer_records,
+                    sample_rate=kwargs.get("sample_rate"),
+                )
+                if tally_audit_result(
+                    audit_state, audit_result, bool(prior_rows) and prior_rows[0][2]
+                ):
+                    for rel_key in relation_keys_needed(audit_result):
+                        relation_requests.add((rel_key, entity_seq))
+                    pickle.dump(
+                        (entity_seq, audit_result),
+                        pending_file,
+                        pickle.HIGHEST_PROTOCOL,
+                    )
+        progress.finish()
+        relation_requests.finish()
+
+        relation_answers = ExternalSorter(temp_dir, sorter_limit)
+        for rel_key, request_rows, rel_rows in merge_groups(
+            relation_requests, relation_rows
+        ):
+            if request_rows and rel_rows:
+                for request_row in request_rows:
+                    relation_answers.add((request_row[1], rel_key, rel_rows[0][2]))
+        relation_answers.finish()
+        performance["PHASE_SECONDS"]["AUDIT_LOOP"] = round(
+            time.time() - audit_start_time, 3
+        )
+
+        logging.info("writing audit results ...")
+        csv_start_time = time.time()
+        answers = iter(relation_answers)
+        answer = next(answers, None)
+        with open(pending_file_name, "rb") as pending_file:
+            while True:
+                try:
+                    entity_seq, audit_result = pickle.load(pending_file)
+                except EOFError:
+                    break
+                relations = {}
+                while answer is not None and answer[0] <= entity_seq:
+                    if answer[0] == entity_seq:
+                        relations[answer[1]] = answer[2]
+                    answer = next(answers, None)
+                report_audit_result(audit_state, audit_result, relations, csv_writer)
+    if not close_audit_writer(csv_writer):
+        return 1
+    performance["PHASE_SECONDS"]["OUTPUT_WRITE"] = round(
+        time.time() - csv_start_time, 3
+    )
+
+    for file_type, record_rows in (
+        ("NEWER", newer_record_rows),
+        ("PRIOR", prior_record_rows),
+    ):
+        performance["RECORDS_PER_SECOND"][file_type] = round(
+            record_rows.row_count
+            / max(performance["PHASE_SECONDS"][f"{file_type}_LOAD"], 0.001)
+        )
+        performance["LARGEST_ENTITIES"][file_type] = [
+            {"ENTITY_ID": entity_id, "RECORD_COUNT": record_count}
+            for record_count, _, entity_id in sorted(largest[file_type], reverse=True)
+        ]
+    stat_pack = write_stat_pack(
+        audit_state,
+        prior_entity_count,
+        newer_entity_count,
+        output_root + ".json",
+        performance,
+    )
+    print_stat_pack(stat_pack, audit_state)
+    write_metrics_file(stat_pack, kwargs.get("metrics_file"))
+    return 0
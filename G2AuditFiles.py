@@ -0,0 +1,333 @@
+"""reads the rows of entity map files, compressed or not, csv or json"""
+
+import os
+import csv
+import json
+import gzip
+import bz2
+import lzma
+import hashlib
+import io
+import queue
+import threading
+
+try:
+    import orjson
+
+    json_loads = orjson.loads  # pylint: disable=no-member
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from G2AuditCommon import (
+    COMPRESSION_MAGIC,
+    compute_record_key,
+    detect_column_names,
+    detect_column_positions,
+    is_database_source,
+    parse_entity_rows,
+    Progress,
+)
+from G2AuditDatabase import read_database_rows
+
+
+def detect_compression(file_name):
+    """returns gzip, bz2, xz or zstd from a file's magic bytes, None if it is not compressed"""
+    with open(file_name, "rb") as f:
+        magic_bytes = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if magic_bytes.startswith(magic):
+            return compression
+    return None
+
+
+def open_compressed(file_name, compression, mode="rb"):
+    """opens a gzip, bz2, xz or zstd file, or file object, for binary reading or writing"""
+    if compression == "gzip":
+        return gzip.open(file_name, mode, compresslevel=6)
+    if compression == "bz2":
+        return bz2.open(file_name, mode)
+    if compression == "xz":
+        return lzma.open(file_name, mode)
+    if compression == "zstd":
+        if zstandard is None:
+            raise Exception(
+                f"zstandard is needed for the zstd compressed {file_name}, pip install zstandard"
+            )
+        if mode.startswith("r"):
+            return zstandard.ZstdDecompressor().stream_reader(
+                open(file_name, "rb") if isinstance(file_name, str) else file_name,
+                read_across_frames=True,
+            )
+        return zstandard.ZstdCompressor().stream_writer(open(file_name, "wb"))
+    return open(file_name, mode)
+
+
+class BackgroundDecompressor(io.RawIOBase):
+    """a raw stream of a compressed file that is decompressed in a background thread
+
+    The thread hands decompressed blocks over a bounded queue so decompressing and
+    parsing overlap while no more than queue_size blocks are held in memory.  The
+    gzip, bz2, lzma and zstandard decompressors release the GIL while they work.
+    """
+
+    block_size = 1024 * 1024
+    queue_size = 16
+
+    def __init__(self, file_name, compression):
+        super().__init__()
+        self.blocks = queue.Queue(self.queue_size)
+        self.pending = memoryview(b"")
+        self.compressed_position = 0
+        self.finished = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self.decompress, args=(file_name, compression), daemon=True
+        )
+        self.thread.start()
+
+    def decompress(self, file_name, compression):
+        try:
+            with open(file_name, "rb") as compressed_file, open_compressed(
+                compressed_file, compression
+            ) as f:
+                while not self.stopping.is_set():
+                    block = f.read(self.block_size)
+                    if not block:
+                        break
+                    self.put_block((block, compressed_file.tell()))
+        except Exception as err:
+            self.put_block(err)
+        self.put_block(None)
+
+    def put_block(self, block):
+        while not self.stopping.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if block is None or isinstance(block, Exception):
+                self.finished = True
+                if block is None:
+                    return 0
+                raise block
+            self.pending = memoryview(block[0])
+            self.compressed_position = block[1]
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        super().close()
+
+
+def open_input(file_name, mode="r"):
+    """opens a file for reading, decompressing it in a background thread if it is compressed"""
+    compression = detect_compression(file_name)
+    if not compression:
+        return open(file_name, mode)
+    f = io.BufferedReader(
+        BackgroundDecompressor(file_name, compression),
+        BackgroundDecompressor.block_size,
+    )
+    return f if "b" in mode else io.TextIOWrapper(f)
+
+
+def bytes_read(f):
+    """how far into the file on disk a file opened by open_input() has read"""
+    raw = getattr(getattr(f, "buffer", f), "raw", f)
+    if isinstance(raw, BackgroundDecompressor):
+        return raw.compressed_position
+    return raw.tell()
+
+
+def open_output(file_name, compression=None):
+    """opens a text file for writing, compressing it with gzip, bz2, xz or zstd if asked"""
+    if not compression:
+        return open(file_name, "w")
+    return io.TextIOWrapper(open_compressed(file_name, compression, "wb"))
+
+
+def detect_file_format(file_name):
+    """returns json for json lines files like the Senzing export, otherwise csv"""
+    with open_compressed(file_name, detect_compression(file_name)) as f:
+        first_bytes = f.read(1024).lstrip()
+    return "json" if first_bytes.startswith(b"{") else "csv"
+
+
+def read_entity_rows(file_name, file_type, query=None, **kwargs):
+    """yields (entity_id, record_key, score, related_entity_id) for each row of an entity map file
+
+    json lines files yield a row for each of an entity's records and related entities.
+    A module://dsn database source yields the rows of its query instead.  The
+    data_sources and sample_rate options are those of filter_entity_rows().
+    """
+    if is_database_source(file_name):
+        yield from filter_entity_rows(
+            read_database_rows(file_name, file_type, query), **kwargs
+        )
+        return
+    if detect_file_format(file_name) == "json":
+        f = open_input(file_name, "rb")
+        entity_rows = parse_json_entity_rows(f)
+    else:
+        f = open_input(file_name, "r")
+        reader = csv.reader(f)
+        entity_rows = parse_entity_rows(
+            reader, detect_column_positions(next(reader, []), file_name)
+        )
+    entity_rows = filter_entity_rows(entity_rows, **kwargs)
+    with f:
+        progress = Progress(
+            f"{file_type} rows loaded",
+            total=os.path.getsize(file_name),
+            position=lambda: bytes_read(f),
+        )
+        for row in entity_rows:
+            progress.update()
+            yield row
+        progress.finish()
+
+
+def row_filter_options(options):
+    """the data_sources and sample_rate options of filter_entity_rows() out of the
+    options of an audit"""
+    return {option: options.get(option) for option in ("data_sources", "sample_rate")}
+
+
+def filter_entity_rows(entity_rows, data_sources=None, sample_rate=None):
+    """drops the entity rows of records from other data sources, or left out of a
+    sample_rate sample of the records, as they are read
+
+    The sample keeps the records whose hashed record key falls below sample_rate, so
+    the same records are kept from both files whatever entities they are in.  A
+    relationship row is kept when it follows a kept record of its entity, as it does
+    in Senzing exports, so entities without any kept records are dropped whole.
+    """
+    if not data_sources and not sample_rate:
+        return entity_rows
+    return kept_entity_rows(entity_rows, set(data_sources or ()), sample_rate)
+
+
+# the key of the record key hash a sample_rate sample is picked by, the benchmark
+# changes it to draw other samples of the same files
+SAMPLE_HASH_KEY = b""
+
+# the hash ranges a sample_rate sample is split into for its confidence intervals
+SAMPLE_GROUPS = 50
+
+
+def sample_hash(record_key):
+    return hashlib.blake2b(
+        record_key.encode(), digest_size=4, key=SAMPLE_HASH_KEY
+    ).digest()
+
+
+def sample_limit(sample_rate):
+    """the record key hashes of a sample_rate sample are below this"""
+    return min(int(sample_rate * 2**32), 2**32 - 1)
+
+
+def sample_group_counts(record_keys, sample_rate):
+    """counts sampled record keys by which of the SAMPLE_GROUPS equal ranges below
+    sample_limit() their hash is in"""
+    limit = sample_limit(sample_rate)
+    group_counts = {}
+    for record_key in record_keys:
+        group = int.from_bytes(sample_hash(record_key), "big") * SAMPLE_GROUPS // limit
+        group_counts[group] = group_counts.get(group, 0) + 1
+    return group_counts
+
+
+def kept_entity_rows(entity_rows, data_sources, sample_rate):
+    limit = None
+    if sample_rate:
+        limit = sample_limit(sample_rate).to_bytes(4, "big")
+    kept_entity_id = None
+    for entity_row in entity_rows:
+        record_key = entity_row[1]
+        if record_key is None:
+            if entity_row[0] == kept_entity_id:
+                yield entity_row
+            continue
+        if data_sources and record_key.partition("||")[0] not in data_sources:
+            continue
+        if limit is not None and sample_hash(record_key) >= limit:
+            continue
+        kept_entity_id = entity_row[0]
+        yield entity_row
+
+
+def parse_json_entity_rows(lines):
+    """parses json lines of resolved entities, such as the Senzing export, into entity rows"""
+    for line in lines:
+        if not line.strip():
+            continue
+        yield from parse_json_entity(json_loads(line))
+
+
+def parse_json_entity(document):
+    resolved_entity = document.get("RESOLVED_ENTITY", document)
+    entity_id = str(resolved_entity["ENTITY_ID"])
+    for record in resolved_entity.get("RECORDS", []):
+        yield (
+            entity_id,
+            compute_record_key(
+                record, "ENTITY_ID", "DATA_SOURCE", "RECORD_ID", "MATCH_KEY"
+            ),
+            record.get("MATCH_KEY") or "",
+            "0",
+        )
+    for related_entity in document.get("RELATED_ENTITIES", []):
+        yield (
+            entity_id,
+            None,
+            related_entity.get("MATCH_KEY") or "",
+            str(related_entity["ENTITY_ID"]),
+        )
+
+
+def parse_record_dicts(records):
+    """parses dicts with the columns of an entity map file, or json entity documents like
+    the Senzing export, into entity rows
+
+    The columns are detected from the first record that isn't an entity document.
+    """
+    column_names = None
+    for record in records:
+        if "RECORDS" in record or "RESOLVED_ENTITY" in record:
+            yield from parse_json_entity(record)
+            continue
+        if column_names is None:
+            column_names = detect_column_names(list(record), "the records")
+        cluster_field, source_field, record_field, score_field = column_names
+        related_entity_id = str(record.get("RELATED_ENTITY_ID") or "0")
+        if related_entity_id == "0":
+            record_key = compute_record_key(
+                record, cluster_field, source_field, record_field, score_field
+            )
+        else:
+            record_key = None
+        yield (
+            str(record[cluster_field]),
+            record_key,
+            (record.get(score_field) or "") if score_field else "",
+            related_entity_id,
+        )
@@ -0,0 +1,420 @@
+"""loads entity map files into the maps the audit compares"""
+
+import os
+import csv
+import io
+import heapq
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from itertools import groupby
+from operator import itemgetter
+import logging
+
+from G2AuditCommon import (
+    detect_column_positions,
+    display_name,
+    is_database_source,
+    parse_entity_rows,
+    track_largest_entity,
+)
+from G2AuditFiles import (
+    detect_compression,
+    detect_file_format,
+    filter_entity_rows,
+    parse_json_entity_rows,
+    read_entity_rows,
+    row_filter_options,
+)
+from G2AuditCompact import CompactEntityMap, load_from_cache
+
+
+def load_from_file(file_name, file_type, **kwargs):
+    if kwargs.get("cache_dir") and not is_database_source(file_name):
+        return load_from_cache(
+            file_name,
+            file_type,
+            kwargs["cache_dir"],
+            **row_filter_options(kwargs),
+        )
+    logging.info(f"loading {display_name(file_name)} ...")
+    entity_rows = read_entity_rows(
+        file_name,
+        file_type,
+        kwargs.get("query"),
+        **row_filter_options(kwargs),
+    )
+    if kwargs.get("compact"):
+        file_map = CompactEntityMap()
+        for row in entity_rows:
+            file_map.add_row(*row, keep_relations=file_type == "newer")
+        file_map.finalize()
+        return file_map
+    if kwargs.get("record_keys") is not None:
+        entity_rows = intern_record_keys(entity_rows, kwargs["record_keys"])
+    return build_entity_map(entity_rows, file_type)
+
+
+def intern_record_keys(entity_rows, record_keys):
+    """swaps each record key for the equal string already in the record_keys dict
+
+    Maps loaded with the same dict then share one string per record, which saves
+    the memory of the copies and lets dict lookups across them match on identity.
+    """
+    for entity_id, record_key, score, related_entity_id in entity_rows:
+        if record_key is not None:
+            record_key = record_keys.setdefault(record_key, record_key)
+        yield entity_id, record_key, score, related_entity_id
+
+
+def build_entity_map(entity_rows, file_type):
+    file_map = {"entities": {}, "records": {}, "relations": RelationIndex()}
+    add_entity_rows(file_map, entity_rows, file_type)
+    file_map["relations"].finalize()
+    return file_map
+
+
+def add_entity_rows(file_map, entity_rows, file_type):
+    for entity_id, record_key, score, related_entity_id in entity_rows:
+        if entity_id not in file_map["entities"]:
+            file_map["entities"][entity_id] = {}
+        if record_key is not None:
+            file_map["entities"][entity_id][record_key] = score
+            file_map["records"][record_key] = entity_id
+        elif file_type == "newer":  # don't need relationships for prior
+            file_map["relations"].add(entity_id, related_entity_id, score)
+
+
+def merge_entity_maps(file_map, partial_map):
+    """adds the map of a later chunk of the same file as if it had been loaded in one pass"""
+    for entity_id, entity in partial_map["entities"].items():
+        if entity_id in file_map["entities"]:
+            file_map["entities"][entity_id].update(entity)
+        else:
+            file_map["entities"][entity_id] = entity
+    file_map["records"].update(partial_map["records"])
+    file_map["relations"].merge(partial_map["relations"])
+
+
+def stream_entity_map(file_name, file_type, **kwargs):
+    """a map of a file grouped by entity id whose entities are read back from the file
+    one at a time as the audit loop gets to them, or None if it isn't grouped
+
+    The first pass only keeps the record -> entity id index and the relationships,
+    which is all the audit needs of the other newer entities, so the entities
+    themselves are never all in memory at once.  The query, data_sources and
+    sample_rate options are those of read_entity_rows().
+    """
+    logging.info(f"indexing {display_name(file_name)} ...")
+    file_map = {"entities": None, "records": {}, "relations": RelationIndex()}
+    entity_ids = set()
+    largest = []
+    entity_id = None
+    entity_keys = set()
+    for row_entity_id, record_key, score, related_entity_id in read_entity_rows(
+        file_name, file_type, **kwargs
+    ):
+        if row_entity_id != entity_id:
+            if entity_id is not None:
+                track_largest_entity(
+                    largest, len(entity_ids), entity_id, len(entity_keys)
+                )
+            if row_entity_id in entity_ids:
+                logging.info(
+                    f"{display_name(file_name)} isn't grouped by entity id, loading it whole"
+                )
+                return None
+            entity_id = row_entity_id
+            entity_ids.add(entity_id)
+            entity_keys = set()
+        if record_key is not None:
+            entity_keys.add(record_key)
+            file_map["records"][record_key] = entity_id
+        elif file_type == "newer":
+            file_map["relations"].add(entity_id, related_entity_id, score)
+    if entity_id is not None:
+        track_largest_entity(largest, len(entity_ids), entity_id, len(entity_keys))
+    file_map["relations"].finalize()
+    file_map["entities"] = StreamedEntities(
+        file_name, file_type, len(entity_ids), largest, **kwargs
+    )
+    return file_map
+
+
+class StreamedEntities(Mapping):
+    """entity_id -> {record_key: score} of a file grouped by entity id, read back in
+    file order each time it is iterated
+
+    Only the entity the iteration is on can be looked up, which is all the audit loop
+    does with it.  largest is the heap of track_largest_entity() from the first pass.
+    """
+
+    def __init__(self, file_name, file_type, entity_count, largest, **kwargs):
+        self.file_name = file_name
+        self.file_type = file_type
+        self.entity_count = entity_count
+        self.largest = largest
+        self.read_options = kwargs
+        self.entity_id = None
+        self.entity = None
+
+    def __len__(self):
+        return self.entity_count
+
+    def __iter__(self):
+        entity_rows = read_entity_rows(
+            self.file_name, self.file_type, **self.read_options
+        )
+        for entity_id, rows in groupby(entity_rows, key=itemgetter(0)):
+            self.entity_id = entity_id
+            self.entity = {
+                record_key: score
+                for _, record_key, score, _ in rows
+                if record_key is not None
+            }
+            yield entity_id
+
+    def __getitem__(self, entity_id):
+        if entity_id != self.entity_id:
+            raise KeyError(entity_id)
+        return self.entity
+
+
+def entity_id_number(entity_id):
+    """the entity id as an integer if it is a plain one below 2**31, otherwise None"""
+    if (
+        entity_id.isascii()
+        and entity_id.isdigit()
+        and (entity_id[0] != "0" or entity_id == "0")
+    ):
+        number = int(entity_id)
+        if number < 2**31:
+            return number
+    return None
+
+
+class RelationIndex(Mapping):
+    """the relationships of a newer file, a rel_key -> match key mapping like the dict
+
+    Most entity ids are integers, so a relationship is kept as the pair of them packed
+    into one 64 bit integer in a sorted array next to an array of interned match key
+    codes, about 12 bytes a relationship where a dict of "id1|id2" strings takes over
+    a hundred.  Relationships of other entity ids are kept in a plain dict.  New ones
+    are collected in a dict until finalize() sorts them in, which any lookup does
+    first, and the first match key of a relationship listed twice is kept.
+    """
+
+    def __init__(self):
+        self.pair_keys = array("q")
+        self.pair_scores = array("i")
+        self.scores = []
+        self.other_relations = {}
+        self._score_codes = {}
+        self._pending = {}
+        self._last_entity = (None, None)
+
+    def add(self, entity_id, related_entity_id, score):
+        if entity_id != self._last_entity[0]:  # an entity's rows usually come together
+            self._last_entity = (entity_id, entity_id_number(entity_id))
+        low = self._last_entity[1]
+        high = entity_id_number(related_entity_id)
+        if low is None or high is None:
+            self.other_relations.setdefault(
+                "|".join(sorted([entity_id, related_entity_id])), score
+            )
+            return
+        pair_key = low << 32 | high if low < high else high << 32 | low
+        score_code = self._score_codes.get(score)
+        if score_code is None:
+            score_code = self._score_codes[score] = len(self.scores)
+            self.scores.append(score)
+        self._pending.setdefault(pair_key, score_code)
+
+    def merge(self, relation_index):
+        """adds the relationships of another index after this one's"""
+        for pair_key, score_code in zip(
+            relation_index.pair_keys, relation_index.pair_scores
+        ):
+            low, high = divmod(pair_key, 1 << 32)
+            self.add(str(low), str(high), relation_index.scores[score_code])
+        for rel_key, score in relation_index.other_relations.items():
+            self.other_relations.setdefault(rel_key, score)
+
+    def finalize(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        for pair_key, score_code in zip(self.pair_keys, self.pair_scores):
+            pending[pair_key] = score_code  # the ones already in were listed first
+        pair_keys = sorted(pending)
+        self.pair_keys = array("q", pair_keys)
+        self.pair_scores = array("i", map(pending.__getitem__, pair_keys))
+
+    @staticmethod
+    def pack(entity_id, related_entity_id):
+        low = entity_id_number(entity_id)
+        high = entity_id_number(related_entity_id)
+        if low is None or high is None:
+            return None
+        if low > high:
+            low, high = high, low
+        return low << 32 | high
+
+    def __len__(self):
+        self.finalize()
+        return len(self.pair_keys) + len(self.other_relations)
+
+    def __iter__(self):
+        self.finalize()
+        for pair_key in self.pair_keys:
+            yield "|".join(
+                sorted(str(entity_id) for entity_id in divmod(pair_key, 1 << 32))
+            )
+        yield from self.other_relations
+
+    def __getitem__(self, rel_key):
+        self.finalize()
+        entity_ids = rel_key.split("|")
+        pair_key = self.pack(*entity_ids) if len(entity_ids) == 2 else None
+        if pair_key is None:
+            return self.other_relations[rel_key]
+        i = bisect_left(self.pair_keys, pair_key)
+        if i == len(self.pair_keys) or self.pair_keys[i] != pair_key:
+            raise KeyError(rel_key)
+        return self.scores[self.pair_scores[i]]
+
+
+def file_chunks(file_name, chunk_count, has_header=True):
+    """splits the rows of a file into byte ranges that start and end on a row"""
+    file_size = os.path.getsize(file_name)
+    with open(file_name, "rb") as f:
+        if has_header:
+            f.readline()
+        boundaries = [f.tell()]
+        for i in range(1, chunk_count):
+            f.seek(
+                max(
+                    boundaries[0] + (file_size - boundaries[0]) * i // chunk_count,
+                    boundaries[-1],
+                )
+            )
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return [
+        (start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start
+    ]
+
+
+def load_chunk(chunk_task):
+    file_name, file_type, column_positions, start, end, filter_options = chunk_task
+    if end is None:  # a compressed file or database source is loaded whole
+        return build_entity_map(
+            read_entity_rows(file_name, file_type, column_positions, **filter_options),
+            file_type,
+        )
+    with open(file_name, "rb") as f:
+        f.seek(start)
+        chunk_data = f.read(end - start)
+    if column_positions is None:  # json lines
+        entity_rows = parse_json_entity_rows(chunk_data.splitlines())
+    else:
+        reader = csv.reader(io.TextIOWrapper(io.BytesIO(chunk_data)))
+        entity_rows = parse_entity_rows(reader, column_positions)
+    return build_entity_map(
+        filter_entity_rows(entity_rows, **filter_options), file_type
+    )
+
+
+def load_files_in_parallel(file_specs, workers, **kwargs):
+    """loads several (file_name, file_type, query) files at once with a pool of processes
+
+    Each file is split into chunks of whole rows that the workers parse into partial
+    maps.  The partial maps are merged back in file order so the result is the same
+    as load_from_file().  Compressed files can't be split by byte range so each one
+    is loaded whole by a single worker, as is each database source over a connection
+    of its own.  The query is only used for database sources.  The data_sources and
+    sample_rate options are those of filter_entity_rows().
+    """
+    filter_options = row_filter_options(kwargs)
+    chunk_tasks = []
+    for file_name, file_type, query in file_specs:
+        logging.info(f"loading {display_name(file_name)} ...")
+        if is_database_source(file_name):
+            # the query rides in the column positions slot of a whole source task
+            chunk_tasks.append((file_name, file_type, query, 0, None, filter_options))
+            continue
+        if detect_compression(file_name):
+            chunk_tasks.append((file_name, file_type, None, 0, None, filter_options))
+            continue
+        column_positions = None
+        if detect_file_format(file_name) == "csv":
+            with open(file_name, "r") as f:
+                column_positions = detect_column_positions(
+                    next(csv.reader(f), []), file_name
+                )
+        chunk_count = max(
+            1, min(workers * 4, os.path.getsize(file_name) // (8 * 1024 * 1024))
+        )
+        for start, end in file_chunks(
+            file_name, chunk_count, has_header=column_positions is not None
+        ):
+            chunk_tasks.append(
+                (file_name, file_type, column_positions, start, end, filter_options)
+            )
+
+    file_maps = {
+        file_name: {"entities": {}, "records": {}, "relations": RelationIndex()}
+        for file_name, _, _ in file_specs
+    }
+    with multiprocessing.Pool(workers) as pool:
+        for chunk_task, partial_map in zip(
+            chunk_tasks, pool.imap(load_chunk, chunk_tasks)
+        ):
+            merge_entity_maps(file_maps[chunk_task[0]], partial_map)
+            if chunk_task[4] is None:
+                logging.info(
+                    f"{len(partial_map['records']):,} {chunk_task[1]} records loaded from {display_name(chunk_task[0])}"
+                )
+            else:
+                logging.info(
+                    f"{len(partial_map['records']):,} {chunk_task[1]} records loaded from {chunk_task[0]} bytes {chunk_task[3]:,}-{chunk_task[4]:,}"
+                )
+    for file_map in file_maps.values():
+        file_map["relations"].finalize()
+    return [file_maps[file_name] for file_name, _, _ in file_specs]
+
+
+def largest_entities(file_map, count=10):
+    """the ids and record counts of a map's largest entities, in file order on ties"""
+    if isinstance(file_map, CompactEntityMap):
+        entity_codes = heapq.nlargest(
+            count, range(len(file_map.entity_ids)), key=file_map.entity_size
+        )
+        entity_sizes = [
+            (file_map.entity_id(entity_code), file_map.entity_size(entity_code))
+            for entity_code in entity_codes
+        ]
+    elif isinstance(file_map["entities"], StreamedEntities):
+        entity_sizes = [
+            (entity_id, record_count)
+            for record_count, _, entity_id in sorted(
+                file_map["entities"].largest, reverse=True
+            )
+        ]
+    else:
+        entity_sizes = heapq.nlargest(
+            count,
+            (
+                (entity_id, len(entity))
+                for entity_id, entity in file_map["entities"].items()
+            ),
+            key=itemgetter(1),
+        )
+    return [
+        {"ENTITY_ID": entity_id, "RECORD_COUNT": record_count}
+        for entity_id, record_count in entity_sizes
+    ]
@@ -0,0 +1,164 @@
+"""estimates how many records each file is missing before an audit"""
+
+import math
+import hashlib
+import heapq
+import logging
+import textwrap
+
+from G2AuditCommon import display_name
+from G2AuditFiles import read_entity_rows, row_filter_options
+
+
+def within_max_missing(report, max_missing):
+    """prints a precheck report and returns whether no more than max_missing of the
+    records of either file are missing from the other, logging why if not"""
+    print(format_precheck(report))
+    for key, desc in (
+        ("MISSING_PRIOR_RECORDS", "newer records are missing from the prior file"),
+        ("MISSING_NEWER_RECORDS", "prior records are missing from the newer file"),
+    ):
+        if report[key]["FRACTION"] > max_missing:
+            logging.error(
+                f"{report[key]['FRACTION']:.2%} of the {desc}, more than --max_missing allows, so the files were not audited"
+            )
+            return False
+    return True
+
+
+class HashSketch:
+    """the sketch_size smallest 64 bit hashes of a file's record keys, a bottom-k sketch
+
+    A record key hashes the same in every file, so the smallest hashes of the union of
+    two sketches are a uniform sample of all the record keys of the two files that
+    tells which of them each is in.  It takes a few seconds per million records and a
+    fixed 4096 hashes of memory however large the file.
+    """
+
+    sketch_size = 4096
+
+    def __init__(self):
+        self.heap = []  # the hashes negated so the largest kept is on top
+        self.hashes = set()
+
+    def add(self, record_key):
+        key_hash = int.from_bytes(
+            hashlib.blake2b(record_key.encode(), digest_size=8).digest(), "big"
+        )
+        if len(self.heap) < self.sketch_size:
+            if key_hash not in self.hashes:
+                self.hashes.add(key_hash)
+                heapq.heappush(self.heap, -key_hash)
+        elif key_hash < -self.heap[0] and key_hash not in self.hashes:
+            self.hashes.discard(-heapq.heappushpop(self.heap, -key_hash))
+            self.hashes.add(key_hash)
+
+    def is_exact(self):
+        """True if the sketch has all the file's record keys"""
+        return len(self.heap) < self.sketch_size
+
+
+def precheck(newer_file_name, prior_file_name, **kwargs):
+    """estimates how many records of each file are missing from the other from hash
+    sketches of their record keys, without loading either file
+
+    Each file is read once into a HashSketch.  Counting which file the hashes of the
+    union sample are in gives the share of the records of both files that are only
+    in the newer file, only in the prior file or in both, and the k-th smallest
+    hash how many records there are in all.  The counts are exact when the files
+    have fewer than HashSketch.sketch_size records between them and otherwise have
+    95% confidence intervals of a few percent.  The newer_query, prior_query,
+    data_sources and sample_rate options are those of audit().
+    """
+    sketches = []
+    for file_name, file_type, query in (
+        (newer_file_name, "newer", kwargs.get("newer_query")),
+        (prior_file_name, "prior", kwargs.get("prior_query")),
+    ):
+        logging.info(f"sketching the record keys of {display_name(file_name)} ...")
+        sketch = HashSketch()
+        for _, record_key, _, _ in read_entity_rows(
+            file_name,
+            file_type,
+            query,
+            **row_filter_options(kwargs),
+        ):
+            if record_key is not None:
+                sketch.add(record_key)
+        sketches.append(sketch)
+    newer_hashes, prior_hashes = sketches[0].hashes, sketches[1].hashes
+
+    union_sample = sorted(newer_hashes | prior_hashes)
+    exact = sketches[0].is_exact() and sketches[1].is_exact()
+    if exact:
+        union_count = len(union_sample)
+    else:
+        union_sample = union_sample[: HashSketch.sketch_size]
+        union_count = (len(union_sample) - 1) * 2**64 / (union_sample[-1] + 1)
+    newer_only = sum(key_hash not in prior_hashes for key_hash in union_sample)
+    prior_only = sum(key_hash not in newer_hashes for key_hash in union_sample)
+    common = len(union_sample) - newer_only - prior_only
+    scale = union_count / len(union_sample) if union_sample else 0
+    return precheck_report(newer_only, prior_only, common, scale, exact)
+
+
+def map_precheck(newer_map, prior_map):
+    """the precheck() report of two loaded maps, exact as it looks each of their
+    record keys up in the other map rather than reading the files again"""
+    newer_records, prior_records = newer_map["records"], prior_map["records"]
+    common = sum(record_key in prior_records for record_key in newer_records)
+    return precheck_report(
+        len(newer_records) - common, len(prior_records) - common, common, 1, True
+    )
+
+
+def precheck_report(newer_only, prior_only, common, scale, exact):
+    """the precheck() report of the counts of a sample of the record keys of both
+    files, each standing for scale records"""
+
+    def missing_stats(missing, present):
+        """the missing share of a file's records with its 95% confidence interval"""
+        record_count = missing + present
+        fraction = missing / record_count if record_count else 0.0
+        margin = (
+            0.0
+            if exact or not record_count
+            else 1.96 * math.sqrt(fraction * (1 - fraction) / record_count)
+        )
+        return {
+            "COUNT": round(missing * scale),
+            "FRACTION": round(fraction, 5),
+            "LOW": round(max(fraction - margin, 0.0), 5),
+            "HIGH": round(min(fraction + margin, 1.0), 5),
+        }
+
+    return {
+        "EXACT": exact,
+        "NEWER_RECORD_COUNT": round((newer_only + common) * scale),
+        "PRIOR_RECORD_COUNT": round((prior_only + common) * scale),
+        "COMMON_RECORD_COUNT": round(common * scale),
+        # newer records the prior file is missing and the other way around, as the
+        # missing prior and missing newer record counts of the audit
+        "MISSING_PRIOR_RECORDS": missing_stats(newer_only, common),
+        "MISSING_NEWER_RECORDS": missing_stats(prior_only, common),
+    }
+
+
+def format_precheck(report):
+    """the lines printed for a precheck() report"""
+    about = "" if report["EXACT"] else "about "
+    lines = [
+        f"{about}{report['NEWER_RECORD_COUNT']:,} newer records",
+        f"{about}{report['PRIOR_RECORD_COUNT']:,} prior records",
+        f"{about}{report['COMMON_RECORD_COUNT']:,} records in both",
+    ]
+    for key, desc in (
+        ("MISSING_PRIOR_RECORDS", "newer records missing from the prior file"),
+        ("MISSING_NEWER_RECORDS", "prior records missing from the newer file"),
+    ):
+        missing = report[key]
+        line = f"{about}{missing['COUNT']:,} {desc}, {missing['FRACTION']:.2%}"
+        if not report["EXACT"]:
+            line += f" ({missing['LOW']:.2%} to {missing['HIGH']:.2%})"
+        lines.append(line)
+    return textwrap.indent("\n".join(lines), "    ") + "\n"
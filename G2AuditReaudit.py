@@ -0,0 +1,420 @@
+"""saves the state of an audit and updates it for a delta of moved records"""
+
+import os
+import argparse
+import csv
+import time
+import pickle
+import logging
+
+from G2AuditCommon import (
+    add_audit_arguments,
+    COMPRESSION_EXTENSIONS,
+    compute_record_key,
+    configure_logging,
+    new_performance,
+    padded_rows,
+    timed_phase,
+    TimedWriter,
+    write_pickle,
+)
+from G2AuditFiles import filter_entity_rows, open_input
+from G2AuditSinks import (
+    AUDIT_CSV_HEADERS,
+    BackgroundWriter,
+    close_audit_writer,
+    open_audit_writer,
+)
+from G2AuditStats import print_stat_pack, write_stat_pack
+from G2AuditCompare import (
+    AuditRows,
+    compare_map_entity,
+    data_source_stats,
+    new_audit_state,
+    OverlapMatrix,
+    report_audit_result,
+    tally_audit_result,
+)
+
+
+def save_audit_state(output_root, newer_map, prior_map, audit_state, **kwargs):
+    """saves the maps and counters of an audit to output_root.state for reaudit()
+    along with the name of its csv file and the data_sources the maps were loaded for"""
+    start_time = time.time()
+    write_pickle(
+        output_root + ".state",
+        {
+            "newer_map": newer_map,
+            "prior_map": prior_map,
+            "audit_state": audit_state,
+            "csv_file": os.path.abspath(
+                output_root
+                + ".csv"
+                + COMPRESSION_EXTENSIONS.get(kwargs.get("csv_compression"), "")
+            ),
+            "data_sources": kwargs.get("data_sources"),
+        },
+    )
+    logging.info(
+        f"audit state saved to {output_root}.state in {time.time() - start_time:.2f} seconds"
+    )
+
+
+def finish_audit(output_root, newer_map, prior_map, audit_state, performance, **kwargs):
+    """saves the audit state if save_state is set and writes the json file, printing
+    its main statistics unless quiet is set, returns the stat pack or None if the
+    state could not be saved"""
+    if kwargs.get("save_state"):
+        try:
+            with timed_phase(performance, "STATE_SAVE"):
+                save_audit_state(
+                    output_root,
+                    newer_map,
+                    prior_map,
+                    audit_state,
+                    csv_compression=kwargs.get("csv_compression"),
+                    data_sources=kwargs.get("data_sources"),
+                )
+        except Exception as err:
+            logging.error(f"{err} saving the audit state")
+            return None
+    stat_pack = write_stat_pack(
+        audit_state,
+        len(prior_map["entities"]),
+        len(newer_map["entities"]),
+        output_root + ".json",
+        performance,
+    )
+    if not kwargs.get("quiet"):
+        print_stat_pack(stat_pack, audit_state)
+    return stat_pack
+
+
+def read_delta_file(file_name):
+    """returns the (record key, old entity id, new entity id, match key) of each row of
+    a delta file, with None for the old entity id of an added record and for the new
+    entity id of a removed one"""
+    with open_input(file_name) as f:
+        reader = csv.reader(f)
+        field_names = [field_name.upper() for field_name in next(reader, [])]
+        if not {"DATA_SOURCE", "RECORD_ID", "NEW_ENTITY_ID"} <= set(field_names):
+            raise Exception(
+                f"Expected fields missing for {file_name}, need at least DATA_SOURCE, RECORD_ID and NEW_ENTITY_ID"
+            )
+        positions = [
+            field_names.index(field_name) if field_name in field_names else None
+            for field_name in (
+                "DATA_SOURCE",
+                "RECORD_ID",
+                "OLD_ENTITY_ID",
+                "NEW_ENTITY_ID",
+                "MATCH_KEY",
+            )
+        ]
+        delta_rows = []
+        for row in padded_rows(reader, positions):
+            old_entity_id, new_entity_id, match_key = (
+                row[pos] if pos is not None else "" for pos in positions[2:]
+            )
+            delta_rows.append(
+                (
+                    compute_record_key(row, None, positions[0], positions[1], None),
+                    old_entity_id or None,
+                    new_entity_id or None,
+                    match_key,
+                )
+            )
+    return delta_rows
+
+
+def affected_newer_entities(newer_map, prior_map, delta_rows):
+    """the newer entities whose audit results a delta can change
+
+    These are the newer entities the delta's records move out of and into and every
+    newer entity holding a record of a prior entity any of their records are in, as
+    only they can be compared to those prior entities before or after the delta.
+    """
+    newer_entity_ids = set()
+    record_keys = set()
+    for record_key, _, new_entity_id, _ in delta_rows:
+        record_keys.add(record_key)
+        if record_key in newer_map["records"]:
+            newer_entity_ids.add(newer_map["records"][record_key])
+        if new_entity_id:
+            newer_entity_ids.add(new_entity_id)
+    for newer_entity_id in newer_entity_ids:
+        record_keys.update(newer_map["entities"].get(newer_entity_id, ()))
+
+    prior_entity_ids = {
+        prior_map["records"][record_key]
+        for record_key in record_keys
+        if record_key in prior_map["records"]
+    }
+    for prior_entity_id in prior_entity_ids:
+        for prior_key in prior_map["entities"][prior_entity_id]:
+            if prior_key in newer_map["records"]:
+                newer_entity_ids.add(newer_map["records"][prior_key])
+    return newer_entity_ids
+
+
+def apply_delta(newer_map, delta_rows):
+    """moves the records of a delta to their new entities in the newer map, returns how
+    many of them weren't in the old entity the delta expected"""
+    mismatch_count = 0
+    for record_key, old_entity_id, new_entity_id, match_key in delta_rows:
+        current_entity_id = newer_map["records"].pop(record_key, None)
+        if old_entity_id is not None and old_entity_id != current_entity_id:
+            mismatch_count += 1
+        if current_entity_id is not None:
+            entity = newer_map["entities"][current_entity_id]
+            del entity[record_key]
+            if not entity:
+                del newer_map["entities"][current_entity_id]
+        if new_entity_id is not None:
+            newer_map["entities"].setdefault(new_entity_id, {})[record_key] = match_key
+            newer_map["records"][record_key] = new_entity_id
+    return mismatch_count
+
+
+def remove_audit_part(audit_state, part, newer_entity_ids):
+    """takes what the audit results of some newer entities added to an audit state back
+    out of it, part being a separate audit state they were tallied and logged to
+
+    The prior entities of the part are forgotten so the next results compared to them
+    count their pairs again, and the samples of the newer entities are dropped.
+    """
+    for counter in (
+        "newer_pair_count",
+        "prior_pair_count",
+        "common_entity_count",
+        "common_pair_count",
+        "missing_prior_record_cnt",
+        "missing_newer_record_cnt",
+    ):
+        audit_state[counter] -= part[counter]
+    for prior_entity_id in part["prior_entities"]:
+        audit_state["prior_entities"].pop(prior_entity_id, None)
+    for data_source, part_stats in part["data_sources"].items():
+        stats = data_source_stats(audit_state, data_source)
+        for counter, count in part_stats.items():
+            if counter != "audit_stats":
+                stats[counter] -= count
+        for audit_category, count in part_stats["audit_stats"].items():
+            stats["audit_stats"][audit_category] -= count
+            if not stats["audit_stats"][audit_category]:
+                del stats["audit_stats"][audit_category]
+    for match_key, (same_count, new_positive_count) in part["match_keys"].items():
+        match_key_count = audit_state["match_keys"][match_key]
+        match_key_count[0] -= same_count
+        match_key_count[1] -= new_positive_count
+        if match_key_count == [0, 0]:
+            del audit_state["match_keys"][match_key]
+    if part["sample_replicates"] is not None:
+        audit_state["sample_replicates"].merge(part["sample_replicates"], -1)
+
+    audit_stats = audit_state["audit_stats"]
+    for audit_category, part_category in part["audit_stats"].items():
+        audit_stats[audit_category]["COUNT"] -= part_category["COUNT"]
+        sub_categories = audit_stats[audit_category]["SUB_CATEGORY"]
+        for best_score, part_sub_category in part_category["SUB_CATEGORY"].items():
+            sub_categories[best_score]["COUNT"] -= part_sub_category["COUNT"]
+            if not sub_categories[best_score]["COUNT"]:
+                del sub_categories[best_score]
+        if not audit_stats[audit_category]["COUNT"]:
+            del audit_stats[audit_category]
+    for category_stats in audit_stats.values():
+        for sub_category_stats in category_stats["SUB_CATEGORY"].values():
+            sub_category_stats["SAMPLE"] = [
+                csv_rows
+                for csv_rows in sub_category_stats["SAMPLE"]
+                if csv_rows[0][7] not in newer_entity_ids
+            ]
+
+
+def copy_audit_rows(csv_file_name, csv_writer, newer_entity_ids):
+    """copies the audit rows of an earlier audit's csv file to the writer, less those
+    of the audit results of the newer entities, and returns how many were copied"""
+    row_count = 0
+    rows = []
+    with open_input(csv_file_name) as f:
+        reader = csv.reader(f)
+        if next(reader, None) != AUDIT_CSV_HEADERS:
+            raise Exception(f"{csv_file_name} is not an audit csv file")
+        audit_id = None
+        keep = False
+        for row in reader:
+            if row[0] != audit_id:
+                audit_id = row[0]
+                keep = row[7] not in newer_entity_ids
+            if keep:
+                row[0] = int(row[0])
+                rows.append(row)
+                if len(rows) == BackgroundWriter.batch_size:
+                    csv_writer.writerows(rows)
+                    row_count += len(rows)
+                    rows = []
+    csv_writer.writerows(rows)
+    return row_count + len(rows)
+
+
+def reaudit_entities(newer_map, prior_map, newer_entity_ids, audit_state, writer):
+    """audits the newer entities a delta affects, in entity id order, tallying them
+    in audit_state and reporting them to the writer"""
+    compare_options = {
+        "overlap_matrix": OverlapMatrix(newer_map, prior_map),
+        "sample_rate": audit_state["sample_rate"],
+    }
+    for newer_entity_id in sorted(newer_entity_ids):
+        if newer_entity_id in newer_map["entities"]:
+            audit_result = compare_map_entity(
+                newer_entity_id, newer_map, prior_map, **compare_options
+            )
+            if tally_audit_result(audit_state, audit_result):
+                report_audit_result(
+                    audit_state, audit_result, newer_map["relations"], writer
+                )
+
+
+def reaudit(state_file_name, delta_file_name, output_root, **kwargs):
+    """updates an audit saved with save_audit_state() for a delta of records that moved
+    to other newer entities and writes it to output_root, with its own state
+
+    Only the audit results of affected_newer_entities() are recomputed, taken out of
+    the counters as they were and added back as they are after the delta, so the
+    comparing goes with the size of the delta.  The I/O doesn't: the whole state is
+    loaded and saved again and the rest of the audit rows are copied from the earlier
+    csv, which goes with the size of the files.  The output_formats and
+    csv_compression options are those of audit().
+    """
+    performance = new_performance()
+    try:
+        with timed_phase(performance, "STATE_LOAD"):
+            with open(state_file_name, "rb") as f:
+                state = pickle.load(f)
+    except Exception as err:
+        logging.error(f"{err} loading {state_file_name}")
+        return 1
+    try:
+        with timed_phase(performance, "DELTA_LOAD"):
+            delta_rows = read_delta_file(delta_file_name)
+    except Exception as err:
+        logging.error(f"{err} reading {delta_file_name}")
+        return 1
+    newer_map, prior_map, audit_state = (
+        state["newer_map"],
+        state["prior_map"],
+        state["audit_state"],
+    )
+    if state["data_sources"] or audit_state["sample_rate"]:
+        # the changed records are kept or dropped as they were when the files loaded
+        kept_keys = {
+            entity_row[1]
+            for entity_row in filter_entity_rows(
+                ((None, delta_row[0], "", "0") for delta_row in delta_rows),
+                state["data_sources"],
+                audit_state["sample_rate"],
+            )
+        }
+        delta_rows = [
+            delta_row for delta_row in delta_rows if delta_row[0] in kept_keys
+        ]
+    if os.path.abspath(
+        output_root
+        + ".csv"
+        + COMPRESSION_EXTENSIONS.get(kwargs.get("csv_compression"), "")
+    ) == os.path.abspath(state["csv_file"]):
+        logging.error(f"{state['csv_file']} would be overwritten, use another -o")
+        return 1
+
+    try:
+        csv_writer = TimedWriter(open_audit_writer(output_root, **kwargs))
+    except Exception as err:
+        logging.error(f"{err} opening the audit output files")
+        return 1
+
+    with timed_phase(performance, "AUDIT_LOOP"):
+        newer_entity_ids = affected_newer_entities(newer_map, prior_map, delta_rows)
+        logging.info(
+            f"re-auditing {len(newer_entity_ids):,} of {len(newer_map['entities']):,} newer entities for {len(delta_rows):,} changed records"
+        )
+        part = new_audit_state(sample_rate=audit_state["sample_rate"])
+        reaudit_entities(newer_map, prior_map, newer_entity_ids, part, AuditRows())
+        remove_audit_part(audit_state, part, newer_entity_ids)
+
+        mismatch_count = apply_delta(newer_map, delta_rows)
+        if mismatch_count:
+            logging.warning(
+                f"{mismatch_count:,} changed records weren't in the old entity the delta gives, they were moved from the one they were in"
+            )
+        try:
+            row_count = copy_audit_rows(state["csv_file"], csv_writer, newer_entity_ids)
+        except Exception as err:
+            logging.error(f"{err} copying the audit rows of {state['csv_file']}")
+            csv_writer.close()
+            return 1
+        logging.info(f"{row_count:,} unchanged audit rows copied")
+
+        reaudit_entities(
+            newer_map, prior_map, newer_entity_ids, audit_state, csv_writer
+        )
+        if not close_audit_writer(csv_writer):
+            return 1
+    performance["PHASE_SECONDS"]["AUDIT_LOOP"] = round(
+        performance["PHASE_SECONDS"]["AUDIT_LOOP"] - csv_writer.seconds, 3
+    )
+    performance["PHASE_SECONDS"]["OUTPUT_WRITE"] = round(csv_writer.seconds, 3)
+    performance["REAUDITED_ENTITIES"] = len(newer_entity_ids)
+
+    stat_pack = finish_audit(
+        output_root,
+        newer_map,
+        prior_map,
+        audit_state,
+        performance,
+        save_state=True,
+        csv_compression=kwargs.get("csv_compression"),
+        data_sources=state["data_sources"],
+    )
+    return 0 if stat_pack is not None else 1
+
+
+def reaudit_command(argv):
+    """the reaudit command, updating a saved audit for a delta, argv being its arguments"""
+    reauditParser = argparse.ArgumentParser(
+        prog="G2Audit.py reaudit",
+        description="update an audit run with --save_state for a delta of records that moved to other newer entities",
+    )
+    reauditParser.add_argument(
+        "stateFile",
+        metavar="state_file",
+        help="the .state file of the audit to update",
+    )
+    reauditParser.add_argument(
+        "deltaFile",
+        metavar="delta_file",
+        help="csv of the changed records with DATA_SOURCE, RECORD_ID, OLD_ENTITY_ID, NEW_ENTITY_ID and an optional MATCH_KEY",
+    )
+    reauditParser.add_argument(
+        "-o",
+        "--output_file_root",
+        dest="outputRoot",
+        required=True,
+        help="the output file root name of the updated audit, it gets a .state file of its own too",
+    )
+    add_audit_arguments(reauditParser, "output_formats", "csv_compression", "debug")
+    args = reauditParser.parse_args(argv)
+    configure_logging(args.debug)
+    for inputFile in (args.stateFile, args.deltaFile):
+        if not os.path.exists(inputFile):
+            logging.error(f"{inputFile} was not found!")
+            return 1
+    if "csv" not in args.outputFormats.split(","):
+        logging.error("the csv output format is needed to update the audit again")
+        return 1
+    return reaudit(
+        args.stateFile,
+        args.deltaFile,
+        args.outputRoot,
+        output_formats=args.outputFormats.split(","),
+        csv_compression=args.csvCompression,
+    )
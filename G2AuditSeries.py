@@ -0,0 +1,227 @@
+"""audits a series of entity map snapshots"""
+
+import os
+import argparse
+import json
+import time
+import logging
+
+from G2AuditCommon import (
+    add_audit_arguments,
+    configure_logging,
+    display_name,
+    is_database_source,
+    new_performance,
+)
+from G2AuditFiles import row_filter_options
+from G2AuditMaps import load_from_file
+from G2AuditEngine import audit_maps
+
+
+SERIES_PAIR_STATS = (
+    "PRIOR_COUNT",
+    "NEWER_COUNT",
+    "COMMON_COUNT",
+    "PRECISION",
+    "RECALL",
+    "F1-SCORE",
+)
+
+
+def audit_series(file_names, output_root, **kwargs):
+    """audits a series of snapshot files, oldest first, loading each of them once
+
+    Each snapshot is compared to the one before it or, given the number of a baseline
+    snapshot counting from 1, every other snapshot is compared to the baseline.  The
+    audit of snapshots i and j goes to the files of output_root.i-j as usual, and
+    output_root.json gets the scores and audit counts of each comparison with how
+    much they changed since the one before.  A snapshot is dropped once no comparison
+    left needs it, and the record keys of all of them are interned in one dict.  The
+    other options are those of audit() without the checkpoints.
+    """
+    if kwargs.get("baseline"):
+        baseline = kwargs["baseline"] - 1
+        comparisons = [
+            (baseline, index) for index in range(len(file_names)) if index != baseline
+        ]
+    else:
+        comparisons = [(index - 1, index) for index in range(1, len(file_names))]
+    series = {
+        "SNAPSHOTS": [{"FILE": display_name(file_name)} for file_name in file_names],
+        "BASELINE": kwargs.get("baseline"),
+        "COMPARISONS": [],
+    }
+    record_keys = {}
+    file_maps = {}
+    previous = None
+    for comparison_number, (prior_index, newer_index) in enumerate(comparisons):
+        for index in (prior_index, newer_index):
+            if index in file_maps:
+                continue
+            start_time = time.time()
+            try:
+                file_maps[index] = load_from_file(
+                    file_names[index],
+                    (
+                        "newer"
+                        if index in (newer for _, newer in comparisons)
+                        else "prior"
+                    ),
+                    compact=kwargs.get("compact"),
+                    cache_dir=kwargs.get("cache_dir"),
+                    **row_filter_options(kwargs),
+                    record_keys=record_keys,
+                )
+            except Exception as err:
+                logging.error(f"{err} loading {display_name(file_names[index])}")
+                return 1
+            series["SNAPSHOTS"][index].update(
+                {
+                    "ENTITY_COUNT": len(file_maps[index]["entities"]),
+                    "RECORD_COUNT": len(file_maps[index]["records"]),
+                    "LOAD_SECONDS": round(time.time() - start_time, 3),
+                }
+            )
+
+        logging.info(
+            f"auditing snapshot {newer_index + 1} against snapshot {prior_index + 1} ..."
+        )
+        comparison_root = f"{output_root}.{prior_index + 1}-{newer_index + 1}"
+        stat_pack = audit_maps(
+            file_maps[newer_index],
+            file_maps[prior_index],
+            comparison_root,
+            new_performance(),
+            **kwargs,
+        )
+        if stat_pack is None:
+            return 1
+        comparison = {
+            "PRIOR": prior_index + 1,
+            "NEWER": newer_index + 1,
+            "OUTPUT_ROOT": comparison_root,
+            "PAIRS": {key: stat_pack["PAIRS"][key] for key in SERIES_PAIR_STATS},
+            "ENTITY": {
+                key: stat_pack["ENTITY"][key]
+                for key in ("PRIOR_COUNT", "NEWER_COUNT", "COMMON_COUNT")
+            },
+            "AUDIT": {
+                audit_category: category_stats["COUNT"]
+                for audit_category, category_stats in stat_pack["AUDIT"].items()
+            },
+            "AUDIT_SECONDS": stat_pack["PERFORMANCE"]["TOTAL_SECONDS"],
+        }
+        if previous:
+            comparison["CHANGE"] = {
+                "PAIRS": {
+                    key: round(comparison["PAIRS"][key] - previous["PAIRS"][key], 5)
+                    for key in ("PRECISION", "RECALL", "F1-SCORE")
+                },
+                "AUDIT": {
+                    audit_category: comparison["AUDIT"].get(audit_category, 0)
+                    - previous["AUDIT"].get(audit_category, 0)
+                    for audit_category in sorted(
+                        set(comparison["AUDIT"]) | set(previous["AUDIT"])
+                    )
+                },
+            }
+        series["COMPARISONS"].append(comparison)
+        previous = comparison
+
+        still_needed = {
+            index for pair in comparisons[comparison_number + 1 :] for index in pair
+        }
+        for index in list(file_maps):
+            if index not in still_needed:
+                del file_maps[index]
+
+    with open(output_root + ".json", "w") as f:
+        json.dump(series, f, indent=4)
+    print(format_series(series))
+    return 0
+
+
+def format_series(series):
+    """a table of the scores and split and merge counts of each comparison"""
+    audit_categories = ("SPLIT", "MERGE", "SPLIT+MERGE")
+    lines = [
+        f"{'prior':>5} {'newer':>5} {'precision':>10} {'recall':>10} {'f1-score':>10} "
+        + " ".join(
+            f"{audit_category.lower():>12}" for audit_category in audit_categories
+        )
+    ]
+    for comparison in series["COMPARISONS"]:
+        lines.append(
+            f"{comparison['PRIOR']:>5} {comparison['NEWER']:>5} "
+            + " ".join(
+                f"{comparison['PAIRS'][key]:>10.5f}"
+                for key in ("PRECISION", "RECALL", "F1-SCORE")
+            )
+            + " "
+            + " ".join(
+                f"{comparison['AUDIT'].get(audit_category, 0):>12,}"
+                for audit_category in audit_categories
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def series_command(argv):
+    """the series command, auditing a series of snapshots, argv being its arguments"""
+    seriesParser = argparse.ArgumentParser(
+        prog="G2Audit.py series",
+        description="audit a series of entity map snapshots, loading each of them once",
+    )
+    seriesParser.add_argument(
+        "snapshotFiles",
+        nargs="+",
+        metavar="entity_map_file",
+        help="the snapshots to audit, oldest first",
+    )
+    seriesParser.add_argument(
+        "-o",
+        "--output_file_root",
+        dest="outputRoot",
+        required=True,
+        help="the output file root name, each comparison gets its own .csv and .json files",
+    )
+    seriesParser.add_argument(
+        "--baseline",
+        dest="baseline",
+        type=int,
+        default=None,
+        help="number of the snapshot, counting from 1, to compare all the others to instead of each to the one before it",
+    )
+    add_audit_arguments(
+        seriesParser,
+        "compact",
+        "cache_dir",
+        "workers",
+        "numpy",
+        "one_to_one",
+        "data_sources",
+        "debug",
+    )
+    args = seriesParser.parse_args(argv)
+    configure_logging(args.debug)
+    if len(args.snapshotFiles) < 2:
+        logging.error("At least two snapshot files are needed")
+        return 1
+    if args.baseline is not None and not 1 <= args.baseline <= len(args.snapshotFiles):
+        logging.error(f"--baseline must be between 1 and {len(args.snapshotFiles)}")
+        return 1
+    for snapshotFile in args.snapshotFiles:
+        if not os.path.exists(snapshotFile) and not is_database_source(snapshotFile):
+            logging.error(f"{snapshotFile} was not found!")
+            return 1
+    return audit_series(
+        args.snapshotFiles,
+        args.outputRoot,
+        baseline=args.baseline,
+        compact=args.compact,
+        cache_dir=args.cacheDir,
+        workers=args.workers,
+        use_numpy=args.useNumpy,
+        one_to_one=args.oneToOne,
+        data_sources=(args.dataSources.split(",") if args.dataSources else None),
+    )
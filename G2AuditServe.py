@@ -0,0 +1,399 @@
+"""keeps prior entity maps loaded and audits the newer files posted to it"""
+
+import os
+import argparse
+import json
+import ipaddress
+import http.server
+import threading
+import logging
+
+from G2AuditCommon import (
+    add_audit_arguments,
+    COMPRESSION_EXTENSIONS,
+    configure_logging,
+    display_name,
+    is_database_source,
+    new_performance,
+    timed_phase,
+)
+from G2AuditFiles import row_filter_options
+from G2AuditMaps import load_from_file
+from G2AuditSinks import AUDIT_SINKS
+from G2AuditEngine import audit_maps
+
+
+class PriorMapCache:
+    """the prior maps a serve process keeps loaded, shared read only by its audits
+
+    A map is loaded the first time it is asked for and the least recently used one is
+    dropped once more than max_maps are loaded.  Maps are keyed on the file's path,
+    size and modification time (or a database source and its query) and the
+    data_sources and sample_rate options it was filtered with, so a changed file is
+    loaded again.  The compact and cache_dir options are those of load_from_file().
+    """
+
+    def __init__(self, max_maps=2, **kwargs):
+        self.max_maps = max_maps
+        self.load_options = kwargs
+        self.maps = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def map_key(self, file_name, **kwargs):
+        if is_database_source(file_name):
+            map_key = (file_name, kwargs.get("query"))
+        else:
+            file_stat = os.stat(file_name)
+            map_key = (
+                os.path.abspath(file_name),
+                file_stat.st_size,
+                file_stat.st_mtime_ns,
+            )
+        return map_key + (
+            tuple(sorted(kwargs.get("data_sources") or ())),
+            kwargs.get("sample_rate"),
+        )
+
+    def get(self, file_name, **kwargs):
+        """the map of a prior file, loading it once however many audits ask at the same time"""
+        map_key = self.map_key(file_name, **kwargs)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(map_key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                prior_map = self.maps.pop(map_key, None)
+                if prior_map is not None:
+                    self.maps[map_key] = prior_map  # now the most recently used
+                    return prior_map
+            try:
+                prior_map = load_from_file(
+                    file_name,
+                    "prior",
+                    compact=self.load_options.get("compact"),
+                    cache_dir=self.load_options.get("cache_dir"),
+                    query=kwargs.get("query"),
+                    **row_filter_options(kwargs),
+                )
+            except Exception:
+                with self.lock:
+                    self.key_locks.pop(map_key, None)
+                raise
+            with self.lock:
+                self.maps[map_key] = prior_map
+                while len(self.maps) > self.max_maps:
+                    evicted_key = next(iter(self.maps))
+                    del self.maps[evicted_key]
+                    # a file's key changes with every edit, so don't keep its lock
+                    self.key_locks.pop(evicted_key, None)
+                    logging.info(
+                        f"dropped the prior map of {display_name(evicted_key[0])}"
+                    )
+            return prior_map
+
+    def loaded(self):
+        """the file names and sizes of the loaded maps, least recently used first"""
+        with self.lock:
+            return [
+                {
+                    "PRIOR_FILE": display_name(map_key[0]),
+                    "DATA_SOURCES": list(map_key[-2]) or None,
+                    "SAMPLE_RATE": map_key[-1],
+                    "ENTITY_COUNT": len(prior_map["entities"]),
+                    "RECORD_COUNT": len(prior_map["records"]),
+                }
+                for map_key, prior_map in self.maps.items()
+            ]
+
+
+# the audit() options a serve request may set and the json type each one takes
+SERVE_OPTIONS = {
+    "compact": bool,
+    "use_numpy": bool,
+    "one_to_one": bool,
+    "data_sources": list,
+    "sample_rate": float,
+    "newer_query": str,
+    "output_formats": list,
+    "csv_compression": str,
+    "sample_size": int,
+    "sample_rows": int,
+    "sample_seed": int,
+}
+
+SERVE_TYPE_NAMES = {
+    bool: "true or false",
+    list: "a list of strings",
+    float: "a number",
+    str: "a string",
+    int: "an integer",
+}
+
+
+def serve_request_options(request):
+    """the SERVE_OPTIONS of a serve request, checked the way the command line checks
+    them, raises ValueError for one of the wrong type or out of range
+
+    The lists may also be given as comma separated strings like on the command line.
+    """
+    options = {}
+    for option, option_type in SERVE_OPTIONS.items():
+        value = request.get(option)
+        if value is None:
+            continue
+        if option_type is list and isinstance(value, str):
+            value = value.split(",")
+        if option_type is float and isinstance(value, int):
+            value = float(value)
+        if (
+            not isinstance(value, option_type)
+            or (option_type is int and isinstance(value, bool))
+            or (option_type is list and not all(isinstance(v, str) for v in value))
+        ):
+            raise ValueError(f"{option} must be {SERVE_TYPE_NAMES[option_type]}")
+        options[option] = value
+    if "sample_rate" in options and not 0 < options["sample_rate"] < 1:
+        raise ValueError("sample_rate must be above 0 and below 1")
+    for option in ("sample_size", "sample_rows"):
+        if options.get(option, 0) < 0:
+            raise ValueError(f"{option} can't be negative")
+    unknown_formats = set(options.get("output_formats", [])) - set(AUDIT_SINKS)
+    if unknown_formats:
+        raise ValueError(
+            f"unknown output format {', '.join(sorted(unknown_formats))}, use {', '.join(AUDIT_SINKS)}"
+        )
+    if options.get("csv_compression") not in (None, *COMPRESSION_EXTENSIONS):
+        raise ValueError(
+            f"csv_compression must be one of {', '.join(sorted(COMPRESSION_EXTENSIONS))}"
+        )
+    return options
+
+
+def serve_path(root_dir, file_name):
+    """the real path of a file a serve request names, relative ones being taken from
+    the root_dir, raises ValueError if it is outside the root_dir"""
+    path = os.path.realpath(os.path.join(root_dir, file_name))
+    if os.path.commonpath([path, root_dir]) != root_dir:
+        raise ValueError(f"{file_name} is outside {root_dir}")
+    return path
+
+
+def serve_audit(prior_maps, request, root_dir, prior_files=()):
+    """audits the newer file of a serve request against its prior file's cached map
+
+    The request has the newer_file, prior_file and output_root and any of the
+    SERVE_OPTIONS of audit().  The files must be in the root_dir, but for a prior
+    file the server was started with.  Returns the http status and the response,
+    which has the output file names and the stat pack of the json file or else the
+    error.
+    """
+    for field in ("newer_file", "prior_file", "output_root"):
+        if not request.get(field):
+            return 400, {"error": f"{field} is missing"}
+    for field in ("newer_file", "prior_file", "output_root", "prior_query"):
+        if not isinstance(request.get(field, ""), str):
+            return 400, {"error": f"{field} must be {SERVE_TYPE_NAMES[str]}"}
+    try:
+        options = serve_request_options(request)
+        newer_file = serve_path(root_dir, request["newer_file"])
+        prior_file = request["prior_file"]
+        if prior_file not in prior_files:
+            prior_file = serve_path(root_dir, prior_file)
+        output_root = serve_path(root_dir, request["output_root"])
+    except ValueError as err:
+        return 400, {"error": str(err)}
+    performance = new_performance()
+    try:
+        with timed_phase(performance, "PRIOR_LOAD"):
+            prior_map = prior_maps.get(
+                prior_file,
+                query=request.get("prior_query"),
+                **row_filter_options(options),
+            )
+        with timed_phase(performance, "NEWER_LOAD"):
+            newer_map = load_from_file(
+                newer_file,
+                "newer",
+                compact=options.get("compact"),
+                query=options.get("newer_query"),
+                **row_filter_options(options),
+            )
+    except Exception as err:
+        logging.error(f"{err} loading files")
+        return 400, {"error": f"{err} loading files"}
+
+    if (
+        audit_maps(
+            newer_map, prior_map, output_root, performance, quiet=True, **options
+        )
+        is None
+    ):
+        return 500, {"error": "the audit output files could not be written"}
+    with open(output_root + ".json") as f:
+        stat_pack = json.load(f)
+    return 200, {
+        "csv_file": (
+            output_root
+            + ".csv"
+            + COMPRESSION_EXTENSIONS.get(options.get("csv_compression"), "")
+            if "csv" in (options.get("output_formats") or ["csv"])
+            else None
+        ),
+        "json_file": output_root + ".json",
+        "stat_pack": stat_pack,
+    }
+
+
+class AuditRequestHandler(http.server.BaseHTTPRequestHandler):
+    """POST /audit runs serve_audit() on the json request body, GET /priors lists the
+    loaded prior maps"""
+
+    def do_GET(self):
+        if self.path != "/priors":
+            self.send_json(404, {"error": f"{self.path} not found"})
+            return
+        self.send_json(200, self.server.prior_maps.loaded())
+
+    def do_POST(self):
+        if self.path != "/audit":
+            self.send_json(404, {"error": f"{self.path} not found"})
+            return
+        try:
+            request = json.loads(
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            )
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a json object")
+        except ValueError as err:
+            self.send_json(400, {"error": f"{err} reading the request"})
+            return
+        try:
+            status, response = serve_audit(
+                self.server.prior_maps,
+                request,
+                self.server.root_dir,
+                self.server.prior_files,
+            )
+        except Exception as err:
+            logging.error(f"{err} auditing {request.get('newer_file')}")
+            status, response = 500, {"error": f"{err} auditing the newer file"}
+        self.send_json(status, response)
+
+    def send_json(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def serve(host, port, **kwargs):
+    """audits the newer files posted to http://host:port/audit, each on a thread of
+    its own, against prior maps kept loaded between them
+
+    The prior_files are loaded up front and at most max_priors maps are kept, see
+    PriorMapCache for the compact and cache_dir options.  Requests can only name
+    files in the root_dir, which defaults to the current directory, or the
+    prior_files.
+    """
+    prior_maps = PriorMapCache(
+        kwargs.get("max_priors") or 2,
+        compact=kwargs.get("compact"),
+        cache_dir=kwargs.get("cache_dir"),
+    )
+    try:
+        for prior_file in kwargs.get("prior_files") or []:
+            prior_maps.get(prior_file)
+        server = http.server.ThreadingHTTPServer((host, port), AuditRequestHandler)
+    except Exception as err:
+        logging.error(f"{err} starting the audit server")
+        return 1
+    server.prior_maps = prior_maps
+    server.prior_files = set(kwargs.get("prior_files") or [])
+    server.root_dir = os.path.realpath(kwargs.get("root_dir") or ".")
+    if not ipaddress.ip_address(server.server_address[0]).is_loopback:
+        logging.warning(
+            f"{host} is not a loopback address and the audit server has no authentication, anyone who can reach it can audit and write files in {server.root_dir}"
+        )
+    logging.info(f"serving audits on http://{host}:{server.server_port}/audit")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("stopping the audit server")
+    finally:
+        server.server_close()
+    return 0
+
+
+def serve_command(argv):
+    """the serve command, auditing the newer files posted to it, argv being its arguments"""
+    serveParser = argparse.ArgumentParser(
+        prog="G2Audit.py serve",
+        description="keep prior entity maps loaded and audit the newer files posted to http://host:port/audit",
+    )
+    serveParser.add_argument(
+        "--host",
+        dest="host",
+        default="127.0.0.1",
+        help="the address to listen on, default=127.0.0.1",
+    )
+    serveParser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=8250,
+        help="the port to listen on, default=8250",
+    )
+    serveParser.add_argument(
+        "-p",
+        "--prior_csv_file",
+        dest="priorFiles",
+        action="append",
+        default=[],
+        help="a prior entity map file to load up front, may be given more than once",
+    )
+    serveParser.add_argument(
+        "--root_dir",
+        dest="rootDir",
+        default=".",
+        help="the directory the files of a request have to be in, relative ones are taken from it, default=the current directory",
+    )
+    serveParser.add_argument(
+        "--max_priors",
+        dest="maxPriors",
+        type=int,
+        default=2,
+        help="most prior maps to keep loaded, the least recently used is dropped, default=2",
+    )
+    serveParser.add_argument(
+        "--compact",
+        dest="compact",
+        action="store_true",
+        default=False,
+        help="load the prior entity maps into compact arrays to use far less memory (but run slower)",
+    )
+    serveParser.add_argument(
+        "--cache_dir",
+        dest="cacheDir",
+        default=None,
+        help="directory to cache the parsed prior files in so they can be memory mapped",
+    )
+    add_audit_arguments(serveParser, "debug")
+    args = serveParser.parse_args(argv)
+    configure_logging(args.debug)
+    if args.maxPriors < 1:
+        logging.error("--max_priors must be at least 1")
+        return 1
+    return serve(
+        args.host,
+        args.port,
+        prior_files=args.priorFiles,
+        max_priors=args.maxPriors,
+        compact=args.compact,
+        cache_dir=args.cacheDir,
+        root_dir=args.rootDir,
+    )
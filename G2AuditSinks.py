@@ -0,0 +1,273 @@
+"""writes the audit rows to csv, parquet or sqlite files"""
+
+import os
+import csv
+import queue
+import sqlite3
+import threading
+import logging
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from G2AuditCommon import COMPRESSION_EXTENSIONS
+from G2AuditFiles import open_output
+
+
+AUDIT_CSV_HEADERS = [
+    "audit_id",
+    "audit_category",
+    "audit_result",
+    "data_source",
+    "record_id",
+    "prior_id",
+    "prior_score",
+    "newer_id",
+    "newer_score",
+]
+
+
+class CsvSink:
+    """writes the audit rows to the .csv file, compressed if csv_compression is set"""
+
+    def __init__(self, output_root, **kwargs):
+        compression = kwargs.get("csv_compression")
+        self.file_name = (
+            output_root + ".csv" + COMPRESSION_EXTENSIONS.get(compression, "")
+        )
+        csv_offset = kwargs.get("csv_offset")
+        if csv_offset is None:
+            self.handle = open_output(self.file_name, compression)
+            self.csv_writer = csv.writer(self.handle)
+            self.csv_writer.writerow(AUDIT_CSV_HEADERS)
+        else:
+            # resuming, so drop any rows written after the checkpoint
+            if not os.path.exists(self.file_name):
+                raise Exception(f"{self.file_name} is missing")
+            if os.path.getsize(self.file_name) < csv_offset:
+                raise Exception(f"{self.file_name} is shorter than at its checkpoint")
+            os.truncate(self.file_name, csv_offset)
+            self.handle = open(self.file_name, "a")
+            self.csv_writer = csv.writer(self.handle)
+
+    def writerows(self, rows):
+        self.csv_writer.writerows(rows)
+
+    def checkpoint(self):
+        """syncs the rows written so far to disk and returns the file offset after them"""
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        return self.handle.tell()
+
+    def close(self):
+        self.handle.close()
+
+
+class ParquetSink:
+    """writes the audit rows to a .parquet file in row groups of row_group_size
+
+    audit_category, audit_result and data_source are dictionary encoded so tools read
+    them back as categories.
+    """
+
+    row_group_size = 128 * 1024
+    dictionary_columns = ("audit_category", "audit_result", "data_source")
+
+    def __init__(self, output_root, **kwargs):
+        if pyarrow is None:
+            raise Exception("pyarrow is needed for parquet output, pip install pyarrow")
+        self.file_name = output_root + ".parquet"
+        self.schema = pyarrow.schema(
+            [
+                (
+                    column_name,
+                    (
+                        pyarrow.int64()
+                        if column_name == "audit_id"
+                        else (
+                            pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+                            if column_name in self.dictionary_columns
+                            else pyarrow.string()
+                        )
+                    ),
+                )
+                for column_name in AUDIT_CSV_HEADERS
+            ]
+        )
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(
+            self.file_name,
+            self.schema,
+            use_dictionary=list(self.dictionary_columns),
+            compression=kwargs.get("parquet_compression") or "zstd",
+        )
+        self.rows = []
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        columns = []
+        for field, values in zip(self.schema, zip(*self.rows)):
+            if pyarrow.types.is_dictionary(field.type):
+                columns.append(
+                    pyarrow.array(values, pyarrow.string()).dictionary_encode()
+                )
+            else:
+                columns.append(pyarrow.array(values, field.type))
+        self.parquet_writer.write_table(
+            pyarrow.Table.from_arrays(columns, schema=self.schema)
+        )
+        self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.write_row_group()
+        self.parquet_writer.close()
+
+
+class SqliteSink:
+    """writes the audit rows to the audit table of a .db sqlite database
+
+    The indexes are built once all the rows are in, which is much faster than keeping
+    them up to date row by row.
+    """
+
+    index_columns = [
+        ("audit_id",),
+        ("data_source", "audit_category"),
+        ("record_id", "data_source"),
+        ("prior_id",),
+        ("newer_id",),
+    ]
+
+    def __init__(self, output_root, **kwargs):
+        self.file_name = output_root + ".db"
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+        # opened here but written by the BackgroundWriter thread
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        self.connection.execute("pragma journal_mode = off")
+        self.connection.execute("pragma synchronous = off")
+        self.connection.execute(
+            f"create table audit (audit_id integer, {', '.join(column_name + ' text' for column_name in AUDIT_CSV_HEADERS[1:])})"
+        )
+        self.insert_sql = (
+            f"insert into audit values ({', '.join('?' * len(AUDIT_CSV_HEADERS))})"
+        )
+
+    def writerows(self, rows):
+        self.connection.executemany(self.insert_sql, rows)
+
+    def close(self):
+        for column_names in self.index_columns:
+            self.connection.execute(
+                f"create index audit_{'_'.join(column_names)} on audit ({', '.join(column_names)})"
+            )
+        self.connection.commit()
+        self.connection.close()
+
+
+AUDIT_SINKS = {"csv": CsvSink, "parquet": ParquetSink, "sqlite": SqliteSink}
+
+
+class BackgroundWriter:
+    """hands the audit rows to the output sinks on a background thread
+
+    Rows are passed over in batches through a bounded queue so the audit only waits
+    for the sinks when they fall queue_size batches behind.  An error in a sink is
+    raised by the next flush(), checkpoint() or by close().
+    """
+
+    batch_size = 4096
+    queue_size = 64
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.rows = []
+        self.batches = queue.Queue(self.queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_batches, daemon=True)
+        self.thread.start()
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.error:
+            raise self.error
+        self.batches.put(self.rows)
+        self.rows = []
+
+    def checkpoint(self):
+        """waits for the sinks to write every row so far and returns where each is up to"""
+        self.flush()
+        self.batches.join()
+        if self.error:
+            raise self.error
+        return [sink.checkpoint() for sink in self.sinks]
+
+    def write_batches(self):
+        while True:
+            rows = self.batches.get()
+            if rows is None:
+                return
+            try:
+                if self.error:
+                    continue  # keeps taking batches so the audit is never blocked
+                for sink in self.sinks:
+                    sink.writerows(rows)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.batches.task_done()
+
+    def close(self):
+        if self.rows:
+            self.batches.put(self.rows)
+            self.rows = []
+        self.batches.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as err:
+                self.error = self.error or err
+        if self.error:
+            raise self.error
+
+
+def open_audit_writer(output_root, **kwargs):
+    """opens a sink for each of the output_formats behind a BackgroundWriter"""
+    sinks = []
+    try:
+        for output_format in kwargs.get("output_formats") or ["csv"]:
+            if output_format not in AUDIT_SINKS:
+                raise Exception(
+                    f"unknown output format {output_format}, use {', '.join(AUDIT_SINKS)}"
+                )
+            sinks.append(AUDIT_SINKS[output_format](output_root, **kwargs))
+    except Exception:
+        for sink in sinks:
+            sink.close()
+        raise
+    return BackgroundWriter(sinks)
+
+
+def close_audit_writer(csv_writer):
+    """closes the writer of an audit's output files, logging why if it fails"""
+    try:
+        csv_writer.close()
+    except Exception as err:
+        logging.error(f"{err} writing the audit output files")
+        return False
+    return True
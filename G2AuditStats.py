@@ -0,0 +1,467 @@
+"""the statistics of the json file and the samples they keep"""
+
+import os
+import json
+import math
+import time
+import random
+import tempfile
+import textwrap
+
+from G2AuditCommon import pair_count, peak_rss_mb
+from G2AuditFiles import SAMPLE_GROUPS
+from G2AuditSinks import AUDIT_CSV_HEADERS
+
+
+class ReservoirSampler:
+    """keeps a uniform random sample of the audit results of each sub category
+
+    This is reservoir sampling (algorithm R): the n-th result replaces a random slot
+    with probability sample_size / n, so every result is equally likely to be kept
+    however many there are.  The random generator is seeded so a rerun keeps the
+    same samples, and a sample keeps at most max_rows csv rows (0 keeps all of them)
+    so a giant entity can't blow up the memory used.
+    """
+
+    def __init__(self, sample_size=None, max_rows=None, seed=None):
+        self.sample_size = 500 if sample_size is None else sample_size
+        self.max_rows = max_rows or 0
+        self.random = random.Random(1 if seed is None else seed)
+
+    def add(self, samples, seen_count, audit_sample):
+        """offers the seen_count-th audit sample of a sub category to its samples"""
+        if len(samples) < self.sample_size:
+            samples.append(self.capped(audit_sample))
+        else:
+            slot = self.random.randrange(seen_count)
+            if slot < self.sample_size:
+                samples[slot] = self.capped(audit_sample)
+
+    def capped(self, audit_sample):
+        return audit_sample[: self.max_rows] if self.max_rows else audit_sample
+
+
+class PairReplicates:
+    """the newer, prior and common pair counts of a sample_rate sample with each of the
+    SAMPLE_GROUPS hash ranges of its records left out in turn, for its confidence
+    intervals
+
+    The records of a hash range are a random 1 / SAMPLE_GROUPS of the sample, so
+    leaving them out is like drawing another hash sample at a slightly lower rate.
+    How much the estimates of these replicates differ gives the variance of the
+    estimates from the whole sample (a delete-a-group jackknife).  A pair is only in
+    the sample when both its records are, so the pair counts are scaled up by
+    1 / rate**2, and the precision, recall and f1-score are worked out for each
+    replicate from its pair counts.  Only the pairs each range takes away are kept.
+    """
+
+    # the t distribution's 97.5th percentile for SAMPLE_GROUPS - 1 degrees of freedom
+    t_score = 2.0096
+
+    def __init__(self):
+        self.losses = [[0, 0, 0] for _ in range(SAMPLE_GROUPS)]
+
+    def add(self, column, group_counts):
+        """takes the pairs of an entity with group_counts records in each hash range
+        from the replicates leaving those ranges out, column being 0 for its newer
+        pairs, 1 for prior pairs and 2 for common pairs"""
+        record_count = sum(group_counts.values())
+        for group, count in group_counts.items():
+            self.losses[group][column] += pair_count(record_count) - pair_count(
+                record_count - count
+            )
+
+    def merge(self, other, sign=1):
+        """adds, or with a sign of -1 takes away, the losses of other replicates"""
+        for losses, other_losses in zip(self.losses, other.losses):
+            for i, loss in enumerate(other_losses):
+                losses[i] += sign * loss
+
+    def estimates(self, pair_counts, sample_rate):
+        """the SAMPLE_ESTIMATES of the json file from the newer, prior and common
+        pair counts of the whole sample, with 95% confidence intervals"""
+        replicates = [
+            [pair_counts[i] - losses[i] for i in range(3)] for losses in self.losses
+        ]
+        # a replicate is a sample at (SAMPLE_GROUPS - 1) / SAMPLE_GROUPS of the rate
+        replicate_scale = (SAMPLE_GROUPS / (SAMPLE_GROUPS - 1) / sample_rate) ** 2
+        estimates = {"SAMPLE_RATE": sample_rate, "CONFIDENCE_LEVEL": 0.95}
+        for name, column in (
+            ("PRIOR_COUNT", 1),
+            ("NEWER_COUNT", 0),
+            ("COMMON_COUNT", 2),
+        ):
+            estimate = pair_counts[column] / sample_rate**2
+            margin = self.margin(
+                [counts[column] * replicate_scale for counts in replicates]
+            )
+            estimates[name] = {
+                "ESTIMATE": round(estimate),
+                "LOW": round(max(estimate - margin, 0)),
+                "HIGH": round(estimate + margin),
+            }
+        # most pairs agree, so the few that don't make the scores skewed, and their
+        # intervals are worked out on the log odds scale to follow that
+        for name, numerator, denominator in (
+            ("PRECISION", lambda counts: counts[2], lambda counts: counts[0]),
+            ("RECALL", lambda counts: counts[2], lambda counts: counts[1]),
+            (
+                "F1-SCORE",
+                lambda counts: 2 * counts[2],
+                lambda counts: counts[0] + counts[1],
+            ),
+        ):
+            estimate = ratio(numerator(pair_counts), denominator(pair_counts))
+            center = log_odds(numerator(pair_counts), denominator(pair_counts))
+            margin = self.margin(
+                [
+                    log_odds(numerator(counts), denominator(counts))
+                    for counts in replicates
+                ]
+            )
+            estimates[name] = {
+                "ESTIMATE": round(estimate, 5),
+                "LOW": round(min(inverse_log_odds(center - margin), estimate), 5),
+                "HIGH": round(max(inverse_log_odds(center + margin), estimate), 5),
+            }
+        return estimates
+
+    def margin(self, replicate_values):
+        """the jackknife margin of error of an estimate from its replicate values"""
+        mean = sum(replicate_values) / SAMPLE_GROUPS
+        return self.t_score * math.sqrt(
+            (SAMPLE_GROUPS - 1)
+            / SAMPLE_GROUPS
+            * sum((value - mean) ** 2 for value in replicate_values)
+        )
+
+
+def log_odds(numerator, denominator):
+    """the log odds of a ratio of sampled pair counts, with half a pair added to both
+    sides so a ratio of 0 or 1 has one too"""
+    return math.log((numerator + 0.5) / (denominator - numerator + 0.5))
+
+
+def inverse_log_odds(value):
+    return 1 / (1 + math.exp(-value))
+
+
+def ratio(numerator, denominator):
+    return numerator / denominator if denominator else 0
+
+
+def format_estimates(estimates):
+    """the lines printed for the SAMPLE_ESTIMATES of an audit or statistic check"""
+    lines = [
+        f"estimated from a {estimates['SAMPLE_RATE']} sample of the records with {estimates['CONFIDENCE_LEVEL']:.0%} confidence intervals:"
+    ]
+    for name, label in (
+        ("PRIOR_COUNT", "prior pairs"),
+        ("NEWER_COUNT", "newer pairs"),
+        ("COMMON_COUNT", "common pairs"),
+        ("PRECISION", "precision"),
+        ("RECALL", "recall"),
+        ("F1-SCORE", "f1-score"),
+    ):
+        estimate = estimates[name]
+        lines.append(
+            f"{estimate['ESTIMATE']} {label} ({estimate['LOW']} to {estimate['HIGH']})"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def write_stat_pack(
+    audit_state,
+    prior_entity_count,
+    newer_entity_count,
+    json_file_name,
+    performance=None,
+):
+    stat_pack = compute_stat_pack(audit_state, prior_entity_count, newer_entity_count)
+    start_time = time.time()
+    with open(json_file_name, "w") as f:
+        json_chunks = iter_json(stat_pack)
+        closing_chunk = next(json_chunks)
+        for json_chunk in json_chunks:
+            f.write(closing_chunk)
+            closing_chunk = json_chunk
+        if performance is not None:
+            # the rest of the file is timed first so its time can go in the file
+            performance["PHASE_SECONDS"]["JSON_DUMP"] = round(
+                time.time() - start_time, 3
+            )
+            performance["TOTAL_SECONDS"] = round(
+                sum(performance["PHASE_SECONDS"].values()), 3
+            )
+            performance["PEAK_RSS_MB"] = peak_rss_mb()
+            stat_pack["PERFORMANCE"] = performance
+            f.write(', "PERFORMANCE": ' + json.dumps(performance))
+        f.write(closing_chunk)
+
+    return stat_pack
+
+
+def print_stat_pack(stat_pack, audit_state):
+    """prints the main statistics of an audit"""
+    print(
+        textwrap.dedent(
+            f"""\
+
+    {stat_pack['PAIRS']['PRIOR_COUNT']} prior pairs
+    {stat_pack['PAIRS']['NEWER_COUNT']} newer pairs
+    {stat_pack['PAIRS']['COMMON_COUNT']} common pairs
+
+    {stat_pack['PAIRS']['SAME_POSITIVE']} same positives
+    {stat_pack['PAIRS']['NEW_POSITIVE']} new positives
+    {stat_pack['PAIRS']['NEW_NEGATIVE']} new negatives
+    {stat_pack['PAIRS']['PRECISION']} precision
+    {stat_pack['PAIRS']['RECALL']} recall
+    {stat_pack['PAIRS']['F1-SCORE']} f1-score
+
+    {stat_pack['ENTITY']['PRIOR_COUNT']} prior entities
+    {stat_pack['ENTITY']['NEWER_COUNT']} new entities
+    {stat_pack['ENTITY']['COMMON_COUNT']} common entities
+    {stat_pack['AUDIT'].get('MERGE', {}).get('COUNT', 0)} merged entities
+    {stat_pack['AUDIT'].get('SPLIT', {}).get('COUNT', 0)} split entities
+    {stat_pack['AUDIT'].get('SPLIT+MERGE', {}).get('COUNT', 0)} split+merge entities
+
+    """
+        )
+    )
+    if (
+        audit_state["missing_prior_record_cnt"]
+        or audit_state["missing_newer_record_cnt"]
+    ):
+        print(f"{audit_state['missing_prior_record_cnt']} missing prior records")
+        print(f"{audit_state['missing_newer_record_cnt']} missing newer records")
+        print()
+    if "SAMPLE_ESTIMATES" in stat_pack:
+        print(format_estimates(stat_pack["SAMPLE_ESTIMATES"]))
+
+
+def compute_stat_pack(audit_state, prior_entity_count, newer_entity_count):
+    """the statistics of the json file, with the SAMPLE lists still holding csv rows"""
+    common_entity_count = audit_state["common_entity_count"]
+    entity_precision = (
+        round(common_entity_count + 0.0 / newer_entity_count + 0.0, 5)
+        if newer_entity_count
+        else 0
+    )
+    entity_recall = (
+        round(common_entity_count + 0.0 / newer_entity_count + 0.0, 5)
+        if prior_entity_count
+        else 0
+    )
+    entity_f1_score = (
+        round(
+            2 * (entity_precision * entity_recall) / (entity_precision + entity_recall),
+            5,
+        )
+        if entity_precision or entity_recall
+        else 0
+    )
+
+    stat_pack = {
+        "SOURCE": "G2Audit",
+        "ENTITY": {
+            "PRIOR_COUNT": prior_entity_count,
+            "NEWER_COUNT": newer_entity_count,
+            "COMMON_COUNT": common_entity_count,
+            "PRECISION": entity_precision,
+            "RECALL": entity_recall,
+            "F1-SCORE": entity_f1_score,
+        },
+        "PAIRS": compute_pair_stats(
+            audit_state["prior_pair_count"],
+            audit_state["newer_pair_count"],
+            audit_state["common_pair_count"],
+        ),
+        "AUDIT": audit_state["audit_stats"],
+        "DATA_SOURCES": {
+            data_source: {
+                "ENTITY": {"COMMON_COUNT": stats["common_entity_count"]},
+                "PAIRS": compute_pair_stats(
+                    stats["prior_pair_count"],
+                    stats["newer_pair_count"],
+                    stats["common_pair_count"],
+                ),
+                "AUDIT": {
+                    audit_category: {"COUNT": count}
+                    for audit_category, count in stats["audit_stats"].items()
+                },
+            }
+            for data_source, stats in sorted(audit_state["data_sources"].items())
+        },
+        "MATCH_KEYS": {
+            match_key: {
+                "SAME_RECORD_COUNT": same_count,
+                "NEW_POSITIVE_RECORD_COUNT": new_positive_count,
+                "SAME_RECORD_FRACTION": round(
+                    same_count / (same_count + new_positive_count), 5
+                ),
+            }
+            for match_key, (same_count, new_positive_count) in sorted(
+                audit_state["match_keys"].items()
+            )
+        },
+    }
+    if audit_state["sample_replicates"] is not None:
+        stat_pack["SAMPLE_ESTIMATES"] = audit_state["sample_replicates"].estimates(
+            [
+                audit_state["newer_pair_count"],
+                audit_state["prior_pair_count"],
+                audit_state["common_pair_count"],
+            ],
+            audit_state["sample_rate"],
+        )
+    return stat_pack
+
+
+def compute_pair_stats(prior_pair_count, newer_pair_count, common_pair_count):
+    """the PAIRS statistics of the json file from the pair counts"""
+    pair_same_positive = common_pair_count
+    pair_new_positive = (
+        newer_pair_count - common_pair_count
+        if newer_pair_count > common_pair_count
+        else 0
+    )
+    pair_new_negative = (
+        prior_pair_count - common_pair_count
+        if prior_pair_count > common_pair_count
+        else 0
+    )
+    pair_precision = (
+        round(pair_same_positive / (pair_same_positive + pair_new_positive), 5)
+        if pair_same_positive + pair_new_positive > 0
+        else 0
+    )
+    pair_recall = (
+        round(pair_same_positive / (pair_same_positive + pair_new_negative), 5)
+        if pair_same_positive + pair_new_negative > 0
+        else 0
+    )
+    pair_f1_score = (
+        round((2 * pair_precision * pair_recall) / (pair_precision + pair_recall), 5)
+        if pair_precision + pair_recall > 0
+        else 0
+    )
+
+    return {
+        "PRIOR_COUNT": prior_pair_count,
+        "NEWER_COUNT": newer_pair_count,
+        "COMMON_COUNT": common_pair_count,
+        "SAME_POSITIVE": pair_same_positive,
+        "NEW_POSITIVE": pair_new_positive,
+        "NEW_NEGATIVE": pair_new_negative,
+        "PRECISION": pair_precision,
+        "RECALL": pair_recall,
+        "F1-SCORE": pair_f1_score,
+    }
+
+
+def iter_json(value, key=None):
+    """yields the json of a value in small pieces, formatted as json.dumps() would
+
+    The audit SAMPLE lists hold csv rows to save memory, they are written as the lists
+    of dicts keyed on AUDIT_CSV_HEADERS they stand for one sample at a time.
+    """
+    if isinstance(value, dict):
+        separator = "{"
+        for item_key, item in value.items():
+            if not isinstance(item_key, str):
+                item_key = json.dumps(item_key)
+            yield f"{separator}{json.dumps(item_key)}: "
+            yield from iter_json(item, item_key)
+            separator = ", "
+        yield "}" if value else "{}"
+    elif isinstance(value, list):
+        separator = "["
+        for item in value:
+            yield separator
+            if key == "SAMPLE":
+                yield json.dumps(
+                    [dict(zip(AUDIT_CSV_HEADERS, csv_row)) for csv_row in item]
+                )
+            else:
+                yield from iter_json(item)
+            separator = ", "
+        yield "]" if value else "[]"
+    else:
+        yield json.dumps(value)
+
+
+def write_metrics_file(stat_pack, metrics_file_name):
+    """writes the performance and scores of an audit in the prometheus text format
+
+    The file is replaced in one step so the node exporter's textfile collector never
+    reads it half written. Does nothing without a metrics file name.
+    """
+    if not metrics_file_name:
+        return
+    performance = stat_pack["PERFORMANCE"]
+    metrics = [
+        ("g2audit_phase_seconds", "seconds spent in each phase of the audit", []),
+        ("g2audit_total_seconds", "seconds the audit took", []),
+        ("g2audit_records_per_second", "records loaded per second", []),
+        ("g2audit_peak_rss_bytes", "peak resident memory of the audit", []),
+        ("g2audit_largest_entity_records", "records in the largest entity", []),
+        ("g2audit_entities", "entities in each file", []),
+        ("g2audit_pairs", "record pairs resolved together", []),
+        ("g2audit_pair_score", "pair precision, recall and f1-score", []),
+        (
+            "g2audit_data_source_pair_score",
+            "pair precision, recall and f1-score of each data source's records",
+            [],
+        ),
+    ]
+    samples = {name: lines for name, _, lines in metrics}
+    for phase, seconds in performance["PHASE_SECONDS"].items():
+        samples["g2audit_phase_seconds"].append(
+            (f'{{phase="{phase.lower()}"}}', seconds)
+        )
+    samples["g2audit_total_seconds"].append(("", performance["TOTAL_SECONDS"]))
+    for file_type, rate in performance["RECORDS_PER_SECOND"].items():
+        samples["g2audit_records_per_second"].append(
+            (f'{{file="{file_type.lower()}"}}', rate)
+        )
+    if performance["PEAK_RSS_MB"] is not None:
+        samples["g2audit_peak_rss_bytes"].append(
+            ("", round(performance["PEAK_RSS_MB"] * 1024 * 1024))
+        )
+    for file_type, largest in performance["LARGEST_ENTITIES"].items():
+        samples["g2audit_largest_entity_records"].append(
+            (
+                f'{{file="{file_type.lower()}"}}',
+                largest[0]["RECORD_COUNT"] if largest else 0,
+            )
+        )
+    for file_type in ("prior", "newer", "common"):
+        count_name = f"{file_type.upper()}_COUNT"
+        label = f'{{file="{file_type}"}}'
+        samples["g2audit_entities"].append((label, stat_pack["ENTITY"][count_name]))
+        samples["g2audit_pairs"].append((label, stat_pack["PAIRS"][count_name]))
+    for score_name in ("PRECISION", "RECALL", "F1-SCORE"):
+        samples["g2audit_pair_score"].append(
+            (f'{{score="{score_name.lower()}"}}', stat_pack["PAIRS"][score_name])
+        )
+        for data_source, data_source_stat_pack in stat_pack["DATA_SOURCES"].items():
+            data_source_label = data_source.replace("\\", "\\\\").replace('"', '\\"')
+            samples["g2audit_data_source_pair_score"].append(
+                (
+                    f'{{data_source="{data_source_label}",score="{score_name.lower()}"}}',
+                    data_source_stat_pack["PAIRS"][score_name],
+                )
+            )
+
+    lines = []
+    for name, description, _ in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples[name]:
+            lines.append(f"{name}{labels} {value}")
+    metrics_dir = os.path.dirname(os.path.abspath(metrics_file_name))
+    with tempfile.NamedTemporaryFile(
+        "w", dir=metrics_dir, suffix=".tmp", delete=False
+    ) as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f.name, metrics_file_name)